@@ -10,6 +10,8 @@ from typing import List, Optional
 import asyncio
 import httpx
 import os
+import time
+import uuid
 
 
 TTS_API_URL = os.getenv("TTS_API_URL", "http://localhost:8080")
@@ -97,19 +99,73 @@ async def process_audio(db: Session, audio_id: int, text_entry_id: int, voice_id
         ),
         "user_type": "user" if text_entry.user_id else "guest",
         "preset": "fast",  # was ultra_fast | very_fast | fast | standard | high_quality
+        # Lets the TTS API return the existing job if a submission is repeated, e.g. after a timeout.
+        "request_key": f"audio-{audio_id}-{uuid.uuid4().hex}",
     }
 
     max_retries = 500
     retry_delay = 1
-
-    for attempt in range(max_retries):
+    poll_interval = 2
+    max_poll_interval = 30
+    # A job still queued or running after this long is taken to be stuck, and the audio fails.
+    max_queued_seconds = 3600
+    max_running_seconds = 1800
+
+    # Submit the generation as a job once, then poll its status. Only failed HTTP calls count as attempts, so a
+    # long generation is waited for instead of being re-posted.
+    job_id = None
+    submitted_at = None
+    running_since = None
+    attempt = 0
+    while attempt < max_retries:
         try:
             async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    f"{TTS_API_URL}/generate_audio", json=tts_data, timeout=30.0
+                if job_id is None:
+                    response = await client.post(
+                        f"{TTS_API_URL}/jobs", json=tts_data, timeout=30.0
+                    )
+                    response.raise_for_status()
+                    job_id = response.json()["job_id"]
+                    submitted_at = time.monotonic()
+                    running_since = None
+                response = await client.get(
+                    f"{TTS_API_URL}/jobs/{job_id}", timeout=30.0
                 )
                 response.raise_for_status()
-                tts_result = response.json()
+                job = response.json()
+
+            if db.query(Audio).filter(Audio.id == audio_id).first() is None:
+                # The audio (or its tab) was deleted meanwhile; stop the generation nobody will fetch.
+                await cancel_tts_job(job_id)
+                break
+            if job["status"] == "failed":
+                print(f"TTS job {job_id} failed for audio {audio_id}: {job['error']}")
+                mark_audio_failed(db, audio_id)
+                break
+            if job["status"] != "completed":
+                now = time.monotonic()
+                if job["status"] == "running":
+                    running_since = running_since or now
+                    waited, limit = now - running_since, max_running_seconds
+                else:
+                    waited, limit = now - submitted_at, max_queued_seconds
+                if waited > limit:
+                    print(
+                        f"TTS job {job_id} for audio {audio_id} still {job['status']} "
+                        f"after {waited:.0f}s, giving up"
+                    )
+                    mark_audio_failed(db, audio_id)
+                    await cancel_tts_job(job_id)
+                    break
+                # Queued jobs come with the TTS API's wait estimate; check back about halfway through it.
+                await asyncio.sleep(
+                    min(
+                        max(poll_interval, job.get("estimated_wait", 0) / 2),
+                        max_poll_interval,
+                    )
+                )
+                continue
+            tts_result = job["result"]
 
             # Update the audio object with the results from the TTS API
             db_audio = db.query(Audio).filter(Audio.id == audio_id).first()
@@ -137,37 +193,61 @@ async def process_audio(db: Session, audio_id: int, text_entry_id: int, voice_id
             break  # Exit the loop if successful
 
         except httpx.HTTPStatusError as e:
+            if e.response.status_code == 429:
+                # The TTS API is at capacity. Not a failure: wait as long as it asks and submit again.
+                retry_after = float(e.response.headers.get("Retry-After", retry_delay))
+                print(f"TTS API busy, retrying audio {audio_id} in {retry_after}s")
+                await asyncio.sleep(retry_after)
+                continue
+            attempt += 1
             print(
-                f"Attempt {attempt + 1} failed for audio {audio_id}: HTTP {e.response.status_code}"
+                f"Attempt {attempt} failed for audio {audio_id}: HTTP {e.response.status_code}"
             )
             print(f"Response content: {e.response.text}")
-            if e.response.status_code == 404:
+            if e.response.status_code == 404 and job_id is None:
                 print(
                     "Voice not found. Please check if the voice exists in the TTS API."
                 )
                 break  # Exit the retry loop if voice is not found
-            if attempt == max_retries - 1:
+            if e.response.status_code == 404:
+                job_id = None  # The TTS API lost the job, submit it again.
+            if attempt == max_retries:
                 # Update status to FAILED if all retries are exhausted
-                db_audio = db.query(Audio).filter(Audio.id == audio_id).first()
-                if db_audio:
-                    db_audio.status = AudioStatus.FAILED
-                    db.commit()
+                mark_audio_failed(db, audio_id)
+                await cancel_tts_job(job_id)
                 print(f"All retries failed for audio {audio_id}: {str(e)}")
             else:
                 await asyncio.sleep(retry_delay)
         except httpx.RequestError as e:
-            print(f"Attempt {attempt + 1} failed for audio {audio_id}: {str(e)}")
-            if attempt == max_retries - 1:
+            attempt += 1
+            print(f"Attempt {attempt} failed for audio {audio_id}: {str(e)}")
+            if attempt == max_retries:
                 # Update status to FAILED if all retries are exhausted
-                db_audio = db.query(Audio).filter(Audio.id == audio_id).first()
-                if db_audio:
-                    db_audio.status = AudioStatus.FAILED
-                    db.commit()
+                mark_audio_failed(db, audio_id)
+                await cancel_tts_job(job_id)
                 print(f"All retries failed for audio {audio_id}: {str(e)}")
             else:
                 await asyncio.sleep(retry_delay)
 
 
+async def cancel_tts_job(job_id: Optional[str]):
+    """Tells the TTS API to drop a job whose result is no longer needed. Best effort."""
+    if job_id is None:
+        return
+    try:
+        async with httpx.AsyncClient() as client:
+            await client.post(f"{TTS_API_URL}/jobs/{job_id}/cancel", timeout=10.0)
+    except httpx.RequestError as e:
+        print(f"Failed to cancel TTS job {job_id}: {str(e)}")
+
+
+def mark_audio_failed(db: Session, audio_id: int):
+    db_audio = db.query(Audio).filter(Audio.id == audio_id).first()
+    if db_audio:
+        db_audio.status = AudioStatus.FAILED
+        db.commit()
+
+
 async def get_audio(db: Session, audio_id: int) -> AudioResponse:
     db_audio = db.query(Audio).filter(Audio.id == audio_id).first()
     if db_audio is None:
@@ -5,6 +5,7 @@ import aiofiles
 import shutil
 import aiohttp
 import asyncio
+import time
 from sqlalchemy.orm import Session
 from fastapi import HTTPException, status, BackgroundTasks, UploadFile
 from models import Voice, User
@@ -14,6 +15,10 @@ from typing import Optional
 
 
 TTS_API_URL = os.getenv("TTS_API_URL", "http://localhost:8080")
+# How often to check whether the TTS API has finished ingesting an uploaded voice.
+VOICE_STATUS_POLL_INTERVAL = 2
+# A voice still processing after this many seconds is taken to be lost (e.g. the TTS API restarted) and fails.
+VOICE_STATUS_MAX_WAIT = 1800
 
 
 import tempfile
@@ -153,12 +158,38 @@ async def add_voice_to_tts_api(
         async with session.post(url, data=data) as response:
             response_text = await response.text()
             print(f"TTS API Response: {response.status} - {response_text}")
-            if response.status != 201:
+            if response.status not in (201, 202):
                 raise HTTPException(
                     status_code=response.status,
                     detail=f"Failed to add voice to TTS API: {response_text}",
                 )
-            return await response.json()
+            result = await response.json()
+
+        # 202 means the voice's latents are still being computed.
+        deadline = time.monotonic() + VOICE_STATUS_MAX_WAIT
+        while result.get("status", "ready") == "processing":
+            if time.monotonic() > deadline:
+                raise HTTPException(
+                    status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                    detail=f"TTS API still processing voice after {VOICE_STATUS_MAX_WAIT}s",
+                )
+            await asyncio.sleep(VOICE_STATUS_POLL_INTERVAL)
+            async with session.get(
+                f"{TTS_API_URL}/voice_status/{user_id}/{voice_name}"
+            ) as response:
+                if response.status != 200:
+                    raise HTTPException(
+                        status_code=response.status,
+                        detail=f"Failed to get voice status: {await response.text()}",
+                    )
+                voice_status = await response.json()
+            result["status"] = voice_status["status"]
+            if voice_status["status"] == "failed":
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail=f"TTS API failed to process voice: {voice_status['error']}",
+                )
+        return result
 
 
 def get_voices(db: Session, skip: int = 0, limit: int = 10) -> list[VoiceResponse]:
@@ -1,28 +1,119 @@
 """ ./tts_api/app.py"""
 
+import logging
 import time
-from flask import Flask, request, jsonify, send_from_directory
-import torchaudio
-from tortoise.api import TextToSpeech
+from flask import Flask, Response, request, jsonify, send_from_directory
+from tortoise.utils.audio import VoiceRegistry
+from tortoise.utils.text import split_and_recombine_text
 import os
 import uuid
 from queue import Queue
 import threading
-from tortoise.utils.audio import load_voice
+import requests
 import re
-import librosa
 import shutil
 from werkzeug.utils import secure_filename
 from pydub import AudioSegment
 
+from concurrent.futures import ThreadPoolExecutor
+
+from services.admission import Overloaded, WaitEstimator, check_queue_wait
+from services.audio_output import AUDIO_FORMATS, OUTPUT_SAMPLE_RATES, encode_audio
+from services.audio_stream import pcm16_bytes, wav_stream_header
+from services.batch_scheduler import BatchScheduler
+from services.fair_queue import FairQueue, QueueLimitExceeded
+from services.inference_pool import InferencePool, TaskCancelled
+from services.job_store import JobStore
+from services.latent_cache import LatentCache
+from services.metrics import Metrics
+from services.output_cache import CoalescedResult, OutputCache
 from services.voice_service import VoiceService
 
+logging.basicConfig(level=logging.INFO)
+
 app = Flask(__name__)
+# Let a front web server that understands X-Sendfile send download bodies, instead of
+# this process reading them. Without it, send_file() still hands the open file to the
+# WSGI server's wsgi.file_wrapper, which servers like gunicorn answer with sendfile().
+app.config["USE_X_SENDFILE"] = os.environ.get("USE_X_SENDFILE", "0") == "1"
 
 BASE_VOICES_DIR = "tts_api/tortoise/voices"
 MIN_AUDIO_LENGTH = 15
+LATENT_CACHE_DIR = os.environ.get("LATENT_CACHE_DIR", "cache/latents")
+LATENT_CACHE_SIZE = int(os.environ.get("LATENT_CACHE_SIZE", "32"))
+TTS_BATCH_WINDOW = float(os.environ.get("TTS_BATCH_WINDOW", "0.05"))
+TTS_MAX_BATCH = int(os.environ.get("TTS_MAX_BATCH", "4"))
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", "cache/jobs.db")
+JOB_CALLBACK_TIMEOUT = 10
+BASE_OUTPUT_DIR = "output"
+# Generated files never change under their unique names, so clients may keep them this long.
+DOWNLOAD_MAX_AGE = int(os.environ.get("DOWNLOAD_MAX_AGE", str(365 * 24 * 3600)))
+ENCODER_WORKERS = int(os.environ.get("ENCODER_WORKERS", "2"))
+TTS_WORKERS = int(os.environ.get("TTS_WORKERS", "1"))
+TTS_PRELOAD_LANGS = os.environ.get("TTS_PRELOAD_LANGS", "vi,en").split(",")
+# Budget for the per-language autoregressive models of one worker, in MB. 0 means no limit.
+TTS_MODEL_MEMORY_BUDGET_MB = int(os.environ.get("TTS_MODEL_MEMORY_BUDGET_MB", "0"))
+# Run the autoregressive model on DeepSpeed's inference kernels. Off by default: the plain model samples with
+# early-stopping candidates, a shared prompt KV cache, kept latents and slots shared across running requests,
+# none of which the DeepSpeed kernels support.
+TTS_USE_DEEPSPEED = os.environ.get("TTS_USE_DEEPSPEED", "0") == "1"
+TTS_WORKER_THREADS = int(
+    os.environ.get("TTS_WORKER_THREADS", str(max(1, os.cpu_count() // TTS_WORKERS)))
+)
+OUTPUT_CACHE_INDEX = os.environ.get("OUTPUT_CACHE_INDEX", "cache/output_index.json")
+OUTPUT_CACHE_MAX_BYTES = int(
+    os.environ.get("OUTPUT_CACHE_MAX_BYTES", str(10 * 1024**3))
+)
+# Share of inference each user type gets while both have requests waiting, as "type:weight,...".
+TTS_CLASS_WEIGHTS = {
+    user_type: int(weight)
+    for user_type, weight in (
+        entry.split(":")
+        for entry in os.environ.get("TTS_CLASS_WEIGHTS", "user:4,guest:1").split(",")
+    )
+}
+# Per-user limits on requests waiting in the queue and requests being generated. 0 means no limit.
+TTS_USER_MAX_QUEUED = int(os.environ.get("TTS_USER_MAX_QUEUED", "8"))
+TTS_USER_MAX_RUNNING = int(
+    os.environ.get("TTS_USER_MAX_RUNNING", str(TTS_MAX_BATCH))
+)
+# Requests are refused with 429 while the estimated queue wait exceeds this many seconds.
+TTS_MAX_QUEUE_WAIT = float(os.environ.get("TTS_MAX_QUEUE_WAIT", "120"))
+# Generation speed assumed for a preset until a batch with it has finished.
+TTS_DEFAULT_SECONDS_PER_CHAR = float(
+    os.environ.get("TTS_DEFAULT_SECONDS_PER_CHAR", "0.1")
+)
+
+voice_registry = VoiceRegistry(BASE_VOICES_DIR)
+voice_registry.build()
+latent_cache = LatentCache(voice_registry, LATENT_CACHE_DIR, LATENT_CACHE_SIZE)
+
+
+def ingest_voice(voice_name, on_done):
+    """Has an inference worker precompute an uploaded voice's latents for the preloaded languages."""
+    inference_pool.submit_ingestion(
+        voice_name, [lang for lang in TTS_PRELOAD_LANGS if lang], on_done
+    )
 
-voice_service = VoiceService(app, BASE_VOICES_DIR, MIN_AUDIO_LENGTH)
+
+voice_service = VoiceService(
+    app, BASE_VOICES_DIR, MIN_AUDIO_LENGTH, latent_cache, voice_registry, ingest_voice
+)
+job_store = JobStore(JOB_STORE_PATH)
+output_cache = OutputCache(BASE_OUTPUT_DIR, OUTPUT_CACHE_INDEX, OUTPUT_CACHE_MAX_BYTES)
+
+metrics = Metrics()
+metrics.histogram(
+    "tts_stage_seconds",
+    "Time spent in each stage of speech generation, per request batch.",
+)
+metrics.max_gauge(
+    "tts_stage_peak_memory_bytes",
+    "Highest peak memory seen during each stage (CUDA memory on GPU, process RSS on CPU).",
+)
+metrics.gauge(
+    "tts_in_flight_requests", "Requests taken from the queue and not yet finished."
+)
 
 
 @app.route("/add_voice", methods=["POST"])
@@ -35,6 +126,11 @@ def list_voices(user_id):
     return voice_service.list_voices(user_id)
 
 
+@app.route("/voice_status/<user_id>/<voice_name>", methods=["GET"])
+def voice_status(user_id, voice_name):
+    return voice_service.get_voice_status(user_id, voice_name)
+
+
 @app.route("/delete_voice/<user_id>/<voice_name>", methods=["DELETE"])
 def delete_voice(user_id, voice_name):
     return voice_service.delete_voice(user_id, voice_name)
@@ -50,54 +146,211 @@ def delete_all_custom_voices():
     return voice_service.delete_all_custom_voices()
 
 
-# Create a queue to handle requests
-request_queue = Queue()
+# Requests are taken in turns across users, with paying users weighted ahead of guests.
+request_queue = FairQueue(
+    TTS_CLASS_WEIGHTS,
+    default_class="guest",
+    max_queued_per_user=TTS_USER_MAX_QUEUED or None,
+    max_running_per_user=TTS_USER_MAX_RUNNING or None,
+)
+wait_estimator = WaitEstimator(TTS_WORKERS, TTS_DEFAULT_SECONDS_PER_CHAR)
+
+# Encoding and writing output files happens here so the model thread can move on to the next request.
+encoder_pool = ThreadPoolExecutor(
+    max_workers=ENCODER_WORKERS, thread_name_prefix="encoder"
+)
+
+
+def save_speech(gen, output, generated_time, labels):
+    """
+    Encode a generated clip as requested by output (path, format, sample rate) and
+    build the generation result. Runs on the encoder pool, off the model thread.
+    """
+    start_time = time.perf_counter()
+    output_file, audio_format, sample_rate = output
+    audio_duration = encode_audio(gen, output_file, audio_format, sample_rate)
+    metrics.observe(
+        "tts_stage_seconds",
+        time.perf_counter() - start_time,
+        stage="encoding",
+        **labels,
+    )
+    # The clip is written at a single rate, so its wavelength equals its duration.
+    return output_file, generated_time, audio_duration, audio_duration
 
 
-def generate_speech(tts_model, text, voice_name, preset, output_file):
-    """Generate speech using the specified voice and text."""
-    start_time = time.time()
-    voice_samples, conditioning_latents = load_voice(voice_name)
-    gen = tts_model.tts_with_preset(
-        text,
-        voice_samples=voice_samples,
-        conditioning_latents=conditioning_latents,
-        preset=preset,
-    )
-    torchaudio.save(output_file, gen.squeeze(0).cpu(), 24000)
-    end_time = time.time()
-    generated_time = end_time - start_time
+def finish_request(result_queue, result):
+    metrics.add("tts_in_flight_requests", -1)
+    result_queue.put(result)
 
-    # Calculate audio duration and wavelength
-    audio_duration = librosa.get_duration(filename=output_file)
-    y, sr = librosa.load(output_file)
-    wavelength = len(y) / sr
 
-    return output_file, generated_time, audio_duration, wavelength
+def deliver_speech(gen, output, generated_time, result_queue, labels):
+    """Hand a generated clip to its requester, encoding it first when it goes to a file."""
+    if output is None:
+        finish_request(result_queue, gen)
+        return
+    future = encoder_pool.submit(save_speech, gen, output, generated_time, labels)
+    future.add_done_callback(
+        lambda f: finish_request(
+            result_queue, f.exception() if f.exception() is not None else f.result()
+        )
+    )
 
 
 def is_valid_user_id(user_id):
     return re.match(r"^[a-zA-Z0-9]+$", user_id) is not None
 
 
-# Function to process requests in the queue
-def process_queue():
-    while True:
-        tts_model, text, voice_name, preset, output_file, result_queue = (
-            request_queue.get()
-        )
-        try:
-            output_file, generated_time, audio_duration, wavelength = generate_speech(
-                tts_model, text, voice_name, preset, output_file
-            )
-            result_queue.put((output_file, generated_time, audio_duration, wavelength))
-        finally:
-            request_queue.task_done()
+def is_valid_voice_name(voice_name):
+    """A voice name is a single directory name: no path separators and no '.' or '..'."""
+    return (
+        isinstance(voice_name, str)
+        and voice_name not in ("", ".", "..")
+        and not any(sep in voice_name for sep in ("/", "\\", os.sep))
+    )
 
 
-# Load TextToSpeech models
-tts = TextToSpeech()
-tts_vi = TextToSpeech(lang="vi")
+def batch_key(item):
+    """
+    Requests for the same language, preset and seed can share one batched pass through TextToSpeech.
+    Seeded texts that need more than one segment go through the long-form pipeline on their own, and so do all of
+    them with DeepSpeed.
+    """
+    if (item[4] is not None or TTS_USE_DEEPSPEED) and len(
+        split_and_recombine_text(item[1])
+    ) > 1:
+        return id(item)
+    return item[0], item[3], item[4]
+
+
+batch_scheduler = BatchScheduler(
+    request_queue,
+    key=batch_key,
+    window=TTS_BATCH_WINDOW,
+    max_batch=TTS_MAX_BATCH,
+)
+
+
+metrics.gauge(
+    "tts_queue_depth", "Requests waiting to be batched.", batch_scheduler.pending
+)
+
+
+def estimated_wait():
+    """Predicted seconds a request queued now waits before generation starts."""
+    return wait_estimator.estimate(
+        [(item[3], item[1]) for item in request_queue.snapshot()]
+    )
+
+
+metrics.gauge(
+    "tts_estimated_wait_seconds",
+    "Predicted queue wait for a newly admitted request.",
+    estimated_wait,
+)
+
+
+def queue_user(params):
+    """Identity the request queue takes turns and applies per-user limits by."""
+    return params["user_type"], params["user_id"]
+
+
+def admit_request(params):
+    """Raises Overloaded if the request should be turned away for now."""
+    wait = estimated_wait()
+    try:
+        request_queue.check(queue_user(params))
+    except QueueLimitExceeded as e:
+        raise Overloaded(str(e), retry_after=wait) from e
+    check_queue_wait(wait, TTS_MAX_QUEUE_WAIT)
+
+
+def overloaded_response(error):
+    response = jsonify(
+        {
+            "error": str(error),
+            "retry_after": error.retry_after,
+            "queue_depth": request_queue.qsize(),
+            "estimated_wait": estimated_wait(),
+        }
+    )
+    return response, 429, {"Retry-After": str(error.retry_after)}
+
+
+def next_batch(timeout=None, join=None, max_batch=None):
+    """
+    Takes the next batch for the inference pool and records how long its requests waited. Given join, a batch that
+    is being generated, only requests that can be added to its generation are taken, at most max_batch of them. Only
+    unseeded generations take new requests while they run, and none do with DeepSpeed.
+    """
+    if join is None:
+        batch = batch_scheduler.next_batch(timeout)
+    elif join[0][4] is None and not TTS_USE_DEEPSPEED:
+        batch = batch_scheduler.next_batch(
+            timeout, key=batch_key(join[0]), max_batch=max_batch
+        )
+    else:
+        batch = None
+    if batch is None:
+        return None
+    now = time.time()
+    for item in batch:
+        metrics.observe(
+            "tts_stage_seconds",
+            now - item[7],
+            stage="queue_wait",
+            lang=item[0],
+            preset=item[3],
+        )
+    metrics.add("tts_in_flight_requests", len(batch))
+    wait_estimator.started(id(batch), [(item[3], item[1]) for item in batch])
+    for item in batch:
+        # Jobs (and the jobs sharing an output with them) are marked running.
+        started = getattr(item[6], "started", None)
+        if started is not None:
+            started()
+    return batch
+
+
+def finish_batch(batch, gens, generated_time, timings):
+    """Called by the inference pool with a batch's waveforms, or with the exception that failed it."""
+    labels = {"lang": batch[0][0], "preset": batch[0][3]}
+    wait_estimator.finished(
+        id(batch),
+        [(item[3], item[1]) for item in batch],
+        None if isinstance(gens, Exception) else generated_time,
+    )
+    for stage, (seconds, peak) in timings.items():
+        metrics.observe("tts_stage_seconds", seconds, stage=stage, **labels)
+        metrics.record_max(
+            "tts_stage_peak_memory_bytes", peak, stage=stage, **labels
+        )
+    try:
+        if isinstance(gens, Exception):
+            for item in batch:
+                finish_request(item[6], gens)
+        else:
+            for item, gen in zip(batch, gens):
+                deliver_speech(gen, item[5], generated_time, item[6], labels)
+    finally:
+        for item in batch:
+            request_queue.task_done(item)
+
+
+inference_pool = InferencePool(
+    TTS_WORKERS,
+    TTS_WORKER_THREADS,
+    {
+        "voices_dir": BASE_VOICES_DIR,
+        "latent_cache_dir": LATENT_CACHE_DIR,
+        "latent_cache_size": LATENT_CACHE_SIZE,
+        "preload_langs": [lang for lang in TTS_PRELOAD_LANGS if lang],
+        "model_memory_budget": TTS_MODEL_MEMORY_BUDGET_MB * 1024**2 or None,
+        "use_deepspeed": TTS_USE_DEEPSPEED,
+        "max_batch": TTS_MAX_BATCH,
+    },
+    app.logger,
+)
 
 DEFAULT_VOICES = [
     "default_en_male",
@@ -105,10 +358,6 @@ DEFAULT_VOICES = [
     "default_vi_male",
     "default_vi_female",
 ]
-BASE_OUTPUT_DIR = "output"
-
-# Start a thread to process the queue
-threading.Thread(target=process_queue, daemon=True).start()
 
 
 @app.route("/health")
@@ -116,9 +365,39 @@ def health():
     return "OK", 200
 
 
-@app.route("/generate_audio", methods=["POST"])
-def generate_audio():
-    data = request.json
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/health/workers")
+def workers_health():
+    workers = inference_pool.health()
+    status = 200 if any(worker["alive"] for worker in workers) else 503
+    return jsonify({"workers": workers}), status
+
+
+@app.route("/queue")
+def queue_status():
+    """Current load, for clients that want to pace their submissions."""
+    return jsonify(
+        {
+            "queue_depth": request_queue.qsize(),
+            "estimated_wait": estimated_wait(),
+            "max_wait": TTS_MAX_QUEUE_WAIT,
+            "workers": TTS_WORKERS,
+            "seconds_per_char": wait_estimator.rates(),
+        }
+    )
+
+
+def prepare_generation(data, url_root, save_output=True):
+    """
+    Validate a generation request and work out where its output goes.
+    Returns (params, None) on success and (None, error_response) otherwise.
+    params only holds JSON-serializable values so it can be stored with a job.
+    With save_output=False no output file is assigned and output_file is None.
+    """
     text = data.get("text")
     lang = data.get("lang", "vi")
     voice_name = data.get("voice_name", "default_vi_female")
@@ -126,57 +405,164 @@ def generate_audio():
     user_id = data.get("user_id", "anonymous")
     user_type = data.get("user_type", "guest")
     preset = data.get("preset", "ultra_fast")
+    seed = data.get("seed")
+    audio_format = data.get("format", "wav")
+    sample_rate = data.get("sample_rate", 24000)
+
+    if not text or not lang:
+        return None, (jsonify({"error": "Please provide both text and lang"}), 400)
 
     print(
         f"Processing request - Text: {text[:50]}..., Lang: {lang}, Voice: {voice_name}, User ID: {user_id}, User Type: {user_type}, Preset: {preset}"
     )
 
-    if not text or not lang:
-        return jsonify({"error": "Please provide both text and lang"}), 400
-
     if user_type not in ["guest", "user"]:
-        return jsonify({"error": "Invalid user type. Must be 'guest' or 'user'"}), 400
+        return None, (
+            jsonify({"error": "Invalid user type. Must be 'guest' or 'user'"}),
+            400,
+        )
+
+    if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+        return None, (jsonify({"error": "Invalid seed. Must be an integer"}), 400)
+
+    if audio_format not in AUDIO_FORMATS:
+        return None, (
+            jsonify(
+                {"error": f"Invalid format. Must be one of {list(AUDIO_FORMATS)}"}
+            ),
+            400,
+        )
+
+    if sample_rate not in OUTPUT_SAMPLE_RATES:
+        return None, (
+            jsonify(
+                {
+                    "error": f"Invalid sample rate. Must be one of {list(OUTPUT_SAMPLE_RATES)}"
+                }
+            ),
+            400,
+        )
 
     if not is_valid_user_id(user_id):
-        return jsonify({"error": "Invalid user ID. Must be alphanumeric"}), 400
+        return None, (jsonify({"error": "Invalid user ID. Must be alphanumeric"}), 400)
 
-    if lang == "vi":
-        tts_model = tts_vi
-    else:
-        tts_model = tts
+    if not is_valid_voice_name(voice_name):
+        return None, (jsonify({"error": "Invalid voice name"}), 400)
 
     # Check if it's a user-uploaded voice
     if voice_name not in DEFAULT_VOICES:
-        user_voice_dir = os.path.join(BASE_VOICES_DIR, user_id, voice_name)
-        if os.path.exists(user_voice_dir):
-            voice_new_name = os.path.join(user_id, voice_name)
-        else:
-            return jsonify({"error": "Requested custom voice not found"}), 404
+        voice_new_name = os.path.join(user_id, voice_name)
+        try:
+            voice_registry.get(voice_new_name)
+        except ValueError:
+            return None, (jsonify({"error": "Requested custom voice not found"}), 404)
+        status = voice_service.voice_status(voice_new_name)
+        if status != VoiceService.READY:
+            return None, (
+                jsonify(
+                    {"error": f"Requested custom voice is {status}", "status": status}
+                ),
+                409,
+            )
     else:
         voice_new_name = voice_name
 
-    # Create user-specific output directory
-    user_output_dir = os.path.join(BASE_OUTPUT_DIR, user_type, user_id)
-    os.makedirs(user_output_dir, exist_ok=True)
-
-    # Generate a unique filename
     timestamp = int(time.time())
-    filename = f"{timestamp}_{voice_name}_{uuid.uuid4().hex[:8]}.wav"
-    output_file = os.path.join(user_output_dir, filename)
+    filename = None
+    output_file = None
+    if save_output:
+        # Create user-specific output directory
+        user_output_dir = os.path.join(BASE_OUTPUT_DIR, user_type, user_id)
+        os.makedirs(user_output_dir, exist_ok=True)
+
+        # Generate a unique filename
+        extension = AUDIO_FORMATS[audio_format]["extension"]
+        filename = f"{timestamp}_{voice_name}_{uuid.uuid4().hex[:8]}.{extension}"
+        output_file = os.path.join(user_output_dir, filename)
+
+    params = {
+        "text": text,
+        "lang": lang,
+        "voice_name": voice_name,
+        "voice_new_name": voice_new_name,
+        "user_id": user_id,
+        "user_type": user_type,
+        "preset": preset,
+        "seed": seed,
+        "format": audio_format,
+        "sample_rate": sample_rate,
+        "timestamp": timestamp,
+        "filename": filename,
+        "output_file": output_file,
+        "url_root": url_root,
+    }
+    return params, None
+
+
+def enqueue_generation(params, result_queue, text=None, admit=True):
+    """
+    Queue a generation for params, or for just `text` when generating part of the request.
+    Whole requests that are saved to a file are served from the output cache when possible,
+    and attach to an identical generation that is already queued or running.
+    With admit=True, raises Overloaded if the request is refused by admission control;
+    follow-up work of an admitted request is queued with admit=False.
+    """
+    if admit:
+        admit_request(params)
+    model_lang = "vi" if params["lang"] == "vi" else "en"
+    output_file = params["output_file"]
+    if text is None and output_file is not None:
+        key = OutputCache.key(
+            params["text"],
+            params["lang"],
+            latent_cache.voice_digest(params["voice_new_name"]),
+            params["preset"],
+            params.get("seed"),
+            params.get("format", "wav"),
+            params.get("sample_rate", 24000),
+        )
+        cached = output_cache.get(key, output_file)
+        if cached is not None:
+            result_queue.put(cached)
+            return
+        if not output_cache.claim(key, output_file, result_queue):
+            return
+        result_queue = CoalescedResult(output_cache, key)
 
-    result_queue = Queue()
     request_queue.put(
-        (tts_model, text, voice_new_name, preset, output_file, result_queue)
+        (
+            model_lang,
+            params["text"] if text is None else text,
+            params["voice_new_name"],
+            params["preset"],
+            params.get("seed"),
+            None
+            if output_file is None
+            else (
+                output_file,
+                params.get("format", "wav"),
+                params.get("sample_rate", 24000),
+            ),
+            result_queue,
+            time.time(),
+        ),
+        params["user_type"],
+        queue_user(params),
     )
 
-    # Wait for the result
-    output_file, generated_time, audio_duration, wavelength = result_queue.get()
 
-    download_url = request.url_root + f"download/{user_type}/{user_id}/{filename}"
-    delete_url = request.url_root + f"delete_audio/{user_type}/{user_id}/{filename}"
+def build_response_data(params, result):
+    output_file, generated_time, audio_duration, wavelength = result
+    url_root = params["url_root"]
+    user_type = params["user_type"]
+    user_id = params["user_id"]
+    filename = params["filename"]
+
+    download_url = url_root + f"download/{user_type}/{user_id}/{filename}"
+    delete_url = url_root + f"delete_audio/{user_type}/{user_id}/{filename}"
     file_size = os.path.getsize(output_file)
 
-    response_data = {
+    return {
         "message": "Audio generated successfully",
         "download_url": download_url,
         "delete_url": delete_url,
@@ -188,22 +574,229 @@ def generate_audio():
         "audio_wavelength": wavelength,
         "user_type": user_type,
         "user_id": user_id,
-        "voice_name": voice_name,
-        "language": lang,
-        "preset": preset,
-        "timestamp": timestamp,
-        "text_length": len(text),
-        "mime_type": "audio/wav",
-        "sample_rate": 24000,
+        "voice_name": params["voice_name"],
+        "language": params["lang"],
+        "preset": params["preset"],
+        "timestamp": params["timestamp"],
+        "text_length": len(params["text"]),
+        "mime_type": AUDIO_FORMATS[params.get("format", "wav")]["mime_type"],
+        "sample_rate": params.get("sample_rate", 24000),
+    }
+
+
+@app.route("/generate_audio", methods=["POST"])
+def generate_audio():
+    params, error = prepare_generation(request.json, request.url_root)
+    if error is not None:
+        return error
+
+    result_queue = Queue()
+    try:
+        enqueue_generation(params, result_queue)
+    except Overloaded as e:
+        return overloaded_response(e)
+
+    # Wait for the result
+    result = result_queue.get()
+    if isinstance(result, Exception):
+        return jsonify({"error": f"Failed to generate audio: {str(result)}"}), 500
+
+    return jsonify(build_response_data(params, result))
+
+
+@app.route("/generate_audio_stream", methods=["POST"])
+def generate_audio_stream():
+    """
+    Streams a WAV as the text is synthesized sentence by sentence, so playback can start
+    once the first segment is vocoded. Takes the same JSON as /generate_audio.
+    """
+    params, error = prepare_generation(
+        request.json, request.url_root, save_output=False
+    )
+    if error is not None:
+        return error
+
+    segments = split_and_recombine_text(params["text"])
+    if not segments:
+        return jsonify({"error": "Text contains nothing to speak"}), 400
+
+    result_queue = Queue()
+    try:
+        enqueue_generation(params, result_queue, text=segments[0])
+    except Overloaded as e:
+        return overloaded_response(e)
+
+    def stream():
+        yield wav_stream_header(24000)
+        for i in range(len(segments)):
+            result = result_queue.get()
+            if isinstance(result, Exception):
+                app.logger.error("Streaming generation failed: %s", str(result))
+                return
+            # Queue the next segment before sending this one, so generation never waits on the client.
+            if i + 1 < len(segments):
+                enqueue_generation(
+                    params, result_queue, text=segments[i + 1], admit=False
+                )
+            yield pcm16_bytes(result)
+
+    return Response(stream(), mimetype="audio/wav")
+
+
+class JobResult:
+    """Stands in for a request's result queue and records the outcome in the job store."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def put(self, result):
+        job = job_store.get(self.job_id)
+        if job["status"] == JobStore.CANCELLED:
+            return
+        if isinstance(result, Exception):
+            job_store.fail(self.job_id, str(result))
+        else:
+            try:
+                job_store.complete(
+                    self.job_id, build_response_data(job["params"], result)
+                )
+            except Exception as e:
+                job_store.fail(self.job_id, str(e))
+        if job["callback_url"]:
+            threading.Thread(
+                target=notify_callback,
+                args=(job["callback_url"], self.job_id),
+                daemon=True,
+            ).start()
+
+    def started(self):
+        job_store.start(self.job_id)
+
+    def cancelled(self):
+        job = job_store.get(self.job_id)
+        return job is not None and job["status"] == JobStore.CANCELLED
+
+
+def job_status(job):
+    status = {
+        "job_id": job["id"],
+        "status": job["status"],
+        "result": job["result"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
     }
+    if job["status"] == JobStore.QUEUED:
+        # Lets pollers wait about as long as the job is likely to take instead of polling blindly.
+        status["queue_depth"] = request_queue.qsize()
+        status["estimated_wait"] = estimated_wait()
+    return status
+
+
+def notify_callback(callback_url, job_id):
+    try:
+        requests.post(
+            callback_url,
+            json=job_status(job_store.get(job_id)),
+            timeout=JOB_CALLBACK_TIMEOUT,
+        )
+    except requests.RequestException as e:
+        app.logger.error(
+            "Callback to %s for job %s failed: %s", callback_url, job_id, str(e)
+        )
+
 
-    return jsonify(response_data)
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    data = request.json
+    request_key = data.get("request_key")
+    # Resubmitting the same request returns the existing job instead of generating twice.
+    job = job_store.find(request_key) if request_key is not None else None
+    if job is None:
+        params, error = prepare_generation(data, request.url_root)
+        if error is not None:
+            return error
+        try:
+            admit_request(params)
+        except Overloaded as e:
+            return overloaded_response(e)
+
+        job, created = job_store.create(
+            params, callback_url=data.get("callback_url"), request_key=request_key
+        )
+        if created:
+            enqueue_generation(params, JobResult(job["id"]), admit=False)
+
+    response = job_status(job)
+    response["status_url"] = request.url_root + f"jobs/{job['id']}"
+    response["result_url"] = request.url_root + f"jobs/{job['id']}/result"
+    return jsonify(response), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_status(job))
+
+
+def is_cancelled(item):
+    """Whether nobody wants the result of a queued or running request any more."""
+    cancelled = getattr(item[6], "cancelled", None)
+    return cancelled is not None and cancelled()
+
+
+def cancel_unwanted_work():
+    """Drops queued requests whose results are no longer wanted and stops batches made only of such requests."""
+    for item in request_queue.remove(is_cancelled):
+        item[6].put(TaskCancelled("Generation was cancelled"))
+    inference_pool.cancel(is_cancelled)
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if not job_store.cancel(job_id):
+        return jsonify({"error": "Job already finished", "status": job["status"]}), 409
+    cancel_unwanted_work()
+    return jsonify(job_status(job_store.get(job_id)))
+
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def get_job_result(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job["status"] == JobStore.FAILED:
+        return jsonify({"error": job["error"], "status": job["status"]}), 500
+    if job["status"] == JobStore.CANCELLED:
+        return jsonify({"error": "Job was cancelled", "status": job["status"]}), 410
+    if job["status"] != JobStore.COMPLETED:
+        return jsonify({"error": "Job not finished", "status": job["status"]}), 409
+    return jsonify(job["result"])
 
 
 @app.route("/download/<user_type>/<user_id>/<filename>", methods=["GET"])
 def download_audio(user_type, user_id, filename):
+    """
+    Serves a generated file with Range support (so players can seek without
+    fetching the whole file), ETag and Last-Modified validators for conditional
+    requests, and cache headers marking the file immutable.
+    """
     directory = os.path.join(BASE_OUTPUT_DIR, user_type, user_id)
-    return send_from_directory(directory, filename, as_attachment=True)
+    response = send_from_directory(
+        directory,
+        filename,
+        as_attachment=True,
+        conditional=True,
+        etag=True,
+        max_age=DOWNLOAD_MAX_AGE,
+    )
+    response.cache_control.immutable = True
+    return response
 
 
 @app.route("/delete_audio/<user_type>/<user_id>/<filename>", methods=["DELETE"])
@@ -212,6 +805,7 @@ def delete_audio(user_type, user_id, filename):
     if os.path.exists(file_path):
         try:
             os.remove(file_path)
+            output_cache.discard(file_path)
             return jsonify({"message": "Audio file deleted successfully"}), 200
         except Exception as e:
             return jsonify({"error": f"Failed to delete audio file: {str(e)}"}), 500
@@ -229,6 +823,7 @@ def delete_all_user_audio(user_type, user_id):
                 file_path = os.path.join(user_dir, filename)
                 if os.path.isfile(file_path):
                     os.remove(file_path)
+                    output_cache.discard(file_path)
             return (
                 jsonify(
                     {
@@ -255,6 +850,7 @@ def delete_all_audio():
         # Recreate the base structure
         os.makedirs(os.path.join(BASE_OUTPUT_DIR, "guest"), exist_ok=True)
         os.makedirs(os.path.join(BASE_OUTPUT_DIR, "user"), exist_ok=True)
+        output_cache.rescan()
 
         return jsonify({"message": "All audio files deleted successfully"}), 200
     except Exception as e:
@@ -263,9 +859,28 @@ def delete_all_audio():
 
 # ... (rest of the existing code)
 
+def start_services():
+    """
+    Starts the inference workers and resumes the work left unfinished when the
+    service last stopped. Defined after everything it uses, and only called at
+    start-up, never on import: workers are spawned processes that re-import
+    this module.
+    """
+    inference_pool.start(next_batch, finish_batch)
+
+    # Finish ingesting voices that were uploaded just before the service stopped.
+    for pending_voice in voice_service.pending_ingestions():
+        voice_service.start_ingestion(pending_voice)
+
+    # Re-queue jobs that were still waiting when the service last stopped.
+    for pending_job in job_store.pending():
+        enqueue_generation(
+            pending_job["params"], JobResult(pending_job["id"]), admit=False
+        )
+
+
 if __name__ == "__main__":
-    # Start the queue processing thread
-    threading.Thread(target=process_queue, daemon=True).start()
+    start_services()
 
     # Run the Flask app
     app.run(host="0.0.0.0", port=8080, debug=False)
@@ -6,7 +6,14 @@ import sys
 # Add the parent directory to the Python path to import the utils module
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from tortoise.models.utils import MODELS, get_model_path, MODELS_DIR
+from tortoise.models.utils import (
+    MODELS,
+    get_model_path,
+    load_checkpoint,
+    mapped_checkpoint_path,
+    MODELS_DIR,
+)
+from tortoise.models.vocoder import VocConf
 
 
 def download_all_models():
@@ -34,5 +41,20 @@ def download_all_models():
     print("All models have been checked and downloaded if necessary.")
 
 
+def convert_all_models():
+    """Converts every downloaded checkpoint to the memory-mapped format TextToSpeech loads from."""
+    subkeys = {conf.value.model_path: conf.value.subkey for conf in VocConf}
+    for model_name in MODELS.keys():
+        model_path = os.path.join(MODELS_DIR, model_name)
+        if not os.path.exists(model_path):
+            continue
+        try:
+            load_checkpoint(model_path, subkeys.get(model_name))
+            print(f"Model {model_name} is mapped from {mapped_checkpoint_path(model_path)}")
+        except Exception as e:
+            print(f"Error converting {model_name}: {str(e)}")
+
+
 if __name__ == "__main__":
     download_all_models()
+    convert_all_models()
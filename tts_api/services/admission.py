@@ -0,0 +1,80 @@
+# ./tts_api/services/admission.py
+
+import math
+import threading
+
+
+class Overloaded(Exception):
+    """A request was turned away for now. retry_after is the suggested wait in whole seconds."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def check_queue_wait(wait, max_wait):
+    """Raises Overloaded if a request would wait more than max_wait seconds before being generated."""
+    if wait > max_wait:
+        raise Overloaded(
+            f"Server busy: estimated queue wait is {wait:.0f} seconds",
+            retry_after=wait - max_wait,
+        )
+
+
+class WaitEstimator:
+    """
+    Predicts how long a newly queued request waits before it is generated.
+    Generation time is modelled as seconds per character of text, learned per
+    preset as an exponentially weighted average over finished batches. The
+    predicted wait is the work queued ahead plus half of the work in progress
+    (on average a running batch is half done), spread over the workers.
+    """
+
+    def __init__(self, workers, default_seconds_per_char, smoothing=0.2):
+        self.workers = workers
+        self.default_seconds_per_char = default_seconds_per_char
+        self.smoothing = smoothing
+        self._rates = {}
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def request_seconds(self, preset, text):
+        with self._lock:
+            rate = self._rates.get(preset, self.default_seconds_per_char)
+        return rate * len(text)
+
+    def started(self, batch_id, requests):
+        """Records that the (preset, text) pairs in requests are being generated as batch_id."""
+        cost = sum(self.request_seconds(preset, text) for preset, text in requests)
+        with self._lock:
+            self._running[batch_id] = cost
+
+    def finished(self, batch_id, requests, seconds=None):
+        """
+        Records that batch_id is done. If it was generated, in `seconds`, the rate
+        of its preset is updated; failed batches pass seconds=None.
+        """
+        chars = sum(len(text) for _, text in requests)
+        with self._lock:
+            self._running.pop(batch_id, None)
+            if seconds is None or not chars:
+                return
+            preset = requests[0][0]
+            rate = seconds / chars
+            previous = self._rates.get(preset)
+            self._rates[preset] = (
+                rate
+                if previous is None
+                else previous + self.smoothing * (rate - previous)
+            )
+
+    def estimate(self, queued):
+        """Predicted wait in seconds for a request queued behind the (preset, text) pairs in queued."""
+        work = sum(self.request_seconds(preset, text) for preset, text in queued)
+        with self._lock:
+            work += sum(self._running.values()) / 2
+        return work / self.workers
+
+    def rates(self):
+        with self._lock:
+            return dict(self._rates)
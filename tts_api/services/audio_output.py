@@ -0,0 +1,61 @@
+# ./tts_api/services/audio_output.py
+
+import torchaudio
+from pydub import AudioSegment
+
+from services.audio_stream import pcm16_bytes
+
+# Sample rate of the waveforms produced by tortoise.
+GENERATED_SAMPLE_RATE = 24000
+
+# Rates a request may ask for. Lower rates are produced by resampling the generated clip.
+OUTPUT_SAMPLE_RATES = (8000, 16000, 22050, 24000)
+
+# Output formats a request may ask for. Compressed formats are encoded by ffmpeg through pydub.
+AUDIO_FORMATS = {
+    "wav": {"extension": "wav", "mime_type": "audio/wav"},
+    "flac": {"extension": "flac", "mime_type": "audio/flac"},
+    "opus": {
+        "extension": "opus",
+        "mime_type": "audio/ogg",
+        "ffmpeg_format": "opus",
+        "codec": "libopus",
+        "bitrate": "32k",
+    },
+    "mp3": {
+        "extension": "mp3",
+        "mime_type": "audio/mpeg",
+        "ffmpeg_format": "mp3",
+        "codec": "libmp3lame",
+        "bitrate": "64k",
+    },
+}
+
+
+def encode_audio(wav, output_file, audio_format="wav", sample_rate=GENERATED_SAMPLE_RATE):
+    """
+    Writes a generated waveform to output_file in the given format and sample rate.
+    Returns the duration of the clip in seconds, computed from the samples in memory.
+    """
+    wav = wav.detach().reshape(1, -1).cpu().float()
+    if sample_rate != GENERATED_SAMPLE_RATE:
+        wav = torchaudio.functional.resample(wav, GENERATED_SAMPLE_RATE, sample_rate)
+
+    spec = AUDIO_FORMATS[audio_format]
+    if audio_format == "wav":
+        torchaudio.save(output_file, wav, sample_rate)
+    elif audio_format == "flac":
+        torchaudio.save(
+            output_file, wav, sample_rate, format="flac", bits_per_sample=16
+        )
+    else:
+        AudioSegment(
+            pcm16_bytes(wav), sample_width=2, frame_rate=sample_rate, channels=1
+        ).export(
+            output_file,
+            format=spec["ffmpeg_format"],
+            codec=spec["codec"],
+            bitrate=spec["bitrate"],
+        )
+
+    return wav.shape[-1] / sample_rate
@@ -0,0 +1,38 @@
+# ./tts_api/services/audio_stream.py
+
+import struct
+
+import torch
+
+# Placeholder for RIFF/data sizes that are unknown while streaming. Most players read until the connection closes.
+STREAMING_SIZE = 0xFFFFFFFF
+
+
+def wav_stream_header(sample_rate, channels=1, bits_per_sample=16):
+    """WAV header for PCM audio of unknown length."""
+    byte_rate = sample_rate * channels * bits_per_sample // 8
+    block_align = channels * bits_per_sample // 8
+    return (
+        b"RIFF"
+        + struct.pack("<I", STREAMING_SIZE)
+        + b"WAVE"
+        + b"fmt "
+        + struct.pack(
+            "<IHHIIHH",
+            16,
+            1,  # PCM
+            channels,
+            sample_rate,
+            byte_rate,
+            block_align,
+            bits_per_sample,
+        )
+        + b"data"
+        + struct.pack("<I", STREAMING_SIZE)
+    )
+
+
+def pcm16_bytes(wav):
+    """Converts a float waveform tensor in [-1, 1] to little-endian 16-bit PCM bytes."""
+    samples = wav.detach().reshape(-1).cpu().clamp(-1, 1)
+    return (samples * 32767).to(torch.int16).numpy().tobytes()
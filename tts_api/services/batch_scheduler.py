@@ -0,0 +1,70 @@
+# ./tts_api/services/batch_scheduler.py
+
+import threading
+import time
+from queue import Empty
+
+
+class BatchScheduler:
+    """
+    Groups pending requests from a FairQueue into micro-batches. A batch starts
+    with the request the queue hands out next and collects further requests
+    with the same key, still in the queue's fair order, until `window` seconds
+    have passed or `max_batch` requests are gathered. Requests with a different
+    key stay queued for later batches.
+    Several consumer threads may call next_batch(); they are served one at a time.
+    """
+
+    def __init__(self, request_queue, key, window=0.05, max_batch=4):
+        self.request_queue = request_queue
+        self.key = key
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+
+    def pending(self):
+        """Number of requests waiting to be batched."""
+        return self.request_queue.qsize()
+
+    def next_batch(self, timeout=None, key=None, max_batch=None):
+        """
+        Blocks until at least one request is available and returns a list of
+        compatible requests, or None if nothing arrives within timeout seconds.
+        Given key, only requests with that key are taken, so that they can join
+        a batch that is already running; given max_batch, at most that many.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._lock.acquire(timeout=-1 if timeout is None else timeout):
+            return None
+        try:
+            remaining = (
+                None if deadline is None else max(0, deadline - time.monotonic())
+            )
+            try:
+                first = self.request_queue.get(
+                    timeout=remaining,
+                    match=None if key is None else lambda item: self.key(item) == key,
+                )
+            except Empty:
+                return None
+            return self._next_batch(first, max_batch or self.max_batch)
+        finally:
+            self._lock.release()
+
+    def _next_batch(self, first, max_batch):
+        batch = [first]
+        batch_key = self.key(first)
+
+        deadline = time.monotonic() + self.window
+        while len(batch) < max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.request_queue.get(
+                    timeout=remaining, match=lambda item: self.key(item) == batch_key
+                )
+            except Empty:
+                break
+            batch.append(item)
+        return batch
@@ -0,0 +1,187 @@
+# ./tts_api/services/fair_queue.py
+
+import threading
+import time
+from collections import Counter, OrderedDict, deque
+from queue import Empty
+
+
+class QueueLimitExceeded(Exception):
+    """Raised by FairQueue.check() when a user already has as many queued requests as allowed."""
+
+
+class FairQueue:
+    """
+    Request queue that is fair between users instead of first-in first-out.
+    Requests belong to a priority class (e.g. "user" or "guest") and a user.
+    Classes are served in proportion to their weights (smooth weighted
+    round-robin), and within a class users take turns, so a user with many
+    queued requests cannot hold up everybody else. Users can be capped in how
+    many requests they may have queued and how many may run at once; a user at
+    the running cap is skipped until one of their requests is marked done.
+    Users are any hashable identity, so callers decide who shares a cap.
+
+    Supports the parts of queue.Queue the service uses, with task_done() taking
+    the finished item.
+    """
+
+    def __init__(
+        self,
+        class_weights,
+        default_class,
+        max_queued_per_user=None,
+        max_running_per_user=None,
+    ):
+        self.default_class = default_class
+        self.max_queued_per_user = max_queued_per_user
+        self.max_running_per_user = max_running_per_user
+        self._classes = {
+            name: {"weight": weight, "current": 0, "users": OrderedDict()}
+            for name, weight in class_weights.items()
+        }
+        self._queued = Counter()
+        self._running = Counter()
+        self._owners = {}
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def check(self, user):
+        """
+        Raises QueueLimitExceeded if user is at their queued cap. put() does not
+        check, so that callers can admit a request once and queue its follow-up
+        work (e.g. the next segment of a stream) without it being refused.
+        """
+        with self._cond:
+            if (
+                self.max_queued_per_user is not None
+                and self._queued[user] >= self.max_queued_per_user
+            ):
+                raise QueueLimitExceeded(
+                    f"Too many queued requests ({self._queued[user]}) for this user"
+                )
+
+    def put(self, item, priority_class, user):
+        """Queues item for user in priority_class. Unknown classes fall back to the default class."""
+        with self._cond:
+            cls = self._classes.get(priority_class, self._classes[self.default_class])
+            cls["users"].setdefault(user, deque()).append(item)
+            self._queued[user] += 1
+            self._size += 1
+            self._cond.notify_all()
+
+    def _can_run(self, user):
+        return (
+            self.max_running_per_user is None
+            or self._running[user] < self.max_running_per_user
+        )
+
+    def _candidate(self, cls, match):
+        """First user in turn order with a runnable request, and the index of that request."""
+        for user, items in cls["users"].items():
+            if not self._can_run(user):
+                continue
+            for index, item in enumerate(items):
+                if match is None or match(item):
+                    return user, index
+        return None
+
+    def _pop(self, match):
+        candidates = {}
+        for name, cls in self._classes.items():
+            candidate = self._candidate(cls, match)
+            if candidate is not None:
+                candidates[name] = candidate
+        if not candidates:
+            return None
+
+        total = sum(self._classes[name]["weight"] for name in candidates)
+        for name in candidates:
+            self._classes[name]["current"] += self._classes[name]["weight"]
+        chosen = max(candidates, key=lambda name: self._classes[name]["current"])
+        self._classes[chosen]["current"] -= total
+
+        users = self._classes[chosen]["users"]
+        user, index = candidates[chosen]
+        items = users[user]
+        item = items[index]
+        del items[index]
+        # The user goes to the back of the line within the class.
+        del users[user]
+        if items:
+            users[user] = items
+
+        self._queued[user] -= 1
+        if not self._queued[user]:
+            del self._queued[user]
+        self._running[user] += 1
+        self._owners[id(item)] = user
+        self._size -= 1
+        return item
+
+    def get(self, block=True, timeout=None, match=None):
+        """
+        Removes and returns the next request in fair order, optionally only
+        considering requests for which match(item) is true. Raises queue.Empty
+        if none is available in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                item = self._pop(match)
+                if item is not None:
+                    return item
+                if not block:
+                    raise Empty
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise Empty
+                    self._cond.wait(remaining)
+
+    def task_done(self, item):
+        """Marks a request returned by get() as finished, freeing a running slot of its user."""
+        with self._cond:
+            user = self._owners.pop(id(item), None)
+            if user is not None:
+                self._running[user] -= 1
+                if not self._running[user]:
+                    del self._running[user]
+            self._cond.notify_all()
+
+    def remove(self, predicate):
+        """Removes the queued requests for which predicate(item) is true and returns them."""
+        removed = []
+        with self._cond:
+            for cls in self._classes.values():
+                users = cls["users"]
+                for user in list(users):
+                    kept = deque()
+                    for item in users[user]:
+                        (removed if predicate(item) else kept).append(item)
+                    dropped = len(users[user]) - len(kept)
+                    if not dropped:
+                        continue
+                    self._queued[user] -= dropped
+                    if not self._queued[user]:
+                        del self._queued[user]
+                    self._size -= dropped
+                    if kept:
+                        users[user] = kept
+                    else:
+                        del users[user]
+        return removed
+
+    def qsize(self):
+        return self._size
+
+    def snapshot(self):
+        """List of the queued requests, in no particular order."""
+        with self._cond:
+            return [
+                item
+                for cls in self._classes.values()
+                for items in cls["users"].values()
+                for item in items
+            ]
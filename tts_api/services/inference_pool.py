@@ -0,0 +1,617 @@
+# ./tts_api/services/inference_pool.py
+
+import itertools
+import multiprocessing
+import os
+import resource
+import threading
+import time
+import traceback
+from collections import deque
+from contextlib import ExitStack
+from multiprocessing import shared_memory
+from queue import Empty, Queue
+
+import numpy as np
+import torch
+
+# CUDA cannot be re-initialized in a forked child, so workers are always spawned.
+_context = multiprocessing.get_context("spawn")
+
+STARTING = "starting"
+IDLE = "idle"
+BUSY = "busy"
+DEAD = "dead"
+
+
+class TaskCancelled(Exception):
+    """A batch was abandoned because nobody wants its results any more."""
+
+
+def share_waveform(wav):
+    """Copies a waveform into a new shared memory block and returns (name, shape) for the receiving process."""
+    array = wav.detach().cpu().float().numpy()
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=np.float32, buffer=shm.buf)[...] = array
+    shm.close()
+    return shm.name, array.shape
+
+
+def collect_waveform(name, shape):
+    """Reads a waveform published by share_waveform() and releases its shared memory block."""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        array = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        return torch.from_numpy(array.copy())
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def run_worker(conn, cancelled_task, threads, config):
+    """
+    Entry point of an inference worker process. Loads its own models, then
+    answers generation and voice ingestion requests from the pipe until the
+    parent goes away. Replies carry the id of the task they answer.
+
+    Unseeded generations go through a ContinuousTTS, which keeps sampling while
+    the worker reads the pipe between decode steps: generations for the same
+    language and preset that arrive meanwhile join it, and ("cancel", task_id)
+    drops one of its tasks. Anything else waits until it is done. Seeded
+    generations (and all of them where the autoregressive model cannot sample
+    that way) run alone, and stop early once the parent writes their id to
+    cancelled_task.
+    """
+    torch.set_num_threads(threads)
+
+    from tortoise.api import GenerationCancelled, ModelRegistry
+    from tortoise.utils.audio import VoiceRegistry
+
+    from services.latent_cache import LatentCache
+
+    try:
+        voice_registry = VoiceRegistry(config["voices_dir"])
+        latent_cache = LatentCache(
+            voice_registry, config["latent_cache_dir"], config["latent_cache_size"]
+        )
+        models = ModelRegistry(
+            memory_budget=config["model_memory_budget"],
+            use_deepspeed=config["use_deepspeed"],
+        )
+        for lang in config["preload_langs"]:
+            models.get(lang)
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}", traceback.format_exc()))
+        return
+    conn.send(("ready", os.getpid()))
+
+    def load_voices(tts_model, voice_names, preset):
+        with tts_model.timed_stage("voice_loading"):
+            conditioning_latents = [
+                latent_cache.load_voice(tts_model, voice_name)[1]
+                for voice_name in voice_names
+            ]
+            conditioning_mels = [None for _ in voice_names]
+            if tts_model.preset_settings(preset).get("cvvp_amount", 0) > 0:
+                conditioning_mels = [
+                    latent_cache.conditioning_mels(tts_model, voice_name)
+                    for voice_name in voice_names
+                ]
+        return conditioning_latents, conditioning_mels
+
+    def send_result(task_id, payload, timings):
+        conn.send(
+            (
+                "ok",
+                task_id,
+                payload,
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                models.loaded_languages(),
+                timings,
+            )
+        )
+
+    def send_error(task_id, e):
+        conn.send(
+            ("error", task_id, f"{type(e).__name__}: {e}", traceback.format_exc())
+        )
+
+    # Messages not acted upon yet, in arrival order.
+    waiting = deque()
+    # The ContinuousTTS in use, with its TextToSpeech, (lang, preset) and task ids.
+    session = None
+
+    def join(message):
+        """Adds a generation to the session, replying if it fails. Returns whether it was taken."""
+        _, task_id, lang, texts, voice_names, preset, seed = message
+        if (
+            session is None
+            or seed is not None
+            or session["settings"] != (lang, preset)
+        ):
+            return False
+        tts_model = session["tts_model"]
+        try:
+            conditioning_latents, conditioning_mels = load_voices(
+                tts_model, voice_names, preset
+            )
+            session["engine"].add(
+                task_id, texts, conditioning_latents, conditioning_mels
+            )
+        except Exception as e:
+            send_error(task_id, e)
+        else:
+            session["tasks"].add(task_id)
+        return True
+
+    while True:
+        try:
+            if session is None and not waiting:
+                waiting.append(conn.recv())
+            while conn.poll():
+                waiting.append(conn.recv())
+        except EOFError:
+            return
+
+        for message in list(waiting):
+            if message not in waiting:
+                continue
+            if message[0] == "cancel":
+                waiting.remove(message)
+                task_id = message[1]
+                queued = [m for m in waiting if m[:2] == ("generate", task_id)]
+                if session is not None and task_id in session["tasks"]:
+                    session["engine"].drop(task_id)
+                    session["tasks"].discard(task_id)
+                elif queued:
+                    waiting.remove(queued[0])
+                else:
+                    # Done already, or running alone and stopped through cancelled_task.
+                    continue
+                conn.send(("cancelled", task_id, "Generation was cancelled"))
+            elif message[0] == "generate" and join(message):
+                waiting.remove(message)
+
+        if session is not None:
+            if session["engine"].busy():
+                tts_model = session["tts_model"]
+                try:
+                    completed = session["engine"].step()
+                except Exception as e:
+                    for task_id in session["tasks"]:
+                        send_error(task_id, e)
+                    session["stack"].close()
+                    session = None
+                    continue
+                for task_id, gens in completed:
+                    session["tasks"].discard(task_id)
+                    # The stages of requests generated together overlap, so each reports what ran since the last.
+                    send_result(
+                        task_id,
+                        [share_waveform(gen) for gen in gens],
+                        tts_model.stage_timings,
+                    )
+                    tts_model.stage_timings = {}
+                continue
+            session["stack"].close()
+            session = None
+            continue
+
+        kind, task_id, *args = waiting.popleft()
+        try:
+            if kind == "ingest":
+                voice_name, langs = args
+                digest = None
+                for lang in langs:
+                    digest = latent_cache.ingest(models.get(lang), voice_name)
+                send_result(task_id, digest, {})
+                continue
+
+            lang, texts, voice_names, preset, seed = args
+            tts_model = models.get(lang)
+            tts_model.stage_timings = {}
+            if seed is None:
+                engine = tts_model.continuous_tts_with_preset(
+                    preset, max_batches=config["max_batch"]
+                )
+                if engine is not None:
+                    tts_model.cancel_check = None
+                    with ExitStack() as stack:
+                        stack.enter_context(torch.no_grad())
+                        stack.enter_context(engine)
+                        # Kept open until the session is done.
+                        stack = stack.pop_all()
+                    session = {
+                        "engine": engine,
+                        "stack": stack,
+                        "tts_model": tts_model,
+                        "settings": (lang, preset),
+                        "tasks": set(),
+                    }
+                    join(("generate", task_id, *args))
+                    continue
+            tts_model.cancel_check = lambda: cancelled_task.value == task_id
+            conditioning_latents, conditioning_mels = load_voices(
+                tts_model, voice_names, preset
+            )
+            if len(texts) == 1:
+                # Long texts are split into segments and pipelined; short ones take the plain tts() path.
+                gens = [
+                    tts_model.tts_long_with_preset(
+                        texts[0],
+                        conditioning_latents=conditioning_latents[0],
+                        conditioning_mels=conditioning_mels[0],
+                        preset=preset,
+                        use_deterministic_seed=seed,
+                    )
+                ]
+            else:
+                gens = tts_model.tts_batch_with_preset(
+                    texts,
+                    conditioning_latents=conditioning_latents,
+                    conditioning_mels=conditioning_mels,
+                    preset=preset,
+                    use_deterministic_seed=seed,
+                )
+            send_result(
+                task_id, [share_waveform(gen) for gen in gens], tts_model.stage_timings
+            )
+        except GenerationCancelled as e:
+            conn.send(("cancelled", task_id, str(e)))
+        except Exception as e:
+            send_error(task_id, e)
+
+
+class InferenceWorker:
+    """Handle on one worker process: starts it, sends it batches and keeps its health figures."""
+
+    def __init__(self, worker_id, threads, config):
+        self.worker_id = worker_id
+        self.threads = threads
+        self.config = config
+        self.process = None
+        self.conn = None
+        self.state = DEAD
+        self.pid = None
+        self.started_at = None
+        self.busy_since = None
+        self.tasks_completed = 0
+        self.tasks_failed = 0
+        self.tasks_cancelled = 0
+        self.restarts = 0
+        self.last_task_seconds = None
+        self.max_rss_kb = None
+        self.loaded_languages = config["preload_langs"]
+        self.last_error = None
+        # task id -> (batch, start time) of the generations sent to the worker, maintained by the pool's dispatcher.
+        self.tasks = {}
+        self._cancelled_task = _context.Value("q", -1, lock=False)
+        # When each task without a reply yet was sent.
+        self._sent = {}
+        self._send_lock = threading.Lock()
+
+    def _receive(self):
+        """Waits for the worker's next message, failing if the process dies meanwhile."""
+        while not self.conn.poll(1.0):
+            self._check_alive()
+        return self.conn.recv()
+
+    def _check_alive(self):
+        if not self.process.is_alive():
+            self.state = DEAD
+            raise RuntimeError(
+                f"Inference worker {self.worker_id} exited with code {self.process.exitcode}"
+            )
+
+    def _send(self, message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def start(self):
+        """Starts the worker process and blocks until its models are loaded."""
+        if self.process is not None:
+            self.restarts += 1
+            if self.process.is_alive():
+                self.process.kill()
+            self.process.join()
+            self.conn.close()
+        self._sent = {}
+        self.busy_since = None
+        self.conn, child_conn = _context.Pipe()
+        self.process = _context.Process(
+            target=run_worker,
+            args=(child_conn, self._cancelled_task, self.threads, self.config),
+            name=f"inference-worker-{self.worker_id}",
+            daemon=True,
+        )
+        self.state = STARTING
+        self.started_at = time.time()
+        self.process.start()
+        child_conn.close()
+
+        message = self._receive()
+        if message[0] != "ready":
+            self.state = DEAD
+            self.last_error = message[1]
+            raise RuntimeError(
+                f"Inference worker {self.worker_id} failed to start: {message[1]}"
+            )
+        self.pid = message[1]
+        self.state = IDLE
+
+    def cancel(self, task_id):
+        """
+        Asks the worker process to abandon task_id: at its next cancellation
+        check if it runs alone, otherwise before its next decode step.
+        """
+        self._cancelled_task.value = task_id
+        try:
+            self._send(("cancel", task_id))
+        except (OSError, ValueError):
+            # The process is gone, and its dispatcher fails the task.
+            pass
+
+    def ensure_running(self):
+        if self.state == DEAD or not self.process.is_alive():
+            self.start()
+
+    def submit(self, task_id, lang, texts, voice_names, preset, seed):
+        """Sends a batch to the worker. Its waveforms come back through next_result()."""
+        self._started(task_id)
+        self._send(("generate", task_id, lang, texts, voice_names, preset, seed))
+
+    def next_result(self, timeout):
+        """
+        Waits up to timeout seconds for the worker to finish one of the batches
+        sent with submit() and returns (task id, waveforms, timings), the timings
+        being the worker's per-stage timings as {stage: (seconds, peak_bytes)}, or
+        None if no batch finished. A batch that failed has the exception in place
+        of its waveforms: TaskCancelled if cancel() stopped it. Raises
+        RuntimeError if the worker process dies.
+        """
+        try:
+            if not self.conn.poll(timeout):
+                self._check_alive()
+                return None
+            message = self.conn.recv()
+        except EOFError:
+            self._check_alive()
+            self.state = DEAD
+            raise RuntimeError(f"Inference worker {self.worker_id} closed its pipe")
+        task_id, payload, timings = self._finished(message)
+        if isinstance(payload, Exception):
+            return task_id, payload, timings
+        return (
+            task_id,
+            [collect_waveform(name, shape) for name, shape in payload],
+            timings,
+        )
+
+    def ingest(self, task_id, voice_name, langs):
+        """
+        Computes and stores the conditioning latents of a voice for langs. Returns
+        the voice digest. Only called while no batch is running.
+        """
+        self._started(task_id)
+        self._send(("ingest", task_id, voice_name, langs))
+        _, digest, _ = self._finished(self._receive())
+        if isinstance(digest, Exception):
+            raise digest
+        return digest
+
+    def _started(self, task_id):
+        now = time.time()
+        if not self._sent:
+            self.busy_since = now
+        self._sent[task_id] = now
+        self.state = BUSY
+
+    def _finished(self, message):
+        """Accounts for the worker's reply to a task and returns (task id, payload or exception, timings)."""
+        kind, task_id = message[:2]
+        sent = self._sent.pop(task_id, None)
+        if sent is not None:
+            self.last_task_seconds = time.time() - sent
+        if not self._sent:
+            self.busy_since = None
+            if self.state == BUSY:
+                self.state = IDLE
+        if kind == "cancelled":
+            self.tasks_cancelled += 1
+            return task_id, TaskCancelled(message[2]), {}
+        if kind != "ok":
+            self.tasks_failed += 1
+            self.last_error = message[2]
+            return task_id, RuntimeError(message[2]), {}
+        self.max_rss_kb = message[3]
+        self.loaded_languages = message[4]
+        self.tasks_completed += 1
+        return task_id, message[2], message[5]
+
+    def health(self):
+        return {
+            "worker_id": self.worker_id,
+            "pid": self.pid,
+            "state": self.state,
+            "alive": self.process is not None and self.process.is_alive(),
+            "threads": self.threads,
+            "started_at": self.started_at,
+            "busy_since": self.busy_since,
+            "tasks_completed": self.tasks_completed,
+            "tasks_failed": self.tasks_failed,
+            "tasks_cancelled": self.tasks_cancelled,
+            "restarts": self.restarts,
+            "last_task_seconds": self.last_task_seconds,
+            "max_rss_kb": self.max_rss_kb,
+            "loaded_languages": self.loaded_languages,
+            "last_error": self.last_error,
+        }
+
+
+class InferencePool:
+    """
+    Fixed set of inference worker processes, each with its own models and torch
+    thread budget. Every worker is driven by a dispatcher thread in this process
+    that takes the next batch from `next_batch` and hands the result to `on_result`:
+    the list of waveforms (or the exception that made the batch fail), the time the
+    batch took, and the worker's per-stage timings. While a worker generates, its
+    dispatcher keeps taking requests that can join the running batches, up to
+    `max_batch` requests at once, and the worker adds them to its sampling between
+    decode steps. Voice ingestions submitted with submit_ingestion() are run by the
+    first dispatcher that is free, ahead of batches.
+    """
+
+    RESTART_DELAY = 5
+    # How long a dispatcher waits for a batch before looking for ingestions again.
+    POLL_INTERVAL = 1.0
+    # How long a dispatcher with batches running waits for a result before looking for requests to join them.
+    JOIN_INTERVAL = 0.05
+
+    def __init__(self, num_workers, threads_per_worker, config, logger):
+        self.logger = logger
+        self.max_batch = config["max_batch"]
+        self.workers = [
+            InferenceWorker(worker_id, threads_per_worker, config)
+            for worker_id in range(num_workers)
+        ]
+        self._task_ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ingestions = Queue()
+
+    def start(self, next_batch, on_result):
+        """
+        Starts the dispatchers. next_batch(timeout) returns the next batch, or None
+        if none is ready within timeout seconds. next_batch(timeout, join=batch,
+        max_batch=n) returns at most n requests that can be generated along with
+        a running batch, or None.
+        """
+        for worker in self.workers:
+            threading.Thread(
+                target=self._dispatch,
+                args=(worker, next_batch, on_result),
+                name=f"inference-dispatch-{worker.worker_id}",
+                daemon=True,
+            ).start()
+
+    def _dispatch(self, worker, next_batch, on_result):
+        while True:
+            try:
+                worker.ensure_running()
+            except Exception as e:
+                self.logger.error("%s", str(e))
+                time.sleep(self.RESTART_DELAY)
+                continue
+
+            if not worker.tasks:
+                try:
+                    ingestion = self._ingestions.get_nowait()
+                except Empty:
+                    ingestion = None
+                if ingestion is not None:
+                    self._ingest(worker, *ingestion)
+                    continue
+
+                batch = next_batch(self.POLL_INTERVAL)
+                if batch is not None:
+                    self._submit(worker, batch, on_result)
+                continue
+
+            running = sum(len(batch) for batch, _ in worker.tasks.values())
+            if running < self.max_batch:
+                batch = next_batch(
+                    0,
+                    join=next(iter(worker.tasks.values()))[0],
+                    max_batch=self.max_batch - running,
+                )
+                if batch is not None:
+                    self._submit(worker, batch, on_result)
+
+            try:
+                result = worker.next_result(self.JOIN_INTERVAL)
+            except Exception as e:
+                self.logger.error(
+                    "Speech generation failed on worker %s: %s",
+                    worker.worker_id,
+                    str(e),
+                )
+                with self._lock:
+                    tasks, worker.tasks = worker.tasks, {}
+                for batch, start_time in tasks.values():
+                    on_result(batch, e, time.time() - start_time, {})
+                continue
+            if result is None:
+                continue
+            task_id, gens, timings = result
+            with self._lock:
+                batch, start_time = worker.tasks.pop(task_id)
+            if isinstance(gens, TaskCancelled):
+                self.logger.info("Generation cancelled on worker %s", worker.worker_id)
+            elif isinstance(gens, Exception):
+                self.logger.error(
+                    "Speech generation failed on worker %s: %s",
+                    worker.worker_id,
+                    str(gens),
+                )
+            on_result(batch, gens, time.time() - start_time, timings)
+
+    def _submit(self, worker, batch, on_result):
+        first = batch[0]
+        with self._lock:
+            task_id = next(self._task_ids)
+            worker.tasks[task_id] = (batch, time.time())
+        try:
+            worker.submit(
+                task_id,
+                first[0],
+                [item[1] for item in batch],
+                [item[2] for item in batch],
+                first[3],
+                first[4],
+            )
+        except Exception as e:
+            self.logger.error(
+                "Speech generation failed on worker %s: %s",
+                worker.worker_id,
+                str(e),
+            )
+            with self._lock:
+                del worker.tasks[task_id]
+            on_result(batch, e, 0.0, {})
+
+    def _ingest(self, worker, voice_name, langs, on_done):
+        with self._lock:
+            task_id = next(self._task_ids)
+        try:
+            worker.ingest(task_id, voice_name, langs)
+        except Exception as e:
+            self.logger.error(
+                "Voice ingestion of %s failed on worker %s: %s",
+                voice_name,
+                worker.worker_id,
+                str(e),
+            )
+            on_done(e)
+        else:
+            on_done(None)
+
+    def submit_ingestion(self, voice_name, langs, on_done):
+        """
+        Queues the computation of a voice's conditioning latents for langs.
+        on_done is called with None once they are stored, or with the exception
+        that made the ingestion fail.
+        """
+        self._ingestions.put((voice_name, langs, on_done))
+
+    def cancel(self, predicate):
+        """
+        Cancels running batches whose requests all satisfy predicate(item). Their
+        results arrive at on_result as TaskCancelled once the worker stops.
+        """
+        with self._lock:
+            for worker in self.workers:
+                for task_id, (batch, _) in list(worker.tasks.items()):
+                    if all(predicate(item) for item in batch):
+                        worker.cancel(task_id)
+
+    def health(self):
+        return [worker.health() for worker in self.workers]
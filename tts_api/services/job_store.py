@@ -0,0 +1,164 @@
+# ./tts_api/services/job_store.py
+
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+class JobStore:
+    """
+    Small SQLite-backed store for asynchronous generation jobs. Jobs keep their
+    request parameters so that unfinished ones can be re-queued after a restart.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        db_dir = os.path.dirname(db_path)
+        if db_dir:
+            os.makedirs(db_dir, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    request_key TEXT UNIQUE,
+                    status TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    result TEXT,
+                    error TEXT,
+                    callback_url TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _to_dict(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def create(self, params, callback_url=None, request_key=None):
+        """
+        Creates a queued job and returns (job, created). If a job with the same
+        request_key already exists, that job is returned instead with created=False.
+        """
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        with self._lock, self._connect() as conn:
+            if request_key is not None:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE request_key = ?", (request_key,)
+                ).fetchone()
+                if row is not None:
+                    return self._to_dict(row), False
+            conn.execute(
+                "INSERT INTO jobs (id, request_key, status, params, callback_url, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job_id,
+                    request_key,
+                    self.QUEUED,
+                    json.dumps(params),
+                    callback_url,
+                    now,
+                    now,
+                ),
+            )
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row), True
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._to_dict(row)
+
+    def find(self, request_key):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE request_key = ?", (request_key,)
+            ).fetchone()
+        return self._to_dict(row)
+
+    def start(self, job_id):
+        """Marks a queued job as running, once its generation has been handed to a worker."""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (self.RUNNING, time.time(), job_id, self.QUEUED),
+            )
+
+    def complete(self, job_id, result):
+        self._finish(job_id, self.COMPLETED, result=json.dumps(result))
+
+    def fail(self, job_id, error):
+        self._finish(job_id, self.FAILED, error=error)
+
+    def cancel(self, job_id):
+        """Cancels a queued or running job. Returns False if the job does not exist or has already finished."""
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? "
+                "WHERE id = ? AND status IN (?, ?)",
+                (self.CANCELLED, time.time(), job_id, self.QUEUED, self.RUNNING),
+            )
+        return cursor.rowcount > 0
+
+    def _finish(self, job_id, status, result=None, error=None):
+        """Records the outcome of a queued or running job. Cancelled jobs keep their status."""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? "
+                "WHERE id = ? AND status IN (?, ?)",
+                (
+                    status,
+                    result,
+                    error,
+                    time.time(),
+                    job_id,
+                    self.QUEUED,
+                    self.RUNNING,
+                ),
+            )
+
+    def pending(self):
+        """
+        Jobs that were queued or running but never finished, oldest first. Meant
+        for start-up: running jobs lost their generation with the previous
+        process, so they are marked queued again.
+        """
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE status = ?",
+                (self.QUEUED, time.time(), self.RUNNING),
+            )
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? ORDER BY created_at",
+                (self.QUEUED,),
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
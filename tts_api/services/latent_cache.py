@@ -0,0 +1,172 @@
+# ./tts_api/services/latent_cache.py
+
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+
+import torch
+from tortoise.utils.audio import load_voice
+
+
+def file_digest(paths):
+    """SHA-256 over the names and contents of files, identifying a set of voice clips."""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class LatentCache:
+    """
+    Two-tier cache of voice conditioning latents: an in-memory LRU in front of
+    .pth files on disk. Entries are keyed by a hash of the voice directory
+    contents, so a voice whose clips change simply misses the cache.
+    """
+
+    def __init__(self, voice_registry, cache_dir, max_entries=32):
+        self.voice_registry = voice_registry
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._memory = OrderedDict()
+        self._digests = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def voice_digest(self, voice_name):
+        """Hash of the voice's clip files, re-read only when their size or mtime changes."""
+        files = sorted(self.voice_registry.get(voice_name))
+        signature = []
+        for path in files:
+            stat = os.stat(path)
+            signature.append((path, stat.st_size, stat.st_mtime_ns))
+        signature = tuple(signature)
+
+        with self._lock:
+            known = self._digests.get(voice_name)
+        if known is not None and known[0] == signature:
+            return known[1]
+
+        digest = file_digest(files)
+
+        with self._lock:
+            self._digests[voice_name] = (signature, digest)
+        return digest
+
+    def _disk_path(self, voice_name, lang, digest):
+        return os.path.join(self.cache_dir, voice_name, f"{lang}_{digest}.pth")
+
+    def _store(self, disk_path, prefix, tensors):
+        """Writes tensors to disk_path, replacing files of older versions of the voice's clips with the same prefix."""
+        voice_cache_dir = os.path.dirname(disk_path)
+        os.makedirs(voice_cache_dir, exist_ok=True)
+        for name in os.listdir(voice_cache_dir):
+            if name.startswith(prefix) and name.endswith(".pth"):
+                os.remove(os.path.join(voice_cache_dir, name))
+        tmp_path = f"{disk_path}.tmp"
+        torch.save(tensors, tmp_path)
+        os.replace(tmp_path, disk_path)
+
+    def _remember(self, key, latents):
+        with self._lock:
+            self._memory[key] = latents
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def load_voice(self, tts_model, voice_name):
+        """
+        Drop-in replacement for tortoise.utils.audio.load_voice that always returns
+        (None, conditioning_latents), computing the latents with tts_model on a miss.
+        """
+        if voice_name == "random":
+            return load_voice(voice_name)
+
+        lang = tts_model.lang
+        digest = self.voice_digest(voice_name)
+        key = (voice_name, lang, digest)
+
+        with self._lock:
+            latents = self._memory.get(key)
+            if latents is not None:
+                self._memory.move_to_end(key)
+                return None, latents
+
+        disk_path = self._disk_path(voice_name, lang, digest)
+        if os.path.exists(disk_path):
+            latents = torch.load(disk_path, map_location="cpu")
+            self._remember(key, latents)
+            return None, latents
+
+        voice_samples, latents = load_voice(voice_name, registry=self.voice_registry)
+        if latents is None:
+            latents = tts_model.get_conditioning_latents(voice_samples)
+        latents = tuple(latent.cpu() for latent in latents)
+        self._store(disk_path, f"{lang}_", latents)
+        self._remember(key, latents)
+        return None, latents
+
+    def ingest(self, tts_model, voice_name):
+        """
+        Computes and stores the conditioning latents of a voice for tts_model's language, along with the
+        voice's conditioning mels used by CVVP, which do not depend on the language. Returns the voice digest.
+        """
+        digest = self.voice_digest(voice_name)
+        voice_samples, _ = load_voice(voice_name, registry=self.voice_registry)
+        if voice_samples is None:
+            # The voice is stored as latents already.
+            return digest
+
+        (
+            auto_latent,
+            diffusion_latent,
+            auto_conds,
+            _,
+        ) = tts_model.get_conditioning_latents(voice_samples, return_mels=True)
+        latents = (auto_latent.cpu(), diffusion_latent.cpu())
+        lang = tts_model.lang
+        self._store(self._disk_path(voice_name, lang, digest), f"{lang}_", latents)
+        self._remember((voice_name, lang, digest), latents)
+
+        mels_path = self._mels_path(voice_name, digest)
+        if not os.path.exists(mels_path):
+            self._store(mels_path, "mels_", auto_conds.cpu())
+        return digest
+
+    def _mels_path(self, voice_name, digest):
+        return os.path.join(self.cache_dir, voice_name, f"mels_{digest}.pth")
+
+    def conditioning_mels(self, tts_model, voice_name):
+        """
+        The CVVP conditioning mels of a voice, ingesting it with tts_model if they are not stored yet.
+        None for voices stored as latents, which have no clips to compute them from.
+        """
+        if voice_name == "random":
+            return None
+        mels_path = self._mels_path(voice_name, self.voice_digest(voice_name))
+        if not os.path.exists(mels_path):
+            self.ingest(tts_model, voice_name)
+            if not os.path.exists(mels_path):
+                return None
+        return torch.load(mels_path, map_location="cpu")
+
+    def invalidate(self, voice_name):
+        """Forget every cached latent of a voice, or of every voice under a prefix such as a user id."""
+        with self._lock:
+            for key in [
+                k
+                for k in self._memory
+                if k[0] == voice_name or k[0].startswith(f"{voice_name}/")
+            ]:
+                del self._memory[key]
+            for name in [
+                n
+                for n in self._digests
+                if n == voice_name or n.startswith(f"{voice_name}/")
+            ]:
+                del self._digests[name]
+        shutil.rmtree(os.path.join(self.cache_dir, voice_name), ignore_errors=True)
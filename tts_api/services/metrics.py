@@ -0,0 +1,107 @@
+# ./tts_api/services/metrics.py
+
+import threading
+
+# Upper bounds, in seconds, of the stage duration histogram buckets.
+STAGE_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    body = ",".join(
+        '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for k, v in labels
+    )
+    return "{" + body + "}"
+
+
+class Metrics:
+    """
+    Minimal in-process metrics registry rendered in the Prometheus text format:
+    labelled histograms, labelled max-gauges, and plain gauges that are either adjusted
+    with add() or read from a callback at scrape time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._max_gauges = {}
+        self._gauges = {}
+        self._callbacks = {}
+        self._help = {}
+
+    def histogram(self, name, help_text, buckets=STAGE_BUCKETS):
+        self._help[name] = help_text
+        self._histograms[name] = {"buckets": buckets, "series": {}}
+
+    def max_gauge(self, name, help_text):
+        """A gauge that keeps the largest value observed for each label set."""
+        self._help[name] = help_text
+        self._max_gauges[name] = {}
+
+    def gauge(self, name, help_text, callback=None):
+        """A gauge changed with add(), or computed by callback() when metrics are rendered."""
+        self._help[name] = help_text
+        if callback is not None:
+            self._callbacks[name] = callback
+        else:
+            self._gauges[name] = 0
+
+    def add(self, name, delta):
+        with self._lock:
+            self._gauges[name] += delta
+
+    def observe(self, name, value, **labels):
+        histogram = self._histograms[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = histogram["series"].get(key)
+            if series is None:
+                series = histogram["series"][key] = {
+                    "counts": [0] * len(histogram["buckets"]),
+                    "sum": 0.0,
+                    "count": 0,
+                }
+            for i, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def record_max(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._max_gauges[name]
+            series[key] = max(series.get(key, value), value)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, histogram in self._histograms.items():
+                lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, series in histogram["series"].items():
+                    for bound, count in zip(histogram["buckets"], series["counts"]):
+                        labels = _format_labels(key + (("le", bound),))
+                        lines.append(f"{name}_bucket{labels} {count}")
+                    labels = _format_labels(key + (("le", "+Inf"),))
+                    lines.append(f"{name}_bucket{labels} {series['count']}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {series['sum']}")
+                    lines.append(
+                        f"{name}_count{_format_labels(key)} {series['count']}"
+                    )
+            for name, series in self._max_gauges.items():
+                lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} gauge")
+                for key, value in series.items():
+                    lines.append(f"{name}{_format_labels(key)} {value}")
+            for name, value in self._gauges.items():
+                lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value}")
+        for name, callback in self._callbacks.items():
+            lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {callback()}")
+        return "\n".join(lines) + "\n"
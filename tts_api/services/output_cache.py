@@ -0,0 +1,276 @@
+# ./tts_api/services/output_cache.py
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import unicodedata
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    """Text as it matters for generation: Unicode NFC with whitespace runs collapsed."""
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+class OutputCache:
+    """
+    Cache of generated audio files in the output tree. Identical requests are
+    answered by linking the already generated file into the requester's output
+    directory, and requests that arrive while the same generation is running
+    are attached to it instead of being generated again. The output tree is
+    kept under `max_bytes` by removing the least recently used files. Its size
+    and usage order are kept in memory: the tree is scanned once at start-up,
+    and files the service deletes itself must be reported with discard().
+    """
+
+    def __init__(self, output_dir, index_path, max_bytes):
+        self.output_dir = output_dir
+        self.index_path = index_path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        # Keys of the in-flight generations that a worker has started on.
+        self._started = set()
+        self._index = OrderedDict()
+        index_dir = os.path.dirname(index_path)
+        if index_dir:
+            os.makedirs(index_dir, exist_ok=True)
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for key, entry in json.load(f):
+                    self._index[key] = entry
+        # Files of the output tree by inode, least recently used first: [size, set of paths]. Hard links made by
+        # cache hits share one inode and are counted once.
+        self._files = OrderedDict()
+        self._inodes = {}
+        self._total = 0
+        self.rescan()
+
+    @staticmethod
+    def key(
+        text,
+        lang,
+        voice_digest,
+        preset,
+        seed=None,
+        audio_format="wav",
+        sample_rate=24000,
+    ):
+        payload = json.dumps(
+            [
+                normalize_text(text),
+                lang,
+                voice_digest,
+                preset,
+                seed,
+                audio_format,
+                sample_rate,
+            ],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(list(self._index.items()), f)
+        os.replace(tmp_path, self.index_path)
+
+    def rescan(self):
+        """Rebuilds the size and usage order of the output tree from the files on disk, oldest first by mtime."""
+        files = {}
+        for root, _, names in os.walk(self.output_dir):
+            for name in names:
+                path = os.path.abspath(os.path.join(root, name))
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                inode = (stat.st_dev, stat.st_ino)
+                if inode not in files:
+                    files[inode] = [stat.st_mtime, stat.st_size, set()]
+                files[inode][2].add(path)
+        with self._lock:
+            self._files = OrderedDict(
+                (inode, [size, paths])
+                for inode, (_, size, paths) in sorted(
+                    files.items(), key=lambda f: f[1][0]
+                )
+            )
+            self._inodes = {
+                path: inode
+                for inode, (_, paths) in self._files.items()
+                for path in paths
+            }
+            self._total = sum(size for size, _ in self._files.values())
+
+    def _track(self, path):
+        """Records path as the most recently used file. Must hold self._lock."""
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return
+        inode = (stat.st_dev, stat.st_ino)
+        if inode not in self._files:
+            self._files[inode] = [stat.st_size, set()]
+            self._total += stat.st_size
+        self._files[inode][1].add(path)
+        self._files.move_to_end(inode)
+        self._inodes[path] = inode
+
+    def discard(self, path):
+        """Forgets a file of the output tree that was deleted by someone else."""
+        path = os.path.abspath(path)
+        with self._lock:
+            inode = self._inodes.pop(path, None)
+            if inode is None:
+                return
+            size, paths = self._files[inode]
+            paths.discard(path)
+            if not paths:
+                del self._files[inode]
+                self._total -= size
+
+    def total_bytes(self):
+        with self._lock:
+            return self._total
+
+    def _materialize(self, source, output_file):
+        """Makes the cached file available at output_file and marks it as recently used."""
+        if os.path.abspath(source) != os.path.abspath(output_file):
+            try:
+                os.link(source, output_file)
+            except OSError:
+                shutil.copyfile(source, output_file)
+        os.utime(output_file)
+        with self._lock:
+            self._track(output_file)
+
+    def get(self, key, output_file):
+        """
+        Returns a generation result (output_file, generated_time, audio_duration, wavelength)
+        for a cached key, with the audio placed at output_file, or None on a miss.
+        """
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(entry["path"]):
+                # Deleted by the user or evicted; the next generation replaces it.
+                del self._index[key]
+                return None
+            self._index.move_to_end(key)
+        self._materialize(entry["path"], output_file)
+        return output_file, 0, entry["audio_duration"], entry["wavelength"]
+
+    def claim(self, key, output_file, result_queue):
+        """
+        Registers a waiter for key. Returns True if the caller should start the
+        generation, or False if an identical one is already running and the
+        result will be delivered to result_queue when it finishes.
+        """
+        with self._lock:
+            waiters = self._in_flight.get(key)
+            if waiters is None:
+                self._in_flight[key] = [(output_file, result_queue)]
+                return True
+            waiters.append((output_file, result_queue))
+            started = key in self._started
+        if started:
+            getattr(result_queue, "started", lambda: None)()
+        return False
+
+    def started(self, key):
+        """Tells every request waiting for the in-flight generation of key that it has started."""
+        with self._lock:
+            self._started.add(key)
+            waiters = list(self._in_flight.get(key, []))
+        for _, result_queue in waiters:
+            getattr(result_queue, "started", lambda: None)()
+
+    def abandoned(self, key):
+        """True if every request waiting for the in-flight generation of key has been cancelled."""
+        with self._lock:
+            waiters = list(self._in_flight.get(key, []))
+        return bool(waiters) and all(
+            getattr(result_queue, "cancelled", lambda: False)()
+            for _, result_queue in waiters
+        )
+
+    def resolve(self, key, result):
+        """Records the result of a claimed generation and hands it to every waiter."""
+        with self._lock:
+            waiters = self._in_flight.pop(key, [])
+            self._started.discard(key)
+            if not isinstance(result, Exception):
+                source, _, audio_duration, wavelength = result
+                self._track(source)
+                self._index[key] = {
+                    "path": source,
+                    "audio_duration": audio_duration,
+                    "wavelength": wavelength,
+                }
+                self._index.move_to_end(key)
+                self._save_index()
+
+        for output_file, result_queue in waiters:
+            if isinstance(result, Exception):
+                result_queue.put(result)
+                continue
+            try:
+                self._materialize(source, output_file)
+                result_queue.put((output_file,) + tuple(result[1:]))
+            except OSError as e:
+                result_queue.put(e)
+
+        if not isinstance(result, Exception):
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used files until the output tree fits in max_bytes."""
+        removed = set()
+        with self._lock:
+            while self._total > self.max_bytes and self._files:
+                _, (size, paths) = self._files.popitem(last=False)
+                self._total -= size
+                for path in paths:
+                    del self._inodes[path]
+                removed |= paths
+        if not removed:
+            return
+
+        for path in removed:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+        with self._lock:
+            for key in [
+                k
+                for k, e in self._index.items()
+                if os.path.abspath(e["path"]) in removed
+            ]:
+                del self._index[key]
+            self._save_index()
+
+
+class CoalescedResult:
+    """Stands in for a request's result queue and resolves every request waiting on the same output."""
+
+    def __init__(self, output_cache, key):
+        self.output_cache = output_cache
+        self.key = key
+
+    def put(self, result):
+        self.output_cache.resolve(self.key, result)
+
+    def started(self):
+        self.output_cache.started(self.key)
+
+    def cancelled(self):
+        return self.output_cache.abandoned(self.key)
@@ -1,17 +1,235 @@
 # ./tts_api/services/voice_service.py
 
+import json
 import os
 import shutil
+import threading
+import time
 from flask import jsonify
 from werkzeug.utils import secure_filename
 from pydub import AudioSegment
 
+from services.latent_cache import file_digest
+
 
 class VoiceService:
-    def __init__(self, app, base_voices_dir, min_audio_length):
+    # Ingestion status of an uploaded voice, kept in the manifest in its directory.
+    PROCESSING = "processing"
+    READY = "ready"
+    FAILED = "failed"
+    MANIFEST_NAME = "manifest.json"
+    # Per-user summary of the voice manifests, so listing voices reads one file.
+    INDEX_NAME = "index.json"
+
+    def __init__(
+        self,
+        app,
+        base_voices_dir,
+        min_audio_length,
+        latent_cache=None,
+        voice_registry=None,
+        ingest_voice=None,
+    ):
         self.app = app
         self.BASE_VOICES_DIR = base_voices_dir
         self.MIN_AUDIO_LENGTH = min_audio_length
+        self.latent_cache = latent_cache
+        self.voice_registry = voice_registry
+        # ingest_voice(voice_name, on_done) precomputes a voice's latents in the
+        # background and calls on_done(error_or_None) when it is done.
+        self.ingest_voice = ingest_voice
+        self._index_lock = threading.Lock()
+
+    def invalidate_latents(self, voice_name):
+        if self.latent_cache is not None:
+            self.latent_cache.invalidate(voice_name)
+
+    def forget_voice(self, voice_name):
+        """Drops a deleted voice, or all voices of a user, from the latent cache and the registry."""
+        self.invalidate_latents(voice_name)
+        if self.voice_registry is not None:
+            self.voice_registry.remove(voice_name)
+
+    def _manifest_path(self, voice_name):
+        return os.path.join(self.BASE_VOICES_DIR, voice_name, self.MANIFEST_NAME)
+
+    def _index_path(self, user_id):
+        return os.path.join(self.BASE_VOICES_DIR, user_id, self.INDEX_NAME)
+
+    @staticmethod
+    def _read_json(path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def describe_voice(self, voice_name):
+        """
+        Manifest fields describing the clips of a voice. This decodes the clips,
+        so it runs once at upload time and listings read the stored result.
+        """
+        voice_dir = os.path.join(self.BASE_VOICES_DIR, voice_name)
+        names = sorted(f for f in os.listdir(voice_dir) if f.endswith(".wav"))
+        parts = []
+        for name in names:
+            path = os.path.join(voice_dir, name)
+            audio = AudioSegment.from_wav(path)
+            parts.append(
+                {
+                    "name": name,
+                    "duration": audio.duration_seconds,
+                    "sample_rate": audio.frame_rate,
+                    "size_bytes": os.path.getsize(path),
+                }
+            )
+        return {
+            "parts": parts,
+            "total_length": sum(part["duration"] for part in parts),
+            "sample_rate": parts[0]["sample_rate"] if parts else None,
+            "size_bytes": sum(part["size_bytes"] for part in parts),
+            # Same digest the latent cache keys the voice's latents by.
+            "content_hash": file_digest(
+                [os.path.join(voice_dir, name) for name in names]
+            ),
+        }
+
+    @staticmethod
+    def _index_entry(voice, manifest):
+        return {
+            "name": voice,
+            "parts": [part["name"] for part in manifest["parts"]],
+            "total_length": manifest["total_length"],
+            "sample_rate": manifest["sample_rate"],
+            "size_bytes": manifest["size_bytes"],
+            "content_hash": manifest["content_hash"],
+            "status": manifest["status"],
+            "updated_at": manifest["updated_at"],
+        }
+
+    def read_manifest(self, voice_name):
+        return self._read_json(self._manifest_path(voice_name))
+
+    def write_manifest(self, voice_name, manifest):
+        """Stores a voice's manifest and updates its entry in the user's index."""
+        manifest["updated_at"] = time.time()
+        self._write_json(self._manifest_path(voice_name), manifest)
+        user_id, voice = os.path.split(voice_name)
+        with self._index_lock:
+            index = self._read_json(self._index_path(user_id))
+            if index is not None:
+                index[voice] = self._index_entry(voice, manifest)
+                self._write_json(self._index_path(user_id), index)
+
+    def update_manifest(self, voice_name, **changes):
+        """Changes fields of a voice's manifest, describing the voice first if it has none."""
+        manifest = self.read_manifest(voice_name)
+        if manifest is None:
+            manifest = self.describe_voice(voice_name)
+            manifest.update(status=self.READY, error=None)
+        manifest.update(changes)
+        self.write_manifest(voice_name, manifest)
+
+    def read_index(self, user_id):
+        """
+        The user's voice summaries by voice name. A missing index is rebuilt from
+        the manifests; voices uploaded before manifests existed get one on the way.
+        """
+        index_path = self._index_path(user_id)
+        with self._index_lock:
+            index = self._read_json(index_path)
+            if index is not None:
+                return index
+
+            index = {}
+            for voice in self.get_user_voices(user_id):
+                voice_name = os.path.join(user_id, voice)
+                manifest = self.read_manifest(voice_name)
+                if manifest is None:
+                    manifest = self.describe_voice(voice_name)
+                    manifest.update(
+                        status=self.READY, error=None, updated_at=time.time()
+                    )
+                    self._write_json(self._manifest_path(voice_name), manifest)
+                index[voice] = self._index_entry(voice, manifest)
+            self._write_json(index_path, index)
+            return index
+
+    def _drop_from_index(self, user_id, voice):
+        with self._index_lock:
+            index = self._read_json(self._index_path(user_id))
+            if index is not None and voice in index:
+                del index[voice]
+                self._write_json(self._index_path(user_id), index)
+
+    def voice_status(self, voice_name):
+        """Ingestion status of a voice. Voices without a manifest predate ingestion and count as ready."""
+        manifest = self.read_manifest(voice_name)
+        return self.READY if manifest is None else manifest["status"]
+
+    def start_ingestion(self, voice_name):
+        """Hands a voice whose manifest says it is processing to the background ingestion."""
+        if self.ingest_voice is None:
+            self.finish_ingestion(voice_name, None)
+            return
+        self.ingest_voice(
+            voice_name, lambda error: self.finish_ingestion(voice_name, error)
+        )
+
+    def finish_ingestion(self, voice_name, error):
+        if not os.path.isdir(os.path.join(self.BASE_VOICES_DIR, voice_name)):
+            # The voice was deleted while it was being ingested.
+            return
+        if error is None:
+            self.app.logger.info("Voice ingestion finished: %s", voice_name)
+            self.update_manifest(voice_name, status=self.READY, error=None)
+        else:
+            self.app.logger.error("Voice ingestion failed: %s: %s", voice_name, error)
+            self.update_manifest(voice_name, status=self.FAILED, error=str(error))
+
+    def pending_ingestions(self):
+        """Voices left processing when the service last stopped."""
+        pending = []
+        for user_id in self.get_user_ids():
+            for voice in self.get_user_voices(user_id):
+                voice_name = os.path.join(user_id, voice)
+                if self.voice_status(voice_name) == self.PROCESSING:
+                    pending.append(voice_name)
+        return pending
+
+    def get_user_ids(self):
+        if not os.path.exists(self.BASE_VOICES_DIR):
+            return []
+        return [
+            d
+            for d in os.listdir(self.BASE_VOICES_DIR)
+            if os.path.isdir(os.path.join(self.BASE_VOICES_DIR, d))
+        ]
+
+    def get_voice_status(self, user_id, voice_name):
+        if not self.is_valid_user_id(user_id):
+            return jsonify({"error": "Invalid user ID. Must be alphanumeric"}), 400
+
+        voice = os.path.join(user_id, voice_name)
+        if not os.path.isdir(os.path.join(self.BASE_VOICES_DIR, voice)):
+            return jsonify({"error": "Voice not found"}), 404
+
+        manifest = self.read_manifest(voice) or {"status": self.READY, "error": None}
+        return jsonify(
+            {
+                "user_id": user_id,
+                "voice_name": voice_name,
+                "status": manifest["status"],
+                "error": manifest["error"],
+            }
+        )
 
     def add_voice(self, request):
         try:
@@ -81,9 +299,18 @@ class VoiceService:
             part2.export(os.path.join(user_voice_dir, "2.wav"), format="wav")
             part3.export(os.path.join(user_voice_dir, "3.wav"), format="wav")
             self.app.logger.info("Exported audio parts successfully")
+            self.invalidate_latents(os.path.join(user_id, voice_name))
 
             os.remove(temp_file_path)
             self.app.logger.info("Removed temporary file: %s", temp_file_path)
+            if self.voice_registry is not None:
+                self.voice_registry.update(os.path.join(user_id, voice_name))
+            # Describe the new clips once, so listings never have to decode them.
+            manifest = self.describe_voice(os.path.join(user_id, voice_name))
+            manifest.update(status=self.PROCESSING, error=None)
+            self.write_manifest(os.path.join(user_id, voice_name), manifest)
+            self.start_ingestion(os.path.join(user_id, voice_name))
+            status = self.voice_status(os.path.join(user_id, voice_name))
 
             response = {
                 "message": "Voice sample uploaded and split successfully",
@@ -91,9 +318,14 @@ class VoiceService:
                 "voice_name": voice_name,
                 "parts": ["1.wav", "2.wav", "3.wav"],
                 "total_length": len(audio) / 1000,
+                "sample_rate": manifest["sample_rate"],
+                "size_bytes": manifest["size_bytes"],
+                "content_hash": manifest["content_hash"],
+                "status": status,
             }
             self.app.logger.info("Voice addition successful: %s", response)
-            return jsonify(response), 201
+            # Until its latents are computed the voice cannot be used yet.
+            return jsonify(response), 201 if status == self.READY else 202
 
         except Exception as e:
             self.app.logger.error(
@@ -115,19 +347,11 @@ class VoiceService:
         if not self.is_valid_user_id(user_id):
             return jsonify({"error": "Invalid user ID. Must be alphanumeric"}), 400
 
-        voices = self.get_user_voices(user_id)
-        voice_details = []
-        for voice in voices:
-            voice_dir = os.path.join(self.BASE_VOICES_DIR, user_id, voice)
-            parts = [f for f in os.listdir(voice_dir) if f.endswith(".wav")]
-            total_length = sum(
-                AudioSegment.from_wav(os.path.join(voice_dir, part)).duration_seconds
-                for part in parts
-            )
-            voice_details.append(
-                {"name": voice, "parts": parts, "total_length": total_length}
-            )
-
+        if not os.path.isdir(os.path.join(self.BASE_VOICES_DIR, user_id)):
+            return jsonify({"user_id": user_id, "voices": []})
+        voice_details = sorted(
+            self.read_index(user_id).values(), key=lambda entry: entry["name"]
+        )
         return jsonify({"user_id": user_id, "voices": voice_details})
 
     def delete_voice(self, user_id, voice_name):
@@ -138,6 +362,8 @@ class VoiceService:
         if os.path.exists(voice_dir):
             try:
                 shutil.rmtree(voice_dir)
+                self._drop_from_index(user_id, voice_name)
+                self.forget_voice(os.path.join(user_id, voice_name))
                 return (
                     jsonify({"message": f"Voice '{voice_name}' deleted successfully"}),
                     200,
@@ -156,6 +382,7 @@ class VoiceService:
             try:
                 shutil.rmtree(user_voice_dir)
                 os.makedirs(user_voice_dir)
+                self.forget_voice(user_id)
                 return (
                     jsonify(
                         {
@@ -181,6 +408,7 @@ class VoiceService:
                     if os.path.isdir(user_voice_dir):
                         shutil.rmtree(user_voice_dir)
                         os.makedirs(user_voice_dir)
+                        self.forget_voice(user_id)
                         deleted_count += 1
 
             if deleted_count > 0:
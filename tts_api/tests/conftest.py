@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The service imports its modules relative to tts_api/ (e.g. `tortoise.api`, `services.job_store`).
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,48 @@
+import pytest
+
+from services.admission import Overloaded, WaitEstimator, check_queue_wait
+
+
+def test_estimate_counts_queued_work_and_half_of_running_work():
+    estimator = WaitEstimator(workers=2, default_seconds_per_char=0.1)
+    assert estimator.estimate([]) == 0
+    estimator.started("batch", [("fast", "x" * 40)])
+    # 4s in progress counts as 2s, plus 10 queued characters; over two workers.
+    assert estimator.estimate([("fast", "x" * 10)]) == pytest.approx(1.5)
+    estimator.finished("batch", [("fast", "x" * 40)])
+    assert estimator.estimate([("fast", "x" * 10)]) == pytest.approx(0.5)
+
+
+def test_rates_are_learned_per_preset():
+    estimator = WaitEstimator(workers=1, default_seconds_per_char=0.1, smoothing=0.5)
+    estimator.started(1, [("fast", "x" * 10)])
+    estimator.finished(1, [("fast", "x" * 10)], seconds=10)
+    assert estimator.rates() == {"fast": pytest.approx(1.0)}
+    estimator.started(2, [("fast", "x" * 10)])
+    estimator.finished(2, [("fast", "x" * 10)], seconds=20)
+    assert estimator.rates() == {"fast": pytest.approx(1.5)}
+    # Other presets keep the default until one of their batches finishes.
+    assert estimator.request_seconds("standard", "x" * 10) == pytest.approx(1.0)
+
+
+def test_failed_batches_do_not_change_the_rate():
+    estimator = WaitEstimator(workers=1, default_seconds_per_char=0.1)
+    estimator.started(1, [("fast", "x" * 10)])
+    estimator.finished(1, [("fast", "x" * 10)], seconds=None)
+    assert estimator.rates() == {}
+    assert estimator.estimate([]) == 0
+
+
+def test_requests_are_refused_past_the_wait_threshold():
+    estimator = WaitEstimator(workers=2, default_seconds_per_char=1.0)
+    check_queue_wait(estimator.estimate([("fast", "x" * 240)]), max_wait=120)
+    with pytest.raises(Overloaded) as e:
+        check_queue_wait(estimator.estimate([("fast", "x" * 243)]), max_wait=120)
+    # Retry once the queue has had time to get back under the threshold.
+    assert e.value.retry_after == 2
+
+
+def test_retry_after_is_whole_seconds_and_at_least_one():
+    assert Overloaded("busy", retry_after=0.2).retry_after == 1
+    assert Overloaded("busy", retry_after=2.1).retry_after == 3
+    assert Overloaded("busy", retry_after=-5).retry_after == 1
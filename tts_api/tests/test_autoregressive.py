@@ -0,0 +1,193 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+from tortoise.models.autoregressive import UnifiedVoice
+
+# Sampling arguments whose draws do not depend on how the vocabulary is laid out (no top-k, no top-p), so that
+# sample_codes() and generate() consume the random state identically.
+EXACT_SAMPLING = {
+    "do_sample": True,
+    "temperature": 0.8,
+    "top_k": 0,
+    "top_p": 1.0,
+    "repetition_penalty": 2.0,
+    "length_penalty": 1.0,
+}
+
+
+def tiny_model(stop_after=None):
+    """
+    A small random UnifiedVoice without DeepSpeed. With stop_after, every code that is a multiple of it is embedded
+    like the stop token's output direction, so that near-greedy sampling stops right after such a code.
+    """
+    torch.manual_seed(0)
+    model = UnifiedVoice(
+        layers=2,
+        model_dim=64,
+        heads=4,
+        max_text_tokens=40,
+        max_mel_tokens=60,
+        max_conditioning_inputs=1,
+        number_text_tokens=255,
+        start_text_token=255,
+        checkpointing=False,
+    ).eval()
+    model.post_init_gpt2_config(kv_cache=True, use_deepspeed=False)
+    if stop_after is not None:
+        with torch.no_grad():
+            codes = torch.arange(model.number_mel_codes)
+            model.mel_embedding.weight[codes % stop_after == 0] = (
+                model.mel_head.weight[model.stop_mel_token] * 50
+            )
+    return model
+
+
+def prompts(lengths, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    conds = [torch.randn((1, 64), generator=generator) for _ in lengths]
+    texts = [torch.randint(1, 255, (1, n), generator=generator) for n in lengths]
+    return conds, texts
+
+
+def sample(model, compact, seed, fn, *args, **kwargs):
+    assert model.compact_sampling
+    model.compact_sampling = compact
+    try:
+        torch.manual_seed(seed)
+        with torch.no_grad():
+            return fn(*args, **kwargs)
+    finally:
+        model.compact_sampling = True
+
+
+def test_sample_codes_matches_generate_for_a_seed():
+    model = tiny_model()
+    (cond,), (text,) = prompts([12])
+    for seed in range(3):
+        codes, _ = sample(
+            model,
+            True,
+            seed,
+            model.inference_speech,
+            cond,
+            text,
+            max_generate_length=40,
+            return_latent=True,
+            **EXACT_SAMPLING,
+        )
+        expected = sample(
+            model,
+            False,
+            seed,
+            model.inference_speech,
+            cond,
+            text,
+            max_generate_length=40,
+            **EXACT_SAMPLING,
+        )
+        assert torch.equal(codes, expected)
+
+
+def test_finished_candidates_leave_like_generate_pads_them():
+    # Near-greedy sampling, so that candidates of different prompts stop at different steps whatever the random
+    # state. generate() keeps sampling them and pads with the stop token, sample_codes() drops them.
+    model = tiny_model(stop_after=7)
+    conds, texts = prompts([5, 12, 9])
+    kwargs = dict(EXACT_SAMPLING, temperature=1e-3)
+    codes = sample(
+        model,
+        True,
+        0,
+        model.inference_speech_batch,
+        conds,
+        texts,
+        num_return_sequences=2,
+        max_generate_length=30,
+        **kwargs,
+    )
+    expected = sample(
+        model,
+        False,
+        0,
+        model.inference_speech_batch,
+        conds,
+        texts,
+        num_return_sequences=2,
+        max_generate_length=30,
+        **kwargs,
+    )
+    assert torch.equal(codes, expected)
+    stops = (codes == model.stop_mel_token).int().argmax(dim=1)
+    assert len(set(stops.tolist())) > 1
+
+
+def test_kept_latents_match_a_second_forward_pass():
+    model = tiny_model()
+    (cond,), (text,) = prompts([9])
+    codes, latents = sample(
+        model,
+        True,
+        0,
+        model.inference_speech,
+        cond,
+        text,
+        max_generate_length=30,
+        return_latent=True,
+        **EXACT_SAMPLING,
+    )
+    with torch.no_grad():
+        expected = model(
+            cond,
+            text,
+            torch.tensor([text.shape[1]]),
+            codes,
+            torch.tensor([codes.shape[1] * model.mel_length_compression]),
+            return_latent=True,
+            clip_inputs=False,
+        )
+    assert latents.shape == expected.shape
+    assert torch.allclose(latents, expected, atol=1e-4)
+
+
+def test_prefix_cache_is_reused_across_batches():
+    model = tiny_model()
+    (cond,), (text,) = prompts([10])
+    prefix_cache = {}
+    first = sample(
+        model,
+        True,
+        0,
+        model.inference_speech,
+        cond,
+        text,
+        num_return_sequences=3,
+        max_generate_length=20,
+        prefix_cache=prefix_cache,
+        **EXACT_SAMPLING,
+    )
+    past_key_values = prefix_cache["past_key_values"]
+    second = sample(
+        model,
+        True,
+        0,
+        model.inference_speech,
+        cond,
+        text,
+        num_return_sequences=3,
+        max_generate_length=20,
+        prefix_cache=prefix_cache,
+        **EXACT_SAMPLING,
+    )
+    assert prefix_cache["past_key_values"] is past_key_values
+    assert torch.equal(first, second)
+
+
+def test_deepspeed_or_unsupported_arguments_fall_back_to_generate():
+    model = tiny_model()
+    assert model.can_sample(EXACT_SAMPLING)
+    assert not model.can_sample(dict(EXACT_SAMPLING, num_beams=2))
+    assert not model.can_sample(dict(EXACT_SAMPLING, do_sample=False))
+    model.compact_sampling = False
+    assert not model.can_sample(EXACT_SAMPLING)
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("k_diffusion")
+# tortoise.api imports the BigVGAN vocoder and checks for HF_TOKEN; nothing is downloaded here.
+pytest.importorskip("BigVGAN")
+os.environ.setdefault("HF_TOKEN", "unused")
+
+from tortoise.api import group_by_length, load_discrete_vocoder_diffuser
+from tortoise.benchmark import TINY_CONFIG, build_tiny_tts, random_voice_samples
+from tortoise.utils.diffusion import SpacedDiffusion
+
+
+def test_lengths_within_the_tolerance_are_grouped():
+    assert group_by_length([40, 100, 45, 50, 60], tolerance=0.25) == [
+        [0, 2, 3],
+        [4],
+        [1],
+    ]
+    assert group_by_length([30, 30, 31], tolerance=0) == [[0, 1], [2]]
+
+
+def test_clips_of_different_lengths_share_one_sample_loop(monkeypatch):
+    tts = build_tiny_tts()
+    tts.enable_redaction = False
+    _, diffusion_conditioning = tts.get_conditioning_latents(random_voice_samples())
+    latents = [
+        torch.randn(1, length, TINY_CONFIG["model_dim"]) for length in (40, 46)
+    ]
+    shapes = []
+    sample_loop = SpacedDiffusion.sample_loop
+
+    def recording_sample_loop(self, model, shape, *args, **kwargs):
+        shapes.append(shape)
+        return sample_loop(self, model, shape, *args, **kwargs)
+
+    monkeypatch.setattr(SpacedDiffusion, "sample_loop", recording_sample_loop)
+    diffuser = load_discrete_vocoder_diffuser(desired_diffusion_steps=2)
+    wavs = tts.diffuse_batch(
+        diffuser,
+        latents,
+        diffusion_conditioning.repeat(2, 1),
+        verbose=False,
+        half=False,
+    )
+
+    assert shapes == [(2, 100, 46 * 4 * 24000 // 22050)]
+    # Each clip keeps its own length, as if it had been diffused alone.
+    assert [wav.shape[-1] for wav in wavs] == [
+        (length * 4 * 24000 // 22050) * 256 for length in (40, 46)
+    ]
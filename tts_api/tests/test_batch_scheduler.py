@@ -0,0 +1,31 @@
+from services.batch_scheduler import BatchScheduler
+from services.fair_queue import FairQueue
+
+
+def make_scheduler(max_batch=4):
+    queue = FairQueue({"user": 1}, default_class="user")
+    scheduler = BatchScheduler(
+        queue, key=lambda item: item[0], window=0.01, max_batch=max_batch
+    )
+    return queue, scheduler
+
+
+def test_requests_with_other_keys_wait_for_later_batches():
+    queue, scheduler = make_scheduler()
+    for item in [("fast", 1), ("standard", 2), ("fast", 3)]:
+        queue.put(item, "user", "u")
+    assert scheduler.next_batch(0) == [("fast", 1), ("fast", 3)]
+    assert scheduler.next_batch(0) == [("standard", 2)]
+    assert scheduler.next_batch(0) is None
+
+
+def test_a_key_takes_only_requests_that_can_join_a_running_batch():
+    queue, scheduler = make_scheduler()
+    for item in [("standard", 1), ("fast", 2), ("fast", 3), ("fast", 4)]:
+        queue.put(item, "user", "u")
+    assert scheduler.next_batch(0, key="fast", max_batch=2) == [
+        ("fast", 2),
+        ("fast", 3),
+    ]
+    assert scheduler.next_batch(0, key="high_quality") is None
+    assert scheduler.next_batch(0) == [("standard", 1)]
@@ -0,0 +1,165 @@
+import os
+import threading
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("k_diffusion")
+# tortoise.api imports the BigVGAN vocoder and checks for HF_TOKEN; nothing is downloaded here.
+pytest.importorskip("BigVGAN")
+os.environ.setdefault("HF_TOKEN", "unused")
+
+import tortoise.api
+from services.inference_pool import _context, run_worker
+from tortoise.api import ContinuousTTS
+from tortoise.benchmark import build_tiny_tts, random_voice_samples
+
+# Small enough for the tiny models to run in seconds. Random models hardly ever stop early, so every candidate
+# takes max_mel_tokens steps.
+TINY_PRESET = {
+    "num_autoregressive_samples": 8,
+    "max_mel_tokens": 12,
+    "diffusion_iterations": 2,
+    "sampler": "ddim",
+    "half": False,
+    "verbose": False,
+}
+
+
+@pytest.fixture(scope="module")
+def tts():
+    tts = build_tiny_tts(autoregressive_batch_size=4)
+    tts.latents = tts.get_conditioning_latents(random_voice_samples())
+    return tts
+
+
+def record_submissions(session):
+    """Records the step at which each batch of candidates was submitted, and returns the list and a step counter."""
+    submitted = []
+    steps = [0]
+    submit = session.engine.submit
+
+    def recording_submit(key, *args, **kwargs):
+        submitted.append((key, steps[0]))
+        return submit(key, *args, **kwargs)
+
+    session.engine.submit = recording_submit
+    return submitted, steps
+
+
+def test_requests_added_while_others_run_share_the_sampler(tts):
+    session = tts.continuous_tts(max_batches=3, **TINY_PRESET)
+    submitted, steps = record_submissions(session)
+    completed = {}
+    with torch.no_grad(), session:
+        session.add("a", ["First request."], [tts.latents])
+        while session.busy():
+            if steps[0] == 3:
+                session.add("b", ["Joins while the first one runs."], [tts.latents])
+            for key, clips in session.step():
+                completed[key] = steps[0]
+                assert len(clips) == 1 and clips[0].shape[:2] == (1, 1)
+            steps[0] += 1
+
+    # The second request started on the free slots right away, and took the first one's as they were freed.
+    assert [(key[0], step) for key, step in submitted] == [
+        ("a", 0),
+        ("a", 0),
+        ("b", 3),
+        ("b", 11),
+    ]
+    assert completed == {"a": 11, "b": 23}
+
+
+def test_long_texts_are_split_and_their_segments_sampled_in_order(tts):
+    session = tts.continuous_tts(max_batches=4, **TINY_PRESET)
+    submitted, steps = record_submissions(session)
+    text = "This is the first sentence of a longer text. " * 6
+    with torch.no_grad(), session:
+        session.add("long", [text, "Short."], [tts.latents, tts.latents])
+        completed = []
+        while session.busy():
+            completed += session.step()
+            steps[0] += 1
+
+    # Every segment is a prompt of its own.
+    assert len({key[:2] for key, _ in submitted}) > 2
+    [(key, clips)] = completed
+    assert key == "long" and len(clips) == 2
+    # The long text's segments are crossfaded into one clip, longer than the short text's.
+    assert clips[0].shape[-1] > clips[1].shape[-1]
+
+
+def test_dropped_requests_free_their_slots(tts):
+    session = tts.continuous_tts(max_batches=2, **TINY_PRESET)
+    with torch.no_grad(), session:
+        session.add("a", ["Dropped."], [tts.latents])
+        session.step()
+        session.add("b", ["Kept."], [tts.latents])
+        session.drop("a")
+        completed = []
+        while session.busy():
+            completed += session.step()
+    assert [key for key, _ in completed] == ["b"]
+
+
+class TinyModels:
+    """Stands in for the ModelRegistry of a worker."""
+
+    def __init__(self, tts):
+        self.tts = tts
+
+    def get(self, lang):
+        return self.tts
+
+    def loaded_languages(self):
+        return ["en"]
+
+
+def test_worker_adds_generations_to_the_running_one(tts, tmp_path, monkeypatch):
+    voice_dir = tmp_path / "voices" / "alice"
+    voice_dir.mkdir(parents=True)
+    torch.save(tts.latents, voice_dir / "latents.pth")
+    monkeypatch.setitem(tortoise.api.PRESETS, "tiny", TINY_PRESET)
+    monkeypatch.setattr(tortoise.api, "ModelRegistry", lambda **_: TinyModels(tts))
+    sessions = []
+    add = ContinuousTTS.add
+
+    def recording_add(self, key, *args, **kwargs):
+        sessions.append((key, id(self)))
+        return add(self, key, *args, **kwargs)
+
+    monkeypatch.setattr(ContinuousTTS, "add", recording_add)
+    config = {
+        "voices_dir": str(tmp_path / "voices"),
+        "latent_cache_dir": str(tmp_path / "cache"),
+        "latent_cache_size": 4,
+        "model_memory_budget": None,
+        "use_deepspeed": False,
+        "preload_langs": ["en"],
+        "max_batch": 2,
+    }
+    conn, child_conn = _context.Pipe()
+    worker = threading.Thread(
+        target=run_worker,
+        args=(child_conn, _context.Value("q", -1), torch.get_num_threads(), config),
+    )
+    worker.start()
+    try:
+        assert conn.recv()[0] == "ready"
+        for task_id, text in enumerate(["One.", "Two.", "Three."]):
+            conn.send(("generate", task_id, "en", [text], ["alice"], "tiny", None))
+        conn.send(("cancel", 2))
+        replies = {}
+        while len(replies) < 3:
+            message = conn.recv()
+            replies[message[1]] = message
+    finally:
+        conn.close()
+        worker.join()
+
+    assert replies[0][0] == replies[1][0] == "ok"
+    assert replies[2][0] == "cancelled"
+    # The second generation was added to the first one's sampler rather than run after it.
+    sessions = dict(sessions)
+    assert sessions[0] == sessions[1]
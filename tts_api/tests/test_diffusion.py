@@ -0,0 +1,87 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("k_diffusion")
+
+from tortoise.utils.diffusion import (
+    SpacedDiffusion,
+    get_named_beta_schedule,
+    space_timesteps,
+)
+
+
+class ShrinkingModel(torch.nn.Module):
+    """Predicts a fixed fraction of its input as the noise, with a learned-range variance of zero."""
+
+    def forward(self, x, t, **kwargs):
+        return torch.cat([x * 0.1, torch.zeros_like(x)], dim=1)
+
+
+def diffuser(sampler, conditioning_free=False):
+    return SpacedDiffusion(
+        use_timesteps=space_timesteps(100, [10]),
+        model_mean_type="epsilon",
+        model_var_type="learned_range",
+        loss_type="mse",
+        betas=get_named_beta_schedule("linear", 100),
+        conditioning_free=conditioning_free,
+        conditioning_free_k=2,
+        sampler=sampler,
+    )
+
+
+def sample(sampler, seed):
+    diffusion = diffuser(sampler)
+    diffusion.generator = torch.Generator().manual_seed(seed)
+    # Another thread drawing from the global RNG meanwhile must not change the result.
+    torch.rand(100)
+    return diffusion.sample_loop(ShrinkingModel(), (2, 3, 8), device="cpu")
+
+
+@pytest.mark.parametrize("sampler", ["p", "ddim"])
+def test_generator_makes_sampling_independent_of_the_global_rng(sampler):
+    first = sample(sampler, 0)
+    torch.rand(1000)
+    assert torch.equal(first, sample(sampler, 0))
+    assert not torch.equal(first, sample(sampler, 1))
+
+
+def test_without_generator_sampling_uses_the_global_rng():
+    diffusion = diffuser("p")
+    torch.manual_seed(0)
+    first = diffusion.sample_loop(ShrinkingModel(), (2, 3, 8), device="cpu")
+    torch.manual_seed(0)
+    second = diffusion.sample_loop(ShrinkingModel(), (2, 3, 8), device="cpu")
+    assert torch.equal(first, second)
+
+
+def test_conditioning_free_sampling_handles_batches():
+    diffusion = diffuser("ddim", conditioning_free=True)
+    noise = torch.randn(2, 3, 8)
+    batch = diffusion.sample_loop(
+        ShrinkingModel(), (2, 3, 8), noise=noise, device="cpu"
+    )
+    single = diffusion.sample_loop(
+        ShrinkingModel(), (1, 3, 8), noise=noise[1:], device="cpu"
+    )
+    # DDIM is deterministic given the starting noise, so batching leaves a clip as is.
+    assert torch.allclose(batch[1:], single)
+
+
+class Cancelled(Exception):
+    pass
+
+
+def test_cancel_check_stops_sampling_between_steps():
+    calls = []
+
+    def cancel_check():
+        calls.append(None)
+        if len(calls) == 3:
+            raise Cancelled
+
+    with pytest.raises(Cancelled):
+        diffuser("ddim").sample_loop(
+            ShrinkingModel(), (1, 3, 8), device="cpu", cancel_check=cancel_check
+        )
+    assert len(calls) == 3
@@ -0,0 +1,94 @@
+from queue import Empty
+
+import pytest
+
+from services.fair_queue import FairQueue, QueueLimitExceeded
+
+
+def drain(queue):
+    items = []
+    while True:
+        try:
+            item = queue.get(block=False)
+        except Empty:
+            return items
+        items.append(item)
+        queue.task_done(item)
+
+
+def test_classes_are_served_in_proportion_to_their_weights():
+    queue = FairQueue({"user": 3, "guest": 1}, default_class="guest")
+    for i in range(8):
+        queue.put(("user", i), "user", "u")
+        queue.put(("guest", i), "guest", "g")
+    order = [cls for cls, _ in drain(queue)]
+    # Smooth weighted round-robin spreads the guests out instead of serving them last.
+    assert order[:8] == ["user", "user", "guest", "user"] * 2
+    assert order.count("user") == 8 and order.count("guest") == 8
+
+
+def test_users_of_a_class_take_turns():
+    queue = FairQueue({"user": 1}, default_class="user")
+    for i in range(4):
+        queue.put(("a", i), "user", "a")
+    queue.put(("b", 0), "user", "b")
+    queue.put(("c", 0), "user", "c")
+    assert drain(queue) == [("a", 0), ("b", 0), ("c", 0), ("a", 1), ("a", 2), ("a", 3)]
+
+
+def test_unknown_class_falls_back_to_the_default():
+    queue = FairQueue({"user": 4, "guest": 1}, default_class="guest")
+    queue.put("x", "admin", "u")
+    assert queue.snapshot() == ["x"]
+    assert queue.get(block=False) == "x"
+
+
+def test_queued_cap_is_checked_by_check_only():
+    queue = FairQueue({"user": 1}, default_class="user", max_queued_per_user=2)
+    queue.put(1, "user", "a")
+    queue.check("a")
+    queue.put(2, "user", "a")
+    with pytest.raises(QueueLimitExceeded):
+        queue.check("a")
+    queue.check("b")
+    # Follow-up work is queued past the cap.
+    queue.put(3, "user", "a")
+    assert queue.qsize() == 3
+    queue.task_done(queue.get(block=False))
+    queue.task_done(queue.get(block=False))
+    queue.check("a")
+
+
+def test_user_at_running_cap_is_skipped_until_task_done():
+    queue = FairQueue({"user": 1}, default_class="user", max_running_per_user=1)
+    queue.put("a1", "user", "a")
+    queue.put("a2", "user", "a")
+    queue.put("b1", "user", "b")
+    first = queue.get(block=False)
+    assert first == "a1"
+    assert queue.get(block=False) == "b1"
+    with pytest.raises(Empty):
+        queue.get(block=False)
+    queue.task_done(first)
+    assert queue.get(block=False) == "a2"
+
+
+def test_get_with_match_keeps_other_requests_queued():
+    queue = FairQueue({"user": 1}, default_class="user")
+    queue.put(("en", 1), "user", "a")
+    queue.put(("vi", 2), "user", "b")
+    assert queue.get(block=False, match=lambda item: item[0] == "vi") == ("vi", 2)
+    with pytest.raises(Empty):
+        queue.get(block=False, match=lambda item: item[0] == "vi")
+    assert queue.get(timeout=0.01) == ("en", 1)
+
+
+def test_remove_drops_matching_requests():
+    queue = FairQueue({"user": 1}, default_class="user", max_queued_per_user=2)
+    queue.put(1, "user", "a")
+    queue.put(2, "user", "a")
+    queue.put(3, "user", "b")
+    assert queue.remove(lambda item: item < 3) == [1, 2]
+    assert queue.qsize() == 1
+    queue.check("a")
+    assert drain(queue) == [3]
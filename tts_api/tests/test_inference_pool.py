@@ -0,0 +1,94 @@
+import logging
+
+import pytest
+
+pytest.importorskip("torch")
+
+from services.inference_pool import InferencePool
+
+
+def make_pool(num_workers=2, max_batch=4):
+    config = {"preload_langs": ["en"], "max_batch": max_batch}
+    return InferencePool(num_workers, 1, config, logging.getLogger(__name__))
+
+
+def test_cancel_stops_batches_whose_requests_are_all_unwanted():
+    pool = make_pool()
+    first, second = pool.workers
+    cancelled = []
+    for worker in pool.workers:
+        worker.cancel = cancelled.append
+    first.tasks = {
+        3: ([("en", "a", "cancelled"), ("en", "b", "cancelled")], 0.0),
+        5: ([("en", "e", "wanted")], 0.0),
+    }
+    second.tasks = {4: ([("en", "c", "cancelled"), ("en", "d", "wanted")], 0.0)}
+
+    pool.cancel(lambda item: item[2] == "cancelled")
+
+    # A batch that still has a wanted request keeps running, even next to a cancelled one.
+    assert cancelled == [3]
+
+
+def test_cancel_ignores_idle_workers():
+    pool = make_pool()
+    pool.cancel(lambda item: True)
+    assert all(worker._cancelled_task.value == -1 for worker in pool.workers)
+
+
+class FakeWorker:
+    """Stands in for an InferenceWorker, answering batches in the order they were sent."""
+
+    worker_id = 0
+
+    def __init__(self):
+        self.tasks = {}
+        self.sent = []
+
+    def ensure_running(self):
+        pass
+
+    def submit(self, task_id, lang, texts, voice_names, preset, seed):
+        self.sent.append((task_id, texts))
+
+    def next_result(self, timeout):
+        task_id, texts = self.sent.pop(0)
+        return task_id, [f"audio of {text}" for text in texts], {}
+
+
+class Stop(Exception):
+    pass
+
+
+def test_requests_join_the_batches_running_on_a_worker():
+    pool = make_pool(num_workers=1, max_batch=3)
+    worker = FakeWorker()
+    first = [("en", "a", "voice", "fast", None)]
+    joining = [("en", "b", "voice", "fast", None), ("en", "c", "voice", "fast", None)]
+    calls = []
+
+    def next_batch(timeout, join=None, max_batch=None):
+        calls.append((join, max_batch))
+        if len(calls) == 1:
+            return first
+        if len(calls) == 2:
+            return joining
+        if len(calls) == 3:
+            return None
+        raise Stop
+
+    results = []
+    with pytest.raises(Stop):
+        pool._dispatch(
+            worker, next_batch, lambda batch, gens, *_: results.append((batch, gens))
+        )
+
+    # The second batch was taken to join the first, with room for the two requests left.
+    assert calls[1] == (first, 2)
+    assert calls[2] == (joining, 1)
+    # Idle again, the worker takes any batch.
+    assert calls[3] == (None, None)
+    assert results == [
+        (first, ["audio of a"]),
+        (joining, ["audio of b", "audio of c"]),
+    ]
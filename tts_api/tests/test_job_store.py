@@ -0,0 +1,101 @@
+from services.job_store import JobStore
+
+
+def make_store(tmp_path):
+    return JobStore(str(tmp_path / "jobs" / "jobs.db"))
+
+
+def test_job_runs_then_completes(tmp_path):
+    store = make_store(tmp_path)
+    job, created = store.create({"text": "hello"}, callback_url="http://cb")
+    assert created
+    assert job["status"] == JobStore.QUEUED
+    assert job["params"] == {"text": "hello"}
+
+    store.start(job["id"])
+    assert store.get(job["id"])["status"] == JobStore.RUNNING
+
+    store.complete(job["id"], {"audio_name": "a.wav"})
+    job = store.get(job["id"])
+    assert job["status"] == JobStore.COMPLETED
+    assert job["result"] == {"audio_name": "a.wav"}
+
+
+def test_queued_or_running_job_can_fail(tmp_path):
+    store = make_store(tmp_path)
+    queued, _ = store.create({})
+    running, _ = store.create({})
+    store.start(running["id"])
+    store.fail(queued["id"], "boom")
+    store.fail(running["id"], "boom")
+    for job_id in (queued["id"], running["id"]):
+        job = store.get(job_id)
+        assert job["status"] == JobStore.FAILED
+        assert job["error"] == "boom"
+
+
+def test_finished_job_is_not_started_again(tmp_path):
+    store = make_store(tmp_path)
+    job, _ = store.create({})
+    store.complete(job["id"], {})
+    store.start(job["id"])
+    assert store.get(job["id"])["status"] == JobStore.COMPLETED
+
+
+def test_request_key_returns_the_existing_job(tmp_path):
+    store = make_store(tmp_path)
+    first, created = store.create({"text": "a"}, request_key="k")
+    second, created_again = store.create({"text": "b"}, request_key="k")
+    assert created and not created_again
+    assert second["id"] == first["id"]
+    assert store.find("k")["params"] == {"text": "a"}
+    assert store.find("other") is None
+
+
+def test_cancel_queued_and_running_jobs(tmp_path):
+    store = make_store(tmp_path)
+    queued, _ = store.create({})
+    running, _ = store.create({})
+    store.start(running["id"])
+    assert store.cancel(queued["id"])
+    assert store.cancel(running["id"])
+    assert store.get(queued["id"])["status"] == JobStore.CANCELLED
+    assert store.get(running["id"])["status"] == JobStore.CANCELLED
+
+
+def test_cancelled_job_keeps_its_status(tmp_path):
+    store = make_store(tmp_path)
+    job, _ = store.create({})
+    store.start(job["id"])
+    assert store.cancel(job["id"])
+    # The generation finishing afterwards does not overwrite the cancellation.
+    store.complete(job["id"], {"audio_name": "a.wav"})
+    job = store.get(job["id"])
+    assert job["status"] == JobStore.CANCELLED
+    assert job["result"] is None
+
+
+def test_finished_or_unknown_job_cannot_be_cancelled(tmp_path):
+    store = make_store(tmp_path)
+    job, _ = store.create({})
+    store.fail(job["id"], "boom")
+    assert not store.cancel(job["id"])
+    assert not store.cancel("missing")
+    assert store.get(job["id"])["status"] == JobStore.FAILED
+
+
+def test_pending_requeues_running_jobs_oldest_first(tmp_path):
+    store = make_store(tmp_path)
+    first, _ = store.create({"n": 1})
+    second, _ = store.create({"n": 2})
+    done, _ = store.create({"n": 3})
+    cancelled, _ = store.create({"n": 4})
+    store.start(first["id"])
+    store.complete(done["id"], {})
+    store.cancel(cancelled["id"])
+
+    # A new store on the same file, as after a restart.
+    store = make_store(tmp_path)
+    pending = store.pending()
+    assert [job["id"] for job in pending] == [first["id"], second["id"]]
+    assert all(job["status"] == JobStore.QUEUED for job in pending)
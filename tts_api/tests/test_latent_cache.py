@@ -0,0 +1,139 @@
+import os
+from types import SimpleNamespace
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("librosa")
+
+import services.latent_cache as latent_cache_module
+from services.latent_cache import LatentCache
+from tortoise.utils.audio import VoiceRegistry
+
+# Voices saved as latents need no model to load, only a language to cache under.
+TTS_MODEL = SimpleNamespace(lang="en")
+
+
+def save_voice(voices_dir, name, value, mtime_ns):
+    voice_dir = voices_dir / name
+    voice_dir.mkdir(parents=True, exist_ok=True)
+    path = voice_dir / "latents.pth"
+    torch.save((torch.full((1, 4), value), torch.full((1, 2), value)), path)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    return path
+
+
+@pytest.fixture
+def voices_dir(tmp_path):
+    voices_dir = tmp_path / "voices"
+    save_voice(voices_dir, "alice", 1.0, 10**18)
+    return voices_dir
+
+
+@pytest.fixture
+def digests(monkeypatch):
+    """Counts how often clip files are hashed."""
+    calls = []
+    file_digest = latent_cache_module.file_digest
+
+    def counting_digest(paths):
+        calls.append(paths)
+        return file_digest(paths)
+
+    monkeypatch.setattr(latent_cache_module, "file_digest", counting_digest)
+    return calls
+
+
+def make_cache(voices_dir, tmp_path):
+    return LatentCache(VoiceRegistry(str(voices_dir)), str(tmp_path / "cache"))
+
+
+def test_digest_is_reused_while_the_clips_are_unchanged(voices_dir, tmp_path, digests):
+    cache = make_cache(voices_dir, tmp_path)
+    digest = cache.voice_digest("alice")
+    assert cache.voice_digest("alice") == digest
+    assert len(digests) == 1
+
+
+def test_changed_clips_get_a_new_digest_and_new_latents(voices_dir, tmp_path, digests):
+    cache = make_cache(voices_dir, tmp_path)
+    _, latents = cache.load_voice(TTS_MODEL, "alice")
+    digest = cache.voice_digest("alice")
+    assert torch.equal(latents[0], torch.full((1, 4), 1.0))
+
+    # Same name and size, new contents and mtime.
+    save_voice(voices_dir, "alice", 2.0, 2 * 10**18)
+    assert cache.voice_digest("alice") != digest
+    _, latents = cache.load_voice(TTS_MODEL, "alice")
+    assert torch.equal(latents[0], torch.full((1, 4), 2.0))
+    # The entry of the old clips was replaced on disk.
+    assert os.listdir(tmp_path / "cache" / "alice") == [
+        f"en_{cache.voice_digest('alice')}.pth"
+    ]
+
+
+def test_latents_survive_a_restart_on_disk(voices_dir, tmp_path):
+    make_cache(voices_dir, tmp_path).load_voice(TTS_MODEL, "alice")
+    cache = make_cache(voices_dir, tmp_path)
+    disk_path = cache._disk_path("alice", "en", cache.voice_digest("alice"))
+    assert os.path.exists(disk_path)
+    _, latents = cache.load_voice(TTS_MODEL, "alice")
+    assert torch.equal(latents[1], torch.full((1, 2), 1.0))
+
+
+def test_invalidate_forgets_a_voice_or_a_user_prefix(voices_dir, tmp_path, digests):
+    save_voice(voices_dir, "1/bob", 3.0, 10**18)
+    cache = make_cache(voices_dir, tmp_path)
+    cache.load_voice(TTS_MODEL, "alice")
+    cache.load_voice(TTS_MODEL, "1/bob")
+    hashed = len(digests)
+
+    cache.invalidate("1")
+    assert not os.path.exists(tmp_path / "cache" / "1")
+    assert os.path.exists(tmp_path / "cache" / "alice")
+    cache.voice_digest("alice")
+    assert len(digests) == hashed
+    cache.voice_digest("1/bob")
+    assert len(digests) == hashed + 1
+
+
+class ConditioningModel:
+    """Stands in for TextToSpeech, returning fixed latents and mels and counting calls."""
+
+    lang = "en"
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_conditioning_latents(self, voice_samples, return_mels=False):
+        self.calls += 1
+        latents = (torch.zeros(1, 4), torch.zeros(1, 2))
+        if return_mels:
+            return (*latents, torch.full((1, len(voice_samples), 80, 8), 5.0), None)
+        return latents
+
+
+def test_conditioning_mels_are_computed_once_and_stored(tmp_path):
+    scipy_wavfile = pytest.importorskip("scipy.io.wavfile")
+    voice_dir = tmp_path / "voices" / "1" / "carol"
+    voice_dir.mkdir(parents=True)
+    clip = (torch.sin(torch.arange(22050) * 0.05) * 0.5).numpy()
+    scipy_wavfile.write(voice_dir / "1.wav", 22050, clip)
+    model = ConditioningModel()
+    cache = make_cache(tmp_path / "voices", tmp_path)
+
+    mels = cache.conditioning_mels(model, "1/carol")
+    assert torch.equal(mels, torch.full((1, 1, 80, 8), 5.0))
+    assert model.calls == 1
+    # The ingestion stored the latents too, and a restart still finds the mels.
+    cache.load_voice(model, "1/carol")
+    restarted = make_cache(tmp_path / "voices", tmp_path)
+    mels = restarted.conditioning_mels(model, "1/carol")
+    assert torch.equal(mels, torch.full((1, 1, 80, 8), 5.0))
+    assert model.calls == 1
+
+
+def test_voices_stored_as_latents_have_no_conditioning_mels(voices_dir, tmp_path):
+    model = ConditioningModel()
+    assert make_cache(voices_dir, tmp_path).conditioning_mels(model, "alice") is None
+    assert model.calls == 0
@@ -0,0 +1,140 @@
+import os
+from queue import Queue
+
+from services.output_cache import CoalescedResult, OutputCache
+
+
+class CancellableQueue(Queue):
+    def __init__(self, cancelled=False):
+        super().__init__()
+        self.is_cancelled = cancelled
+
+    def cancelled(self):
+        return self.is_cancelled
+
+
+def make_cache(tmp_path, max_bytes=1000):
+    output_dir = tmp_path / "output"
+    output_dir.mkdir(exist_ok=True)
+    return OutputCache(str(output_dir), str(tmp_path / "index.json"), max_bytes)
+
+
+def write(tmp_path, name, size):
+    path = tmp_path / "output" / name
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(b"x" * size)
+    return str(path)
+
+
+def generate(cache, key, path, waiters=()):
+    """Claims key, attaches waiters to it and resolves it with the file at path."""
+    assert cache.claim(key, path, Queue())
+    for output_file, result_queue in waiters:
+        assert not cache.claim(key, output_file, result_queue)
+    CoalescedResult(cache, key).put((path, 1.5, 2.0, 2.0))
+
+
+def test_key_normalizes_text():
+    assert OutputCache.key("Hello   world ", "en", "d", "fast") == OutputCache.key(
+        "Hello world", "en", "d", "fast"
+    )
+    assert OutputCache.key("Hello", "en", "d", "fast", seed=1) != OutputCache.key(
+        "Hello", "en", "d", "fast", seed=2
+    )
+
+
+def test_identical_requests_share_one_generation(tmp_path):
+    cache = make_cache(tmp_path)
+    source = write(tmp_path, "user/a/first.wav", 10)
+    waiter = CancellableQueue()
+    waiter_file = str(tmp_path / "output" / "user" / "b.wav")
+    generate(cache, "k", source, [(waiter_file, waiter)])
+
+    assert waiter.get_nowait() == (waiter_file, 1.5, 2.0, 2.0)
+    assert os.path.samefile(source, waiter_file)
+    # Linked files are counted once.
+    assert cache.total_bytes() == 10
+
+
+def test_failed_generation_is_passed_to_every_waiter(tmp_path):
+    cache = make_cache(tmp_path)
+    waiter = CancellableQueue()
+    assert cache.claim("k", "a.wav", Queue())
+    assert not cache.claim("k", "b.wav", waiter)
+    error = RuntimeError("boom")
+    CoalescedResult(cache, "k").put(error)
+    assert waiter.get_nowait() is error
+    # Nothing is cached, so the next request generates again.
+    assert cache.get("k", "c.wav") is None
+    assert cache.claim("k", "c.wav", Queue())
+
+
+def test_cached_result_is_linked_for_later_requests(tmp_path):
+    cache = make_cache(tmp_path)
+    source = write(tmp_path, "user/a/first.wav", 10)
+    generate(cache, "k", source)
+    later = str(tmp_path / "output" / "user" / "c.wav")
+    assert cache.get("k", later) == (later, 0, 2.0, 2.0)
+    assert os.path.samefile(source, later)
+
+
+def test_generation_is_abandoned_once_every_waiter_cancelled(tmp_path):
+    cache = make_cache(tmp_path)
+    first, second = CancellableQueue(), CancellableQueue()
+    assert cache.claim("k", "a.wav", first)
+    assert not cache.claim("k", "b.wav", second)
+    result = CoalescedResult(cache, "k")
+    first.is_cancelled = True
+    assert not result.cancelled()
+    second.is_cancelled = True
+    assert result.cancelled()
+
+
+def test_least_recently_used_files_are_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=250)
+    first = write(tmp_path, "user/a/1.wav", 100)
+    generate(cache, "first", first)
+    second = write(tmp_path, "user/a/2.wav", 100)
+    generate(cache, "second", second)
+    # Using the first file makes the second the least recently used.
+    cache.get("first", first)
+    third = write(tmp_path, "user/a/3.wav", 100)
+    generate(cache, "third", third)
+
+    assert os.path.exists(first) and os.path.exists(third)
+    assert not os.path.exists(second)
+    assert cache.total_bytes() == 200
+    assert cache.get("second", str(tmp_path / "again.wav")) is None
+    assert cache.get("first", first) is not None
+
+
+def test_eviction_removes_every_link_of_a_file(tmp_path):
+    cache = make_cache(tmp_path, max_bytes=150)
+    first = write(tmp_path, "user/a/1.wav", 100)
+    link = str(tmp_path / "output" / "user" / "b" / "1.wav")
+    os.makedirs(os.path.dirname(link))
+    generate(cache, "first", first, [(link, Queue())])
+    second = write(tmp_path, "user/a/2.wav", 100)
+    generate(cache, "second", second)
+
+    assert not os.path.exists(first) and not os.path.exists(link)
+    assert os.path.exists(second)
+
+
+def test_size_is_scanned_once_and_updated_on_discard(tmp_path):
+    old = write(tmp_path, "user/a/old.wav", 100)
+    newer = write(tmp_path, "user/a/newer.wav", 100)
+    os.utime(old, (1, 1))
+    cache = make_cache(tmp_path, max_bytes=250)
+    assert cache.total_bytes() == 200
+
+    os.remove(newer)
+    cache.discard(newer)
+    assert cache.total_bytes() == 100
+
+    # The tree is not walked again, so the file from before start-up is the first to go.
+    big = write(tmp_path, "user/a/big.wav", 200)
+    generate(cache, "big", big)
+    assert not os.path.exists(old)
+    assert os.path.exists(big)
+    assert cache.total_bytes() == 200
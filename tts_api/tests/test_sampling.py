@@ -0,0 +1,133 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+
+import torch.nn.functional as F
+from transformers import (
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+from tortoise.utils.sampling import FusedSampler
+from tortoise.utils.typical_sampling import TypicalLogitsWarper
+
+VOCAB = 200
+
+
+def inputs(batch=4, history=12, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    logits = torch.randn((batch, VOCAB), generator=generator) * 3
+    input_ids = torch.randint(0, VOCAB, (batch, history), generator=generator)
+    seen = torch.zeros((batch, VOCAB), dtype=torch.bool)
+    seen.scatter_(1, input_ids, True)
+    return logits, input_ids, seen
+
+
+def fused_probs(sampler, logits, input_ids, seen):
+    """The distribution sampler draws from, over the whole vocabulary."""
+    scores, indices = sampler.warp(logits, seen, input_ids)
+    probs = F.softmax(scores, dim=-1)
+    if indices is None:
+        return probs
+    return torch.zeros_like(logits).scatter(1, indices, probs)
+
+
+def reference_probs(processors, logits, input_ids):
+    """The distribution generate(do_sample=True) draws from with these processors and warpers."""
+    scores = LogitsProcessorList(processors)(input_ids, logits.clone())
+    return F.softmax(scores, dim=-1)
+
+
+@pytest.mark.parametrize(
+    "kwargs, processors",
+    [
+        (
+            {"repetition_penalty": 2.0},
+            [RepetitionPenaltyLogitsProcessor(2.0)],
+        ),
+        (
+            {"temperature": 0.7},
+            [TemperatureLogitsWarper(0.7)],
+        ),
+        (
+            {"top_k": 17},
+            [TopKLogitsWarper(17)],
+        ),
+        (
+            {"top_p": 0.8},
+            [TopPLogitsWarper(0.8)],
+        ),
+        (
+            {"typical_mass": 0.9},
+            [TypicalLogitsWarper(mass=0.9)],
+        ),
+        (
+            # The service's presets: repetition penalty, temperature, and generate()'s default top-k under top-p.
+            {"repetition_penalty": 2.0, "temperature": 0.8, "top_k": 50, "top_p": 0.8},
+            [
+                RepetitionPenaltyLogitsProcessor(2.0),
+                TemperatureLogitsWarper(0.8),
+                TopKLogitsWarper(50),
+                TopPLogitsWarper(0.8),
+            ],
+        ),
+        (
+            {"repetition_penalty": 1.5, "typical_mass": 0.8, "temperature": 1.2},
+            [
+                RepetitionPenaltyLogitsProcessor(1.5),
+                TypicalLogitsWarper(mass=0.8),
+                TemperatureLogitsWarper(1.2),
+            ],
+        ),
+    ],
+)
+def test_matches_hf_processors(kwargs, processors):
+    logits, input_ids, seen = inputs()
+    expected = reference_probs(processors, logits, input_ids)
+    actual = fused_probs(FusedSampler(**kwargs), logits, input_ids, seen)
+    assert torch.allclose(actual, expected, atol=1e-6)
+
+
+def test_extra_processors_see_input_ids():
+    logits, input_ids, seen = inputs()
+    processor = RepetitionPenaltyLogitsProcessor(3.0)
+    expected = reference_probs(
+        [processor, TemperatureLogitsWarper(0.5)], logits, input_ids
+    )
+    sampler = FusedSampler(temperature=0.5, processors=[processor])
+    assert torch.allclose(
+        fused_probs(sampler, logits, input_ids, seen), expected, atol=1e-6
+    )
+
+
+@pytest.mark.parametrize("kwargs", [{"top_k": 5}, {"top_p": 0.3}, {}])
+def test_samples_only_allowed_tokens(kwargs):
+    logits, input_ids, seen = inputs(batch=64)
+    sampler = FusedSampler(repetition_penalty=2.0, **kwargs)
+    allowed = fused_probs(sampler, logits, input_ids, seen) > 0
+    for _ in range(5):
+        tokens = sampler(logits, seen, input_ids)
+        assert tokens.shape == (64,)
+        assert allowed.gather(1, tokens.unsqueeze(1)).all()
+
+
+def test_without_top_k_or_top_p_samples_like_multinomial():
+    # Drawing from the whole vocabulary in order consumes the random state like generate() does.
+    logits, input_ids, seen = inputs()
+    sampler = FusedSampler(repetition_penalty=2.0, temperature=0.8)
+    torch.manual_seed(3)
+    tokens = sampler(logits, seen, input_ids)
+    torch.manual_seed(3)
+    expected = torch.multinomial(
+        reference_probs(
+            [RepetitionPenaltyLogitsProcessor(2.0), TemperatureLogitsWarper(0.8)],
+            logits,
+            input_ids,
+        ),
+        num_samples=1,
+    ).squeeze(1)
+    assert torch.equal(tokens, expected)
@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("librosa")
+
+from tortoise.utils.audio import VoiceRegistry
+
+
+def add_voice(voices_dir, name):
+    voice_dir = voices_dir / name
+    voice_dir.mkdir(parents=True)
+    (voice_dir / "1.wav").write_bytes(b"")
+    return voice_dir
+
+
+@pytest.fixture
+def voices_dir(tmp_path):
+    voices_dir = tmp_path / "voices"
+    add_voice(voices_dir, "default")
+    add_voice(voices_dir, "42/mine")
+    return voices_dir
+
+
+def test_default_and_user_voices_are_found(voices_dir):
+    registry = VoiceRegistry(str(voices_dir))
+    assert registry.get("default") == [str(voices_dir / "default" / "1.wav")]
+    assert registry.get("42/mine") == [str(voices_dir / "42" / "mine" / "1.wav")]
+
+
+def test_voices_added_later_are_found_by_a_rescan(voices_dir):
+    registry = VoiceRegistry(str(voices_dir))
+    registry.build()
+    add_voice(voices_dir, "42/new")
+    assert registry.get("42/new") == [str(voices_dir / "42" / "new" / "1.wav")]
+
+
+@pytest.mark.parametrize(
+    "name", ["../outside", "42/../../outside", "42/mine/..", "42", "/tmp", "42//mine"]
+)
+def test_names_outside_the_tree_are_not_resolved(voices_dir, tmp_path, name):
+    add_voice(tmp_path, "outside")
+    registry = VoiceRegistry(str(voices_dir))
+    with pytest.raises(ValueError):
+        registry.get(name)
+
+
+def test_symlinks_out_of_the_tree_are_ignored(voices_dir, tmp_path):
+    outside = add_voice(tmp_path, "outside")
+    os.symlink(outside, voices_dir / "42" / "linked")
+    registry = VoiceRegistry(str(voices_dir))
+    with pytest.raises(ValueError):
+        registry.get("42/linked")
+    with pytest.raises(ValueError):
+        registry.update("42/linked")
+    assert "42/linked" not in registry.names()
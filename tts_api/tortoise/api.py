@@ -2,8 +2,11 @@
 
 import os
 import random
-from time import time
+import threading
+from queue import Queue
+from time import perf_counter, time
 
+import psutil
 import torch
 import torch.nn.functional as F
 import torchaudio
@@ -23,12 +26,20 @@ from tortoise.utils.diffusion import (
     get_named_beta_schedule,
     space_timesteps,
 )
+from tortoise.utils.text import split_and_recombine_text
 from tortoise.utils.tokenizer import VoiceBpeTokenizer
 from tortoise.utils.wav2vec_alignment import Wav2VecAlignment
 
-from tortoise.models.utils import MODELS_DIR, get_model_path
+from tortoise.models.utils import (
+    MODELS_DIR,
+    assign_state_dict,
+    get_model_path,
+    load_checkpoint,
+)
 
-from contextlib import contextmanager
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager, nullcontext
 
 
 def pad_or_truncate(t, length):
@@ -120,9 +131,12 @@ def do_spectrogram_diffusion(
     conditioning_latents,
     temperature=1,
     verbose=True,
+    cancel_check=None,
 ):
     """
-    Uses the specified diffusion model to convert discrete codes into a spectrogram.
+    Uses the specified diffusion model to convert discrete codes into a spectrogram. All noise comes from the
+    diffuser's generator when it has one.
+    cancel_check, if given, is called between diffusion steps and may raise to abandon sampling.
     """
     with torch.no_grad():
         output_seq_len = (
@@ -133,23 +147,161 @@ def do_spectrogram_diffusion(
             latents, conditioning_latents, output_seq_len, False
         )
 
-        noise = torch.randn(output_shape, device=latents.device) * temperature
+        noise = diffuser.randn(output_shape, latents.device) * temperature
         mel = diffuser.sample_loop(
             diffusion_model,
             output_shape,
             noise=noise,
             model_kwargs={"precomputed_aligned_embeddings": precomputed_embeddings},
             progress=verbose,
+            cancel_check=cancel_check,
         )
         return denormalize_tacotron_mel(mel)[:, :, :output_seq_len]
 
 
+# Codes fed to a candidate after its stop token when its latents are kept while sampling. diffusion_stage() uses the
+# latents up to 8 columns past the stop token, whose codes fix_autoregressive_output() turns into the calm token (83).
+LATENT_TRAILING_TOKENS = [83] * 7
+
+# Host memory the latents of all candidates may take when they are kept for CLVP to choose from. Beyond this, the
+# latents of the chosen candidates are re-produced with a second autoregressive forward pass instead.
+MAX_RETAINED_LATENT_BYTES = 1 << 30
+
+
+def pad_latents(latents, length):
+    """Cuts or zero-pads latents kept while sampling (see UnifiedVoice.sample_codes()) to `length` columns."""
+    latents = latents[:, :length]
+    return F.pad(latents, (0, 0, 0, length - latents.shape[1]))
+
+
+# Clips whose latents are at most this fraction longer than the shortest of them are diffused in one batch.
+DIFFUSION_LENGTH_TOLERANCE = 0.25
+
+
+def group_by_length(lengths, tolerance=DIFFUSION_LENGTH_TOLERANCE):
+    """
+    Groups the indices of clips with the given latent lengths so that the longest clip of a group is at most
+    `tolerance` longer than the shortest. Returns a list of index lists, shortest clips first.
+    """
+    groups = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if groups and lengths[i] <= lengths[groups[-1][0]] * (1 + tolerance):
+            groups[-1].append(i)
+        else:
+            groups.append([i])
+    return groups
+
+
+def extend_latents(latents, length):
+    """
+    Extends latents to `length` columns by repeating their last one. Latents trimmed where a clip settles into the calm
+    token end in calm columns, so this adds silence after the clip.
+    """
+    padding = latents[:, -1:].expand(-1, length - latents.shape[1], -1)
+    return torch.cat([latents, padding], dim=1)
+
+
+def trim_latents(codes, latents, calm_token=83):
+    """
+    Cuts the latents of a clip, of shape (1, length, channels), where its codes settle into the calm token (the token
+    for coding silence, which is fixed in place with fix_autoregressive_output()), as diffusion_stage() does.
+    """
+    ctokens = 0
+    for k in range(codes.shape[-1]):
+        if codes[0, k] == calm_token:
+            ctokens += 1
+        else:
+            ctokens = 0
+        if ctokens > 8:  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
+            return latents[:, :k]
+    return latents
+
+
+# Generation parameters of the presets accepted by TextToSpeech.tts_with_preset() and friends.
+PRESETS = {
+    "single_sample": {
+        "num_autoregressive_samples": 8,
+        "diffusion_iterations": 10,
+        "sampler": "ddim",
+    },
+    "ultra_fast": {
+        "num_autoregressive_samples": 16,  # was 16
+        "diffusion_iterations": 15,  # was 10
+        "sampler": "ddim",
+    },
+    "ultra_fast_old": {
+        "num_autoregressive_samples": 16,
+        "diffusion_iterations": 30,
+        "cond_free": False,
+    },
+    "very_fast": {
+        "num_autoregressive_samples": 32,
+        "diffusion_iterations": 30,
+        "sampler": "dpm++2m",
+    },
+    "fast": {
+        "num_autoregressive_samples": 96,
+        "diffusion_iterations": 20,
+        "sampler": "dpm++2m",
+    },
+    "fast_adaptive": {
+        "num_autoregressive_samples": 96,  # upper bound, see adaptive_sampling in tts()
+        "adaptive_sampling": True,
+        "diffusion_iterations": 20,
+        "sampler": "dpm++2m",
+    },
+    "fast_old": {"num_autoregressive_samples": 96, "diffusion_iterations": 80},
+    "standard": {
+        "num_autoregressive_samples": 256,
+        "diffusion_iterations": 200,
+    },
+    "high_quality": {
+        "num_autoregressive_samples": 256,
+        "diffusion_iterations": 400,
+    },
+}
+
+
+class GenerationCancelled(Exception):
+    """Raised from inside a generation when TextToSpeech.cancel_check reports it is no longer wanted."""
+
+
+def crossfade_clips(clips, overlap):
+    """
+    Concatenates audio clips of shape (1,1,S) along the sample axis, blending each boundary with a linear crossfade
+    of <overlap> samples.
+    """
+    result = clips[0]
+    for clip in clips[1:]:
+        n = min(overlap, result.shape[-1], clip.shape[-1])
+        if n == 0:
+            result = torch.cat([result, clip], dim=-1)
+            continue
+        fade = torch.linspace(0, 1, n, device=clip.device)
+        blended = result[..., -n:] * (1 - fade) + clip[..., :n] * fade
+        result = torch.cat([result[..., :-n], blended, clip[..., n:]], dim=-1)
+    return result
+
+
+_classifier = None
+
+
 def classify_audio_clip(clip):
     """
     Returns whether or not Tortoises' classifier thinks the given clip came from Tortoise.
     :param clip: torch tensor containing audio waveform data (get it from load_audio)
     :return: True if the clip was classified as coming from Tortoise and false if it was classified as real.
     """
+    global _classifier
+    if _classifier is None:
+        _classifier = load_classifier()
+    clip = clip.cpu().unsqueeze(0)
+    results = F.softmax(_classifier(clip), dim=-1)
+    return results[0][0]
+
+
+def load_classifier():
+    """Builds the classifier used by classify_audio_clip(). Only loaded the first time a clip is classified."""
     classifier = AudioMiniEncoderWithClassifierHead(
         2,
         spec_dim=1,
@@ -164,12 +316,8 @@ def classify_audio_clip(clip):
         kernel_size=5,
         distribute_zero_label=False,
     )
-    classifier.load_state_dict(
-        torch.load(get_model_path("classifier.pth"), map_location=torch.device("cpu"))
-    )
-    clip = clip.cpu().unsqueeze(0)
-    results = F.softmax(classifier(clip), dim=-1)
-    return results[0][0]
+    assign_state_dict(classifier, load_checkpoint(get_model_path("classifier.pth")))
+    return classifier.eval()
 
 
 def pick_best_batch_size_for_gpu():
@@ -211,11 +359,14 @@ class TextToSpeech:
         device=None,
         high_vram=False,
         kv_cache=True,
+        use_deepspeed=True,
         ar_checkpoint=None,
         clvp_checkpoint=None,
         diff_checkpoint=None,
         vocoder=VocConf.Univnet,
         lang="en",
+        shared_models=None,
+        autoregressive=None,
     ):
         """
         Constructor
@@ -229,10 +380,20 @@ class TextToSpeech:
         :param device: Device to use when running the model. If omitted, the device will be automatically chosen.
         :param high_vram: If true, the model will use more VRAM but will run faster.
         :param kv_cache: If true, the autoregressive model will cache key value attention pairs to speed up generation.
+        :param use_deepspeed: If true, the autoregressive model runs on DeepSpeed's fused inference kernels and samples
+                              with Hugging Face generate(). If false, it runs as a plain model and samples with
+                              UnifiedVoice.sample_codes(), which drops finished candidates, shares the prompt's KV cache
+                              and keeps the latents for diffusion. Ignored when `autoregressive` is given.
         :param ar_checkpoint: Path to a checkpoint file for the autoregressive model. If omitted, uses default
         :param clvp_checkpoint: Path to a checkpoint file for the CLVP model. If omitted, uses default
         :param diff_checkpoint: Path to a checkpoint file for the diffusion model. If omitted, uses default
         :param lang: Language for the tokenizer, default is 'en' for English, can be set to 'vi' for Vietnamese.
+        :param shared_models: Language-independent models (diffusion, CLVP, vocoder, aligner) as returned by another
+                              instance's shared_models(). When given they are reused instead of being loaded again, so
+                              only the autoregressive model and tokenizer for `lang` are loaded.
+        :param autoregressive: An already built UnifiedVoice, ready for inference (post_init_gpt2_config() called), to
+                               use instead of loading the checkpoint. Together with shared_models this builds a
+                               pipeline without reading any weights, e.g. around small random models for benchmarks.
 
         """
         self.ar_checkpoint = ar_checkpoint
@@ -245,15 +406,46 @@ class TextToSpeech:
         )
         self.enable_redaction = enable_redaction
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        if self.enable_redaction:
-            self.aligner = Wav2VecAlignment()
 
+        self.lang = lang
         self.tokenizer = VoiceBpeTokenizer(lang=lang)
 
-        if os.path.exists(f"{models_dir}/autoregressive.ptt"):
+        # Checkpoints are read in parallel; after their one-time conversion they are memory-mapped, which makes this
+        # mostly a matter of mapping files.
+        traced = autoregressive is None and os.path.exists(
+            f"{models_dir}/autoregressive.ptt"
+        )
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            checkpoints = {}
+            if not traced and autoregressive is None:
+                ar_model_file = (
+                    "autoregressive_vi.pth" if lang == "vi" else "autoregressive.pth"
+                )
+                ar_path = ar_checkpoint or get_model_path(ar_model_file, models_dir)
+                print(f"Autoregressive model path: {ar_path}")
+                checkpoints["autoregressive"] = pool.submit(load_checkpoint, ar_path)
+            if shared_models is None:
+                if not traced:
+                    diff_path = diff_checkpoint or get_model_path(
+                        "diffusion_decoder.pth", models_dir
+                    )
+                    checkpoints["diffusion"] = pool.submit(load_checkpoint, diff_path)
+                clvp_path = clvp_checkpoint or get_model_path("clvp2.pth", models_dir)
+                checkpoints["clvp"] = pool.submit(load_checkpoint, clvp_path)
+                checkpoints["vocoder"] = pool.submit(
+                    load_checkpoint,
+                    get_model_path(vocoder.value.model_path, models_dir),
+                    vocoder.value.subkey,
+                )
+            checkpoints = {name: f.result() for name, f in checkpoints.items()}
+
+        if autoregressive is not None:
+            self.autoregressive = autoregressive
+        elif traced:
             # Assume this is a traced directory.
             self.autoregressive = torch.jit.load(f"{models_dir}/autoregressive.ptt")
-            self.diffusion = torch.jit.load(f"{models_dir}/diffusion_decoder.ptt")
+            if shared_models is None:
+                self.diffusion = torch.jit.load(f"{models_dir}/diffusion_decoder.ptt")
         else:
             self.autoregressive = (
                 UnifiedVoice(
@@ -271,17 +463,45 @@ class TextToSpeech:
                 .cpu()
                 .eval()
             )
-            ar_model_file = (
-                "autoregressive_vi.pth" if lang == "vi" else "autoregressive.pth"
+            assign_state_dict(self.autoregressive, checkpoints["autoregressive"])
+            self.autoregressive.post_init_gpt2_config(
+                kv_cache, use_deepspeed=use_deepspeed
             )
-            ar_path = ar_checkpoint or get_model_path(ar_model_file, models_dir)
-            print(f"Autoregressive model path: {ar_path}")
-            self.autoregressive.load_state_dict(torch.load(ar_path))
-            self.autoregressive.post_init_gpt2_config(kv_cache)
 
-            diff_path = diff_checkpoint or get_model_path(
-                "diffusion_decoder.pth", models_dir
-            )
+        if shared_models is not None:
+            self._shared = shared_models
+            self.diffusion = shared_models["diffusion"]
+            self.clvp = shared_models["clvp"]
+            self.vocoder = shared_models["vocoder"]
+        else:
+            # The aligner is created on first use and lives in this dict so that pipelines sharing it see it too.
+            self._shared = {"aligner": None}
+            self.load_shared_models(checkpoints, vocoder)
+        self.cvvp = None  # CVVP model is only loaded if used.
+
+        # Random latent generators (RLGs) are loaded lazily.
+        self.rlg_auto = None
+        self.rlg_diffusion = None
+
+        # Wall time and peak memory per pipeline stage, see timed_stage(). Callers reset it between requests.
+        self.stage_timings = {}
+        # tts_long() times stages on two threads at once.
+        self._timing_lock = threading.Lock()
+        self._open_stages = 0
+        # Optional callable polled between autoregressive batches and diffusion steps. When it returns True the
+        # generation stops with GenerationCancelled. Callers set it per request.
+        self.cancel_check = None
+
+        if high_vram:
+            self.autoregressive = self.autoregressive.to(self.device)
+            self.diffusion = self.diffusion.to(self.device)
+            self.clvp = self.clvp.to(self.device)
+            self.vocoder = self.vocoder.to(self.device)
+        self.high_vram = high_vram
+
+    def load_shared_models(self, checkpoints, vocoder):
+        """Builds the models that do not depend on the language (diffusion decoder, CLVP and vocoder) from checkpoints."""
+        if "diffusion" in checkpoints:
             self.diffusion = (
                 DiffusionTts(
                     model_channels=1024,
@@ -299,7 +519,7 @@ class TextToSpeech:
                 .cpu()
                 .eval()
             )
-            self.diffusion.load_state_dict(torch.load(diff_path))
+            assign_state_dict(self.diffusion, checkpoints["diffusion"])
 
         self.clvp = (
             CLVP(
@@ -319,31 +539,64 @@ class TextToSpeech:
             .cpu()
             .eval()
         )
-        clvp_path = clvp_checkpoint or get_model_path("clvp2.pth", models_dir)
-        self.clvp.load_state_dict(torch.load(clvp_path))
-        self.cvvp = None  # CVVP model is only loaded if used.
+        assign_state_dict(self.clvp, checkpoints["clvp"])
 
         self.vocoder = vocoder.value.constructor().cpu()
-        self.vocoder.load_state_dict(
-            vocoder.value.optionally_index(
-                torch.load(
-                    get_model_path(vocoder.value.model_path, models_dir),
-                    map_location=torch.device("cpu"),
-                )
-            )
-        )
+        assign_state_dict(self.vocoder, checkpoints["vocoder"])
         self.vocoder.eval(inference=True)
 
-        # Random latent generators (RLGs) are loaded lazily.
-        self.rlg_auto = None
-        self.rlg_diffusion = None
+    @property
+    def aligner(self):
+        """Wav2Vec aligner used for redaction, created on first use."""
+        if self._shared["aligner"] is None:
+            self._shared["aligner"] = Wav2VecAlignment()
+        return self._shared["aligner"]
 
-        if high_vram:
-            self.autoregressive = self.autoregressive.to(self.device)
-            self.diffusion = self.diffusion.to(self.device)
-            self.clvp = self.clvp.to(self.device)
-            self.vocoder = self.vocoder.to(self.device)
-        self.high_vram = high_vram
+    def shared_models(self):
+        """The language-independent models of this instance, for passing to another instance as shared_models."""
+        self._shared.update(
+            diffusion=self.diffusion, clvp=self.clvp, vocoder=self.vocoder
+        )
+        return self._shared
+
+    @contextmanager
+    def timed_stage(self, stage):
+        """
+        Adds the wall time of the enclosed block to self.stage_timings[stage], together with the peak memory seen
+        during it, as (seconds, peak_bytes). On GPU that is the peak of allocated CUDA memory. On CPU, where only
+        the lifetime peak is recorded, it is the larger of the process's resident set sizes at the start and the end
+        of the block. Safe to use from several threads. CUDA keeps a single peak per device, so while stages overlap
+        (the two threads of tts_long()) it is only reset when no other stage is open, and each stage's peak includes
+        what the others allocated meanwhile.
+        """
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        else:
+            start_rss = psutil.Process().memory_info().rss
+        with self._timing_lock:
+            if torch.cuda.is_available() and self._open_stages == 0:
+                torch.cuda.reset_peak_memory_stats()
+            self._open_stages += 1
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+                peak = torch.cuda.max_memory_allocated()
+            else:
+                peak = max(start_rss, psutil.Process().memory_info().rss)
+            with self._timing_lock:
+                self._open_stages -= 1
+                seconds, previous_peak = self.stage_timings.get(stage, (0.0, 0))
+                self.stage_timings[stage] = (
+                    seconds + perf_counter() - start,
+                    max(previous_peak, peak),
+                )
+
+    def check_cancelled(self):
+        if self.cancel_check is not None and self.cancel_check():
+            raise GenerationCancelled("Generation was cancelled")
 
     @contextmanager
     def temporary_cuda(self, model):
@@ -371,8 +624,8 @@ class TextToSpeech:
             .cpu()
             .eval()
         )
-        self.cvvp.load_state_dict(
-            torch.load(get_model_path("cvvp.pth", self.models_dir))
+        assign_state_dict(
+            self.cvvp, load_checkpoint(get_model_path("cvvp.pth", self.models_dir))
         )
 
     def get_conditioning_latents(
@@ -398,7 +651,7 @@ class TextToSpeech:
             2,
         ], "latent_averaging mode has to be one of (0, 1, 2)"
         print("mode", latent_averaging_mode)
-        with torch.no_grad():
+        with self.timed_stage("conditioning_latents"), torch.no_grad():
             voice_samples = [[v.to(self.device) for v in ls] for ls in voice_samples]
 
             auto_conds = []
@@ -463,18 +716,14 @@ class TextToSpeech:
         # Lazy-load the RLG models.
         if self.rlg_auto is None:
             self.rlg_auto = RandomLatentConverter(1024).eval()
-            self.rlg_auto.load_state_dict(
-                torch.load(
-                    get_model_path("rlg_auto.pth", self.models_dir),
-                    map_location=torch.device("cpu"),
-                )
+            assign_state_dict(
+                self.rlg_auto,
+                load_checkpoint(get_model_path("rlg_auto.pth", self.models_dir)),
             )
             self.rlg_diffusion = RandomLatentConverter(2048).eval()
-            self.rlg_diffusion.load_state_dict(
-                torch.load(
-                    get_model_path("rlg_diffuser.pth", self.models_dir),
-                    map_location=torch.device("cpu"),
-                )
+            assign_state_dict(
+                self.rlg_diffusion,
+                load_checkpoint(get_model_path("rlg_diffuser.pth", self.models_dir)),
             )
         with torch.no_grad():
             return self.rlg_auto(torch.tensor([0.0])), self.rlg_diffusion(
@@ -488,9 +737,42 @@ class TextToSpeech:
             'ultra_fast': Produces speech much faster than the original tortoise repo.
             'ultra_fast_old': Produces speech at a speed which belies the name of this repo. (Not really, but it's definitely fastest).
             'fast': Decent quality speech at a decent inference rate. A good choice for mass inference.
+            'fast_adaptive': Like 'fast', but stops sampling candidates once new ones no longer beat the best so far.
             'standard': Very good quality. This is generally about as good as you are going to get.
             'high_quality': Use if you want the absolute best. This is not really worth the compute, though.
         """
+        settings = self.preset_settings(preset)
+        settings.update(kwargs)  # allow overriding of preset settings with kwargs
+        return self.tts(text, **settings)
+
+    def tts_batch_with_preset(self, texts, preset="fast", **kwargs):
+        """
+        Calls tts_batch() with one of the presets described in tts_with_preset().
+        """
+        settings = self.preset_settings(preset)
+        settings.update(kwargs)  # allow overriding of preset settings with kwargs
+        return self.tts_batch(texts, **settings)
+
+    def tts_long_with_preset(self, text, preset="fast", **kwargs):
+        """
+        Calls tts_long() with one of the presets described in tts_with_preset().
+        """
+        settings = self.preset_settings(preset)
+        settings.update(kwargs)  # allow overriding of preset settings with kwargs
+        return self.tts_long(text, **settings)
+
+    def continuous_tts_with_preset(self, preset="fast", **kwargs):
+        """
+        Calls continuous_tts() with one of the presets described in tts_with_preset().
+        """
+        settings = self.preset_settings(preset)
+        settings.update(kwargs)  # allow overriding of preset settings with kwargs
+        return self.continuous_tts(**settings)
+
+    def preset_settings(self, preset):
+        """
+        Returns the generation parameters used by the given preset. See tts_with_preset() for the options.
+        """
         # Use generally found best tuning knobs for generation.
         settings = {
             "temperature": 0.8,  # was 0.2
@@ -500,46 +782,8 @@ class TextToSpeech:
             "cond_free_k": 2.0,
             "diffusion_temperature": 1.0,
         }
-        # Presets are defined here.
-        presets = {
-            "single_sample": {
-                "num_autoregressive_samples": 8,
-                "diffusion_iterations": 10,
-                "sampler": "ddim",
-            },
-            "ultra_fast": {
-                "num_autoregressive_samples": 16,  # was 16
-                "diffusion_iterations": 15,  # was 10
-                "sampler": "ddim",
-            },
-            "ultra_fast_old": {
-                "num_autoregressive_samples": 16,
-                "diffusion_iterations": 30,
-                "cond_free": False,
-            },
-            "very_fast": {
-                "num_autoregressive_samples": 32,
-                "diffusion_iterations": 30,
-                "sampler": "dpm++2m",
-            },
-            "fast": {
-                "num_autoregressive_samples": 96,
-                "diffusion_iterations": 20,
-                "sampler": "dpm++2m",
-            },
-            "fast_old": {"num_autoregressive_samples": 96, "diffusion_iterations": 80},
-            "standard": {
-                "num_autoregressive_samples": 256,
-                "diffusion_iterations": 200,
-            },
-            "high_quality": {
-                "num_autoregressive_samples": 256,
-                "diffusion_iterations": 400,
-            },
-        }
-        settings.update(presets[preset])
-        settings.update(kwargs)  # allow overriding of preset settings with kwargs
-        return self.tts(text, **settings)
+        settings.update(PRESETS[preset])
+        return settings
 
     def tts(
         self,
@@ -558,8 +802,12 @@ class TextToSpeech:
         repetition_penalty=2.0,
         top_p=0.8,
         max_mel_tokens=500,
+        adaptive_sampling=False,
+        adaptive_margin=0.0,
+        adaptive_threshold=None,
         # CVVP parameters follow
         cvvp_amount=0.0,
+        conditioning_mels=None,
         # diffusion generation parameters follow
         diffusion_iterations=100,
         cond_free=True,
@@ -592,6 +840,12 @@ class TextToSpeech:
                                    of long silences or "uhhhhhhs", etc.
         :param top_p: P value used in nucleus sampling. (0,1]. Lower values mean the decoder produces more "likely" (aka boring) outputs.
         :param max_mel_tokens: Restricts the output length. (0,600] integer. Each unit is 1/20 of a second.
+        :param adaptive_sampling: When true, num_autoregressive_samples is an upper bound: each batch of samples is ranked
+                                  as soon as it is generated, and sampling stops once the ranking saturates.
+        :param adaptive_margin: Adaptive sampling stops when a batch raises the mean of the top k ranking scores by no
+                                more than this.
+        :param adaptive_threshold: Adaptive sampling also stops when the k-th best ranking score reaches this value.
+                                   Scores are CLVP's text-speech similarities (blended with CVVP's if cvvp_amount > 0).
         :param typical_sampling: Turns typical sampling on or off. This sampling mode is discussed in this paper: https://arxiv.org/abs/2202.00666
                                  I was interested in the premise, but the results were not as good as I was hoping. This is off by default, but
                                  could use some tuning.
@@ -599,6 +853,9 @@ class TextToSpeech:
         ~~CLVP-CVVP KNOBS~~
         :param cvvp_amount: Controls the influence of the CVVP model in selecting the best output from the autoregressive model.
                             [0,1]. Values closer to 1 mean the CVVP model is more important, 0 disables the CVVP model.
+        :param conditioning_mels: The voice's CVVP conditioning mels, as returned by get_conditioning_latents(return_mels=True),
+                                  to go with conditioning_latents. Without them (or voice_samples) candidates are ranked by
+                                  CLVP alone.
         ~~DIFFUSION KNOBS~~
         :param diffusion_iterations: Number of diffusion steps to perform. [0,4000]. More steps means the network has more chances to iteratively refine
                                      the output, which should theoretically mean a higher quality output. Generally a value above 250 is not noticeably better,
@@ -644,6 +901,8 @@ class TextToSpeech:
             )
         elif conditioning_latents is not None:
             auto_conditioning, diffusion_conditioning = conditioning_latents
+            if conditioning_mels is not None:
+                auto_conds = conditioning_mels.to(self.device)
         else:
             (
                 auto_conditioning,
@@ -659,140 +918,331 @@ class TextToSpeech:
             sampler=sampler,
         )
 
-        # in the case of single_sample,
-        orig_batch_size = self.autoregressive_batch_size
-        while num_autoregressive_samples % self.autoregressive_batch_size:
-            self.autoregressive_batch_size //= 2
         with torch.no_grad():
-            samples = []
-            num_batches = num_autoregressive_samples // self.autoregressive_batch_size
-            stop_mel_token = self.autoregressive.stop_mel_token
-            calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
-            self.autoregressive = self.autoregressive.to(self.device)
-            if verbose:
-                print("Generating autoregressive samples..")
-            with self.temporary_cuda(
-                self.autoregressive
-            ) as autoregressive, torch.autocast(
-                device_type="cuda", dtype=torch.float16, enabled=half
-            ):
-                for b in tqdm(range(num_batches), disable=not verbose):
+            best_results, best_latents = self.autoregressive_stage(
+                text_tokens,
+                auto_conditioning,
+                auto_conds=auto_conds,
+                k=k,
+                verbose=verbose,
+                num_autoregressive_samples=num_autoregressive_samples,
+                temperature=temperature,
+                length_penalty=length_penalty,
+                repetition_penalty=repetition_penalty,
+                top_p=top_p,
+                max_mel_tokens=max_mel_tokens,
+                adaptive_sampling=adaptive_sampling,
+                adaptive_margin=adaptive_margin,
+                adaptive_threshold=adaptive_threshold,
+                cvvp_amount=cvvp_amount,
+                half=half,
+                **hf_generate_kwargs,
+            )
+            del auto_conditioning
+
+            wav_candidates = self.diffusion_stage(
+                text,
+                best_results,
+                best_latents,
+                diffusion_conditioning,
+                diffuser,
+                diffusion_temperature=diffusion_temperature,
+                half=half,
+                verbose=verbose,
+            )
+
+            if len(wav_candidates) > 1:
+                res = wav_candidates
+            else:
+                res = wav_candidates[0]
+
+            if return_deterministic_state:
+                return res, (
+                    deterministic_seed,
+                    text,
+                    voice_samples,
+                    conditioning_latents,
+                )
+            else:
+                return res
+
+    def rank_candidates(
+        self, clvp, text_tokens, codes, auto_conds=None, cvvp_amount=0.0
+    ):
+        """
+        Fixes up a batch of sampled codes in place (see fix_autoregressive_output()) and returns their ranking scores:
+        CLVP's, blended with CVVP's by cvvp_amount when the voice's conditioning mels are given.
+        """
+        stop_mel_token = self.autoregressive.stop_mel_token
+        for i in range(codes.shape[0]):
+            codes[i] = fix_autoregressive_output(codes[i], stop_mel_token)
+        if cvvp_amount != 1:
+            clvp_res = clvp(
+                text_tokens.repeat(codes.shape[0], 1),
+                codes,
+                return_loss=False,
+            )
+        if auto_conds is None or cvvp_amount == 0:
+            return clvp_res
+        cvvp_accumulator = 0
+        for cl in range(auto_conds.shape[1]):
+            cvvp_accumulator = cvvp_accumulator + self.cvvp(
+                auto_conds[:, cl].repeat(codes.shape[0], 1, 1),
+                codes,
+                return_loss=False,
+            )
+        cvvp = cvvp_accumulator / auto_conds.shape[1]
+        if cvvp_amount == 1:
+            return cvvp
+        return cvvp * cvvp_amount + clvp_res * (1 - cvvp_amount)
+
+    @staticmethod
+    def candidates_saturated(clip_results, k, margin, threshold=None):
+        """
+        Whether adaptive sampling can stop, given the ranking scores of the batches sampled so far: either the k-th
+        best score reached threshold, or the mean of the top k scores rose by no more than margin with the last batch.
+        """
+        scores = torch.cat(clip_results, dim=0)
+        if scores.shape[0] < k:
+            return False
+        top = torch.topk(scores, k=k).values
+        if threshold is not None and top[-1].item() >= threshold:
+            return True
+        previous = scores[: -clip_results[-1].shape[0]]
+        if previous.shape[0] < k:
+            return False
+        improvement = top.mean() - torch.topk(previous, k=k).values.mean()
+        return improvement.item() <= margin
+
+    def autoregressive_stage(
+        self,
+        text_tokens,
+        auto_conditioning,
+        auto_conds=None,
+        k=1,
+        verbose=True,
+        num_autoregressive_samples=512,
+        temperature=0.8,
+        length_penalty=1,
+        repetition_penalty=2.0,
+        top_p=0.8,
+        max_mel_tokens=500,
+        adaptive_sampling=False,
+        adaptive_margin=0.0,
+        adaptive_threshold=None,
+        cvvp_amount=0.0,
+        half=True,
+        **hf_generate_kwargs,
+    ):
+        """
+        First half of tts(): samples candidate codes from the autoregressive model, keeps the k best according to
+        CLVP (and optionally CVVP), along with the autoregressive latents the diffusion model needs for them. The
+        latents are recorded while sampling when they fit in MAX_RETAINED_LATENT_BYTES and the model samples with
+        sample_codes(), i.e. it was set up with use_deepspeed=False. Otherwise (always with DeepSpeed) they are
+        re-produced with a second forward pass, the latent_reforward stage.
+        Parameters are the same as tts(). Must be called under torch.no_grad().
+        :return: Tuple of (best_results, best_latents).
+        """
+        batch_size = self.autoregressive_batch_size
+        while num_autoregressive_samples % batch_size:
+            batch_size //= 2
+        samples = []
+        clip_results = []
+        num_batches = num_autoregressive_samples // batch_size
+        stop_mel_token = self.autoregressive.stop_mel_token
+        # Adaptive sampling only keeps the latents of the k best candidates so far, otherwise those of every candidate
+        # are kept on the host until CLVP has ranked them all.
+        retain_latents = adaptive_sampling or (
+            num_autoregressive_samples
+            * (max_mel_tokens + len(LATENT_TRAILING_TOKENS))
+            * self.autoregressive.model_dim
+            * 4
+            <= MAX_RETAINED_LATENT_BYTES
+        )
+        sample_latents = []
+        # Indices among all samples of the candidates whose latents adaptive sampling keeps.
+        kept_indices = None
+        # Every batch is sampled after the same conditioning and text, so their KV cache is computed once.
+        prefix_cache = {}
+        if cvvp_amount > 0 and self.cvvp is None:
+            self.load_cvvp()
+        if verbose:
+            print("Generating autoregressive samples..")
+            if self.cvvp is None or cvvp_amount == 0:
+                print("Computing best candidates using CLVP")
+            else:
+                print(
+                    f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%"
+                )
+        with self.temporary_cuda(
+            self.autoregressive
+        ) as autoregressive, torch.autocast(
+            device_type="cuda", dtype=torch.float16, enabled=half
+        ), (
+            # Adaptive sampling ranks every batch as soon as it is sampled, so CLVP stays on the device too.
+            self.temporary_cuda(self.clvp)
+            if adaptive_sampling
+            else nullcontext()
+        ) as clvp:
+            if adaptive_sampling and cvvp_amount > 0:
+                self.cvvp = self.cvvp.to(self.device)
+            for b in tqdm(range(num_batches), disable=not verbose):
+                self.check_cancelled()
+                with self.timed_stage("autoregressive"):
                     codes = autoregressive.inference_speech(
                         auto_conditioning,
                         text_tokens,
                         do_sample=True,
                         top_p=top_p,
                         temperature=temperature,
-                        num_return_sequences=self.autoregressive_batch_size,
+                        num_return_sequences=batch_size,
                         length_penalty=length_penalty,
                         repetition_penalty=repetition_penalty,
                         max_generate_length=max_mel_tokens,
+                        return_latent=retain_latents,
+                        trailing_tokens=LATENT_TRAILING_TOKENS,
+                        prefix_cache=prefix_cache,
                         **hf_generate_kwargs,
                     )
+                    if retain_latents:
+                        codes, latents = codes
+                        # None when the model sampled with generate(), which does not keep them.
+                        retain_latents = latents is not None
                     padding_needed = max_mel_tokens - codes.shape[1]
                     codes = F.pad(codes, (0, padding_needed), value=stop_mel_token)
-                    samples.append(codes)
-            self.autoregressive_batch_size = (
-                orig_batch_size  # in the case of single_sample
-            )
-
-            clip_results = []
-            with self.temporary_cuda(self.clvp) as clvp, torch.autocast(
-                device_type="cuda", dtype=torch.float16, enabled=half
-            ):
-                if cvvp_amount > 0:
-                    if self.cvvp is None:
-                        self.load_cvvp()
-                    self.cvvp = self.cvvp.to(self.device)
-                if verbose:
-                    if self.cvvp is None:
-                        print("Computing best candidates using CLVP")
-                    else:
-                        print(
-                            f"Computing best candidates using CLVP {((1-cvvp_amount) * 100):2.0f}% and CVVP {(cvvp_amount * 100):2.0f}%"
+                samples.append(codes)
+                if retain_latents and not adaptive_sampling:
+                    sample_latents.append(pad_latents(latents, max_mel_tokens).cpu())
+                if not adaptive_sampling:
+                    continue
+                with self.timed_stage("clvp"):
+                    clip_results.append(
+                        self.rank_candidates(
+                            clvp, text_tokens, codes, auto_conds, cvvp_amount
                         )
-                for batch in tqdm(samples, disable=not verbose):
-                    for i in range(batch.shape[0]):
-                        batch[i] = fix_autoregressive_output(batch[i], stop_mel_token)
-                    if cvvp_amount != 1:
-                        clvp_res = clvp(
-                            text_tokens.repeat(batch.shape[0], 1),
-                            batch,
-                            return_loss=False,
+                    )
+                if retain_latents:
+                    scores = torch.cat(clip_results, dim=0)
+                    indices = torch.arange(
+                        scores.shape[0] - batch_size,
+                        scores.shape[0],
+                        device=scores.device,
+                    )
+                    latents = pad_latents(latents, max_mel_tokens)
+                    if kept_indices is not None:
+                        indices = torch.cat([kept_indices, indices])
+                        latents = torch.cat([sample_latents[0], latents])
+                    top = torch.topk(
+                        scores[indices], k=min(k, indices.shape[0])
+                    ).indices
+                    kept_indices = indices[top]
+                    sample_latents = [latents[top]]
+                if self.candidates_saturated(
+                    clip_results, k, adaptive_margin, adaptive_threshold
+                ):
+                    if verbose:
+                        print(
+                            f"CLVP scores saturated after {len(samples) * batch_size} samples"
                         )
-                    if auto_conds is not None and cvvp_amount > 0:
-                        cvvp_accumulator = 0
-                        for cl in range(auto_conds.shape[1]):
-                            cvvp_accumulator = cvvp_accumulator + self.cvvp(
-                                auto_conds[:, cl].repeat(batch.shape[0], 1, 1),
-                                batch,
-                                return_loss=False,
-                            )
-                        cvvp = cvvp_accumulator / auto_conds.shape[1]
-                        if cvvp_amount == 1:
-                            clip_results.append(cvvp)
-                        else:
-                            clip_results.append(
-                                cvvp * cvvp_amount + clvp_res * (1 - cvvp_amount)
+                    break
+
+        with self.timed_stage("clvp"):
+            if not adaptive_sampling:
+                with self.temporary_cuda(self.clvp) as clvp, torch.autocast(
+                    device_type="cuda", dtype=torch.float16, enabled=half
+                ):
+                    if cvvp_amount > 0:
+                        self.cvvp = self.cvvp.to(self.device)
+                    for batch in tqdm(samples, disable=not verbose):
+                        clip_results.append(
+                            self.rank_candidates(
+                                clvp, text_tokens, batch, auto_conds, cvvp_amount
                             )
-                    else:
-                        clip_results.append(clvp_res)
-                clip_results = torch.cat(clip_results, dim=0)
-                samples = torch.cat(samples, dim=0)
-                best_results = samples[torch.topk(clip_results, k=k).indices]
-            if self.cvvp is not None:
-                self.cvvp = self.cvvp.cpu()
-            del samples
-
-            # The diffusion model actually wants the last hidden layer from the autoregressive model as conditioning
-            # inputs. Re-produce those for the top results. This could be made more efficient by storing all of these
-            # results, but will increase memory usage.
-            with self.temporary_cuda(
-                self.autoregressive
-            ) as autoregressive, torch.autocast(
-                device_type="cuda", dtype=torch.float16, enabled=half
-            ):
-                best_latents = autoregressive(
-                    auto_conditioning.repeat(k, 1),
-                    text_tokens.repeat(k, 1),
-                    torch.tensor([text_tokens.shape[-1]], device=text_tokens.device),
-                    best_results,
-                    torch.tensor(
-                        [
-                            best_results.shape[-1]
-                            * self.autoregressive.mel_length_compression
-                        ],
-                        device=text_tokens.device,
-                    ),
-                    return_latent=True,
-                    clip_inputs=False,
-                )
-            del auto_conditioning
+                        )
+            clip_results = torch.cat(clip_results, dim=0)
+            samples = torch.cat(samples, dim=0)
+            if not retain_latents:
+                best = torch.topk(clip_results, k=k).indices
+            elif kept_indices is not None:
+                top = torch.topk(clip_results[kept_indices], k=k).indices
+                best = kept_indices[top]
+                best_latents = sample_latents[0][top]
+            else:
+                best = torch.topk(clip_results, k=k).indices
+                best_latents = torch.cat(sample_latents, dim=0)[best.cpu()]
+            best_results = samples[best]
+        if self.cvvp is not None:
+            self.cvvp = self.cvvp.cpu()
+        del samples, sample_latents, prefix_cache
+        if retain_latents:
+            return best_results, best_latents.to(self.device)
 
-            if verbose:
-                print("Transforming autoregressive outputs into audio..")
-            wav_candidates = []
-            with self.temporary_cuda(self.diffusion) as diffusion, self.temporary_cuda(
-                self.vocoder
-            ) as vocoder:
-                diffusion.enable_fp16 = half  # hacky
-                for b in range(best_results.shape[0]):
-                    codes = best_results[b].unsqueeze(0)
-                    latents = best_latents[b].unsqueeze(0)
-
-                    # Find the first occurrence of the "calm" token and trim the codes to that.
-                    ctokens = 0
-                    for k in range(codes.shape[-1]):
-                        if codes[0, k] == calm_token:
-                            ctokens += 1
-                        else:
-                            ctokens = 0
-                        if (
-                            ctokens > 8
-                        ):  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
-                            latents = latents[:, :k]
-                            break
+        # The diffusion model actually wants the last hidden layer from the autoregressive model as conditioning
+        # inputs. When those were not kept while sampling, re-produce them for the top results.
+        with self.timed_stage("latent_reforward"), self.temporary_cuda(
+            self.autoregressive
+        ) as autoregressive, torch.autocast(
+            device_type="cuda", dtype=torch.float16, enabled=half
+        ):
+            best_latents = autoregressive(
+                auto_conditioning.repeat(k, 1),
+                text_tokens.repeat(k, 1),
+                torch.tensor([text_tokens.shape[-1]], device=text_tokens.device),
+                best_results,
+                torch.tensor(
+                    [
+                        best_results.shape[-1]
+                        * self.autoregressive.mel_length_compression
+                    ],
+                    device=text_tokens.device,
+                ),
+                return_latent=True,
+                clip_inputs=False,
+            )
+        return best_results, best_latents
 
+    def diffusion_stage(
+        self,
+        text,
+        best_results,
+        best_latents,
+        diffusion_conditioning,
+        diffuser,
+        diffusion_temperature=1.0,
+        half=True,
+        verbose=True,
+    ):
+        """
+        Second half of tts(): turns the output of autoregressive_stage() into audio with the diffusion model and the
+        vocoder, then applies redaction. Must be called under torch.no_grad().
+        :return: List of generated audio clips, one per candidate.
+        """
+        calm_token = 83  # This is the token for coding silence, which is fixed in place with "fix_autoregressive_output"
+        if verbose:
+            print("Transforming autoregressive outputs into audio..")
+        wav_candidates = []
+        with self.temporary_cuda(self.diffusion) as diffusion, self.temporary_cuda(
+            self.vocoder
+        ) as vocoder:
+            diffusion.enable_fp16 = half  # hacky
+            for b in range(best_results.shape[0]):
+                codes = best_results[b].unsqueeze(0)
+                latents = best_latents[b].unsqueeze(0)
+
+                # Find the first occurrence of the "calm" token and trim the codes to that.
+                ctokens = 0
+                for k in range(codes.shape[-1]):
+                    if codes[0, k] == calm_token:
+                        ctokens += 1
+                    else:
+                        ctokens = 0
+                    if (
+                        ctokens > 8
+                    ):  # 8 tokens gives the diffusion model some "breathing room" to terminate speech.
+                        latents = latents[:, :k]
+                        break
+
+                with self.timed_stage("diffusion"):
                     mel = do_spectrogram_diffusion(
                         diffusion,
                         diffuser,
@@ -800,34 +1250,751 @@ class TextToSpeech:
                         diffusion_conditioning,
                         temperature=diffusion_temperature,
                         verbose=verbose,
+                        cancel_check=self.check_cancelled,
                     )
+                with self.timed_stage("vocoder"):
                     wav = vocoder.inference(mel)
-                    wav_candidates.append(wav.cpu())
+                wav_candidates.append(wav.cpu())
 
-            def potentially_redact(clip, text):
-                if self.enable_redaction:
+        def potentially_redact(clip, text):
+            if self.enable_redaction:
+                with self.timed_stage("redaction"):
                     return self.aligner.redact(clip.squeeze(1), text).unsqueeze(1)
-                return clip
+            return clip
 
-            wav_candidates = [
-                potentially_redact(wav_candidate, text)
-                for wav_candidate in wav_candidates
-            ]
+        return [
+            potentially_redact(wav_candidate, text) for wav_candidate in wav_candidates
+        ]
 
-            if len(wav_candidates) > 1:
-                res = wav_candidates
-            else:
-                res = wav_candidates[0]
+    def tts_long(
+        self,
+        text,
+        voice_samples=None,
+        conditioning_latents=None,
+        crossfade=0.05,
+        verbose=True,
+        use_deterministic_seed=None,
+        latent_averaging_mode=0,
+        # autoregressive generation parameters follow
+        num_autoregressive_samples=512,
+        temperature=0.8,
+        length_penalty=1,
+        repetition_penalty=2.0,
+        top_p=0.8,
+        max_mel_tokens=500,
+        adaptive_sampling=False,
+        adaptive_margin=0.0,
+        adaptive_threshold=None,
+        # CVVP parameters follow
+        cvvp_amount=0.0,
+        conditioning_mels=None,
+        # diffusion generation parameters follow
+        diffusion_iterations=100,
+        cond_free=True,
+        cond_free_k=2,
+        diffusion_temperature=1.0,
+        sampler="ddim",
+        half=True,
+        original_tortoise=False,
+        **hf_generate_kwargs,
+    ):
+        """
+        Produces an audio clip for text of any length. The text is split into sentence-sized segments which are run
+        through a two-stage pipeline: a worker thread does autoregressive sampling and CLVP ranking for the next segment
+        while the calling thread runs diffusion and the vocoder on the current one. Segments are joined in memory with
+        a short linear crossfade.
+        :param crossfade: Length of the crossfade between segments, in seconds.
+        Other parameters are the same as tts(), except that only the best clip is produced (k=1).
+        :return: Generated audio clip as a torch tensor of shape (1,1,S). Sample rate is 24kHz.
+        """
+        segments = split_and_recombine_text(text)
+        if len(segments) <= 1:
+            return self.tts(
+                text,
+                voice_samples=voice_samples,
+                conditioning_latents=conditioning_latents,
+                verbose=verbose,
+                use_deterministic_seed=use_deterministic_seed,
+                latent_averaging_mode=latent_averaging_mode,
+                num_autoregressive_samples=num_autoregressive_samples,
+                temperature=temperature,
+                length_penalty=length_penalty,
+                repetition_penalty=repetition_penalty,
+                top_p=top_p,
+                max_mel_tokens=max_mel_tokens,
+                adaptive_sampling=adaptive_sampling,
+                adaptive_margin=adaptive_margin,
+                adaptive_threshold=adaptive_threshold,
+                cvvp_amount=cvvp_amount,
+                conditioning_mels=conditioning_mels,
+                diffusion_iterations=diffusion_iterations,
+                cond_free=cond_free,
+                cond_free_k=cond_free_k,
+                diffusion_temperature=diffusion_temperature,
+                sampler=sampler,
+                half=half,
+                original_tortoise=original_tortoise,
+                **hf_generate_kwargs,
+            )
 
-            if return_deterministic_state:
-                return res, (
-                    deterministic_seed,
-                    text,
-                    voice_samples,
-                    conditioning_latents,
+        seed = self.deterministic_state(seed=use_deterministic_seed)
+
+        auto_conds = None
+        if voice_samples is not None:
+            (
+                auto_conditioning,
+                diffusion_conditioning,
+                auto_conds,
+                _,
+            ) = self.get_conditioning_latents(
+                voice_samples,
+                return_mels=True,
+                latent_averaging_mode=latent_averaging_mode,
+                original_tortoise=original_tortoise,
+            )
+        elif conditioning_latents is not None:
+            auto_conditioning, diffusion_conditioning = conditioning_latents
+            if conditioning_mels is not None:
+                auto_conds = conditioning_mels.to(self.device)
+        else:
+            (
+                auto_conditioning,
+                diffusion_conditioning,
+            ) = self.get_random_conditioning_latents()
+        auto_conditioning = auto_conditioning.to(self.device)
+        diffusion_conditioning = diffusion_conditioning.to(self.device)
+
+        segment_tokens = []
+        for segment in segments:
+            text_tokens = (
+                torch.IntTensor(self.tokenizer.encode(segment))
+                .unsqueeze(0)
+                .to(self.device)
+            )
+            text_tokens = F.pad(text_tokens, (0, 1))
+            assert (
+                text_tokens.shape[-1] < 400
+            ), "Too much text provided in one segment. Add punctuation to the text and re-try inference."
+            segment_tokens.append(text_tokens)
+
+        diffuser = load_discrete_vocoder_diffuser(
+            desired_diffusion_steps=diffusion_iterations,
+            cond_free=cond_free,
+            cond_free_k=cond_free_k,
+            sampler=sampler,
+        )
+        # Diffusion runs alongside the autoregressive worker, which keeps the global RNG to itself. Drawing from a
+        # generator of its own, each stage sees the same random numbers for a given seed whatever the timing.
+        diffuser.generator = torch.Generator(device=self.device).manual_seed(seed)
+
+        # The autoregressive worker runs ahead of diffusion by at most one segment, so only one pair of
+        # (codes, latents) is held in memory besides the one being decoded.
+        stage_outputs = Queue(maxsize=1)
+        stop = threading.Event()
+
+        def autoregressive_worker():
+            try:
+                with torch.no_grad():
+                    for text_tokens in segment_tokens:
+                        if stop.is_set():
+                            return
+                        stage_outputs.put(
+                            self.autoregressive_stage(
+                                text_tokens,
+                                auto_conditioning,
+                                auto_conds=auto_conds,
+                                verbose=verbose,
+                                num_autoregressive_samples=num_autoregressive_samples,
+                                temperature=temperature,
+                                length_penalty=length_penalty,
+                                repetition_penalty=repetition_penalty,
+                                top_p=top_p,
+                                max_mel_tokens=max_mel_tokens,
+                                adaptive_sampling=adaptive_sampling,
+                                adaptive_margin=adaptive_margin,
+                                adaptive_threshold=adaptive_threshold,
+                                cvvp_amount=cvvp_amount,
+                                half=half,
+                                **hf_generate_kwargs,
+                            )
+                        )
+            except Exception as e:
+                stage_outputs.put(e)
+
+        worker = threading.Thread(target=autoregressive_worker, daemon=True)
+        worker.start()
+        clips = []
+        try:
+            with torch.no_grad():
+                for segment in segments:
+                    output = stage_outputs.get()
+                    if isinstance(output, Exception):
+                        raise output
+                    best_results, best_latents = output
+                    clips.append(
+                        self.diffusion_stage(
+                            segment,
+                            best_results,
+                            best_latents,
+                            diffusion_conditioning,
+                            diffuser,
+                            diffusion_temperature=diffusion_temperature,
+                            half=half,
+                            verbose=verbose,
+                        )[0]
+                    )
+                    del best_results, best_latents
+        finally:
+            stop.set()
+            # Unblock the worker if it is waiting to hand over a segment nobody will consume.
+            while worker.is_alive():
+                while not stage_outputs.empty():
+                    stage_outputs.get_nowait()
+                worker.join(timeout=0.1)
+
+        return crossfade_clips(clips, int(crossfade * 24000))
+
+    def continuous_autoregressive_batch(
+        self,
+        text_tokens,
+        auto_conditioning,
+        auto_conds=None,
+        verbose=True,
+        num_autoregressive_samples=512,
+        batch_size=16,
+        temperature=0.8,
+        length_penalty=1,
+        repetition_penalty=2.0,
+        top_p=0.8,
+        max_mel_tokens=500,
+        adaptive_sampling=False,
+        adaptive_margin=0.0,
+        adaptive_threshold=None,
+        cvvp_amount=0.0,
+        half=True,
+        **hf_generate_kwargs,
+    ):
+        """
+        Autoregressive sampling and CLVP (and CVVP) ranking of tts_batch() with iteration-level batching (see
+        ContinuousSampler): each text's candidates are requested in batches of batch_size, and whenever candidates
+        finish, their slots go to the next waiting batch, whichever text it is for. A text with long candidates thus
+        no longer holds up the others. Each batch is ranked by CLVP as soon as all of its candidates are done, and
+        only the best candidate of each text is kept, with its latents. With adaptive sampling, the batches of a
+        text whose ranking saturated are dropped while the other texts go on. auto_conds holds the CVVP conditioning
+        mels of each text, or is None if cvvp_amount is 0. Only the given texts share the slots; ContinuousTTS keeps
+        the sampler running across calls and takes new texts while it runs.
+        Must be called under torch.no_grad().
+        :return: Tuple of (best_results, best_latents) lists with one entry per text, or None if the autoregressive
+                 model cannot sample this way with these parameters.
+        """
+        engine = self.autoregressive.continuous_sampler(
+            batch_size * len(text_tokens),
+            max_generate_length=max_mel_tokens,
+            return_latent=True,
+            trailing_tokens=LATENT_TRAILING_TOKENS,
+            do_sample=True,
+            top_p=top_p,
+            temperature=temperature,
+            length_penalty=length_penalty,
+            repetition_penalty=repetition_penalty,
+            **hf_generate_kwargs,
+        )
+        if engine is None:
+            return None
+        stop_mel_token = self.autoregressive.stop_mel_token
+        num_batches = num_autoregressive_samples // batch_size
+        # (score, codes, latents) of the best candidate of each text so far.
+        best = [None for _ in text_tokens]
+        clip_results = [[] for _ in text_tokens]
+        if verbose:
+            print(
+                f"Generating autoregressive samples for {len(text_tokens)} texts, ranking them using CLVP.."
+            )
+        with self.temporary_cuda(
+            self.autoregressive
+        ), self.temporary_cuda(self.clvp) as clvp, torch.autocast(
+            device_type="cuda", dtype=torch.float16, enabled=half
+        ), tqdm(
+            total=num_batches * len(text_tokens), disable=not verbose
+        ) as progress:
+            # Interleaved, so that the texts are sampled side by side.
+            for b in range(num_batches):
+                for i, (conditioning, tokens) in enumerate(
+                    zip(auto_conditioning, text_tokens)
+                ):
+                    engine.submit((i, b), conditioning, tokens, batch_size, prompt_key=i)
+            while engine.busy():
+                # Timed from one finished batch to the next rather than per token, since timing synchronizes the
+                # device.
+                with self.timed_stage("autoregressive"):
+                    finished = []
+                    while engine.busy() and not finished:
+                        self.check_cancelled()
+                        finished = engine.step()
+                for (i, _), codes, latents in finished:
+                    progress.update()
+                    with self.timed_stage("clvp"):
+                        codes = F.pad(
+                            codes,
+                            (0, max_mel_tokens - codes.shape[1]),
+                            value=stop_mel_token,
+                        )
+                        scores = self.rank_candidates(
+                            clvp,
+                            text_tokens[i],
+                            codes,
+                            None if auto_conds is None else auto_conds[i],
+                            cvvp_amount,
+                        )
+                    clip_results[i].append(scores)
+                    top = torch.argmax(scores).item()
+                    if best[i] is None or scores[top] > best[i][0]:
+                        best[i] = (
+                            scores[top],
+                            codes[top : top + 1],
+                            pad_latents(latents[top : top + 1], max_mel_tokens),
+                        )
+                    if adaptive_sampling and self.candidates_saturated(
+                        clip_results[i], 1, adaptive_margin, adaptive_threshold
+                    ):
+                        engine.drop(i)
+        return [codes for _, codes, _ in best], [latents for _, _, latents in best]
+
+    def continuous_tts(
+        self,
+        max_batches=4,
+        crossfade=0.05,
+        verbose=True,
+        # autoregressive generation parameters follow
+        num_autoregressive_samples=512,
+        temperature=0.8,
+        length_penalty=1,
+        repetition_penalty=2.0,
+        top_p=0.8,
+        max_mel_tokens=500,
+        adaptive_sampling=False,
+        adaptive_margin=0.0,
+        adaptive_threshold=None,
+        # CVVP parameters follow
+        cvvp_amount=0.0,
+        # diffusion generation parameters follow
+        diffusion_iterations=100,
+        cond_free=True,
+        cond_free_k=2,
+        diffusion_temperature=1.0,
+        sampler="ddim",
+        half=True,
+        **hf_generate_kwargs,
+    ):
+        """
+        Returns a ContinuousTTS generating with these parameters, which takes new requests while it runs, or None if
+        the autoregressive model cannot sample that way with these parameters (e.g. on DeepSpeed).
+        :param max_batches: Number of batches of candidates sampled at once. The sampler has this many times the
+                            autoregressive batch size in slots.
+        Other parameters are the same as tts_long(). Generation is not seeded: requests are sampled side by side, so
+        what each one draws from the random number generator depends on the others.
+        """
+        batch_size = self.autoregressive_batch_size
+        while num_autoregressive_samples % batch_size:
+            batch_size //= 2
+        engine = self.autoregressive.continuous_sampler(
+            batch_size * max_batches,
+            max_generate_length=max_mel_tokens,
+            return_latent=True,
+            trailing_tokens=LATENT_TRAILING_TOKENS,
+            do_sample=True,
+            top_p=top_p,
+            temperature=temperature,
+            length_penalty=length_penalty,
+            repetition_penalty=repetition_penalty,
+            **hf_generate_kwargs,
+        )
+        if engine is None:
+            return None
+        if cvvp_amount > 0 and self.cvvp is None:
+            self.load_cvvp()
+        diffuser = load_discrete_vocoder_diffuser(
+            desired_diffusion_steps=diffusion_iterations,
+            cond_free=cond_free,
+            cond_free_k=cond_free_k,
+            sampler=sampler,
+        )
+        return ContinuousTTS(
+            self,
+            engine,
+            diffuser,
+            batch_size=batch_size,
+            num_batches=num_autoregressive_samples // batch_size,
+            max_batches=max_batches,
+            max_mel_tokens=max_mel_tokens,
+            adaptive_sampling=adaptive_sampling,
+            adaptive_margin=adaptive_margin,
+            adaptive_threshold=adaptive_threshold,
+            cvvp_amount=cvvp_amount,
+            diffusion_temperature=diffusion_temperature,
+            half=half,
+            crossfade=crossfade,
+            verbose=verbose,
+        )
+
+    def tts_batch(
+        self,
+        texts,
+        conditioning_latents,
+        conditioning_mels=None,
+        verbose=True,
+        use_deterministic_seed=None,
+        # autoregressive generation parameters follow
+        num_autoregressive_samples=512,
+        temperature=0.8,
+        length_penalty=1,
+        repetition_penalty=2.0,
+        top_p=0.8,
+        max_mel_tokens=500,
+        adaptive_sampling=False,
+        adaptive_margin=0.0,
+        adaptive_threshold=None,
+        # CVVP parameters follow
+        cvvp_amount=0.0,
+        # diffusion generation parameters follow
+        diffusion_iterations=100,
+        cond_free=True,
+        cond_free_k=2,
+        diffusion_temperature=1.0,
+        sampler="ddim",
+        half=True,
+        **hf_generate_kwargs,
+    ):
+        """
+        Produces one audio clip per text, running all of the texts through the models together.
+        :param texts: List of texts to be spoken.
+        :param conditioning_latents: List of (autoregressive_conditioning_latent, diffusion_conditioning_latent) tuples,
+                                     one per text. Conditioning latents can be retrieved via get_conditioning_latents().
+        :param conditioning_mels: List of the voices' CVVP conditioning mels, one per text, as returned by
+                                  get_conditioning_latents(return_mels=True). Required when cvvp_amount > 0. Texts whose
+                                  entry is None (voices stored as latents only) are ranked by CLVP alone.
+        Autoregressive sampling runs as a single batch across all texts, and so do diffusion and vocoding for texts
+        whose clips come out of similar length (see diffuse_batch()). CLVP and CVVP ranking (and the latent
+        re-forward, when the latents are not kept while sampling) is done per text, since each text is only compared
+        against its own candidates. Only the best candidate of each text is returned. When the autoregressive model
+        supports it, sampling and ranking go through continuous_autoregressive_batch() instead, which shares the
+        sampling slots between the texts as their candidates finish. The texts are fixed for the whole call: nothing
+        is added to a batch once it runs (see continuous_tts() for generation that takes new texts while it runs).
+        All other parameters are the same as tts().
+        :return: List of generated audio clips, one per text, shaped like the k=1 output of tts(). Sample rate is 24kHz.
+        """
+        self.deterministic_state(seed=use_deterministic_seed)
+
+        text_tokens = []
+        for text in texts:
+            tokens = (
+                torch.IntTensor(self.tokenizer.encode(text))
+                .unsqueeze(0)
+                .to(self.device)
+            )
+            tokens = F.pad(tokens, (0, 1))  # This may not be necessary.
+            assert (
+                tokens.shape[-1] < 400
+            ), "Too much text provided. Break the text up into separate segments and re-try inference."
+            text_tokens.append(tokens)
+
+        auto_conditioning = [latents[0].to(self.device) for latents in conditioning_latents]
+        diffusion_conditioning = torch.cat(
+            [latents[1].to(self.device) for latents in conditioning_latents], dim=0
+        )
+
+        diffuser = load_discrete_vocoder_diffuser(
+            desired_diffusion_steps=diffusion_iterations,
+            cond_free=cond_free,
+            cond_free_k=cond_free_k,
+            sampler=sampler,
+        )
+
+        if cvvp_amount > 0:
+            if conditioning_mels is None:
+                raise ValueError(
+                    "cvvp_amount > 0 needs the conditioning_mels of every text"
                 )
+            if self.cvvp is None:
+                self.load_cvvp()
+            conditioning_mels = [
+                None if mels is None else mels.to(self.device)
+                for mels in conditioning_mels
+            ]
+            # Candidates may be ranked while others are still sampled, so CVVP stays on the device as long as CLVP.
+            self.cvvp = self.cvvp.to(self.device)
+        else:
+            conditioning_mels = [None for _ in texts]
+
+        batch_size = self.autoregressive_batch_size
+        while num_autoregressive_samples % batch_size:
+            batch_size //= 2
+        with torch.no_grad():
+            continuous = self.continuous_autoregressive_batch(
+                text_tokens,
+                auto_conditioning,
+                auto_conds=conditioning_mels,
+                verbose=verbose,
+                num_autoregressive_samples=num_autoregressive_samples,
+                batch_size=batch_size,
+                temperature=temperature,
+                length_penalty=length_penalty,
+                repetition_penalty=repetition_penalty,
+                top_p=top_p,
+                max_mel_tokens=max_mel_tokens,
+                adaptive_sampling=adaptive_sampling,
+                adaptive_margin=adaptive_margin,
+                adaptive_threshold=adaptive_threshold,
+                cvvp_amount=cvvp_amount,
+                half=half,
+                **hf_generate_kwargs,
+            )
+            if continuous is not None:
+                best_results, best_latents = continuous
             else:
-                return res
+                samples = [[] for _ in texts]
+                num_batches = num_autoregressive_samples // batch_size
+                stop_mel_token = self.autoregressive.stop_mel_token
+                # See autoregressive_stage() for which latents are kept.
+                retain_latents = adaptive_sampling or (
+                    len(texts)
+                    * num_autoregressive_samples
+                    * (max_mel_tokens + len(LATENT_TRAILING_TOKENS))
+                    * self.autoregressive.model_dim
+                    * 4
+                    <= MAX_RETAINED_LATENT_BYTES
+                )
+                sample_latents = [[] for _ in texts]
+                kept_indices = [None for _ in texts]
+                prefix_cache = {}
+                if verbose:
+                    print(f"Generating autoregressive samples for {len(texts)} texts..")
+                clip_results = [[] for _ in texts]
+                with self.temporary_cuda(
+                    self.autoregressive
+                ) as autoregressive, torch.autocast(
+                    device_type="cuda", dtype=torch.float16, enabled=half
+                ), (
+                    self.temporary_cuda(self.clvp)
+                    if adaptive_sampling
+                    else nullcontext()
+                ) as clvp:
+                    for b in tqdm(range(num_batches), disable=not verbose):
+                        self.check_cancelled()
+                        with self.timed_stage("autoregressive"):
+                            codes = autoregressive.inference_speech_batch(
+                                auto_conditioning,
+                                text_tokens,
+                                do_sample=True,
+                                top_p=top_p,
+                                temperature=temperature,
+                                num_return_sequences=batch_size,
+                                length_penalty=length_penalty,
+                                repetition_penalty=repetition_penalty,
+                                max_generate_length=max_mel_tokens,
+                                return_latent=retain_latents,
+                                trailing_tokens=LATENT_TRAILING_TOKENS,
+                                prefix_cache=prefix_cache,
+                                **hf_generate_kwargs,
+                            )
+                            if retain_latents:
+                                codes, latents = codes
+                                retain_latents = latents is not None
+                            padding_needed = max_mel_tokens - codes.shape[1]
+                            codes = F.pad(
+                                codes, (0, padding_needed), value=stop_mel_token
+                            )
+                        for i, text_codes in enumerate(codes.split(batch_size, dim=0)):
+                            samples[i].append(text_codes)
+                        if retain_latents:
+                            latents = pad_latents(latents, max_mel_tokens)
+                            if not adaptive_sampling:
+                                latents = latents.cpu()
+                            for i, text_latents in enumerate(
+                                latents.split(batch_size, dim=0)
+                            ):
+                                sample_latents[i].append(text_latents)
+                        if not adaptive_sampling:
+                            continue
+                        with self.timed_stage("clvp"):
+                            for i, (tokens, text_samples, text_results) in enumerate(
+                                zip(text_tokens, samples, clip_results)
+                            ):
+                                text_results.append(
+                                    self.rank_candidates(
+                                        clvp,
+                                        tokens,
+                                        text_samples[-1],
+                                        conditioning_mels[i],
+                                        cvvp_amount,
+                                    )
+                                )
+                                if not retain_latents:
+                                    continue
+                                # Keep the latents of the text's best candidate so far only.
+                                scores = torch.cat(text_results, dim=0)
+                                indices = torch.arange(
+                                    scores.shape[0] - batch_size,
+                                    scores.shape[0],
+                                    device=scores.device,
+                                )
+                                if kept_indices[i] is not None:
+                                    indices = torch.cat([kept_indices[i], indices])
+                                top = torch.topk(scores[indices], k=1).indices
+                                kept_indices[i] = indices[top]
+                                sample_latents[i] = [
+                                    torch.cat(sample_latents[i], dim=0)[top]
+                                ]
+                        # The texts are sampled together, so sampling goes on until every one of them has saturated.
+                        if all(
+                            self.candidates_saturated(
+                                text_results, 1, adaptive_margin, adaptive_threshold
+                            )
+                            for text_results in clip_results
+                        ):
+                            break
+
+                best_results = []
+                best_latents = []
+                with self.timed_stage("clvp"):
+                    if not adaptive_sampling:
+                        if verbose:
+                            print("Computing best candidates using CLVP")
+                        with self.temporary_cuda(self.clvp) as clvp, torch.autocast(
+                            device_type="cuda", dtype=torch.float16, enabled=half
+                        ):
+                            for tokens, mels, text_samples, text_results in zip(
+                                text_tokens, conditioning_mels, samples, clip_results
+                            ):
+                                for batch in text_samples:
+                                    text_results.append(
+                                        self.rank_candidates(
+                                            clvp, tokens, batch, mels, cvvp_amount
+                                        )
+                                    )
+                    for text_samples, text_results, text_latents, text_kept in zip(
+                        samples, clip_results, sample_latents, kept_indices
+                    ):
+                        text_samples = torch.cat(text_samples, dim=0)
+                        text_results = torch.cat(text_results, dim=0)
+                        if text_kept is not None:
+                            best = text_kept
+                        else:
+                            best = torch.topk(text_results, k=1).indices
+                        best_results.append(text_samples[best])
+                        if not retain_latents:
+                            continue
+                        text_latents = torch.cat(text_latents, dim=0)
+                        if text_kept is not None:
+                            best_latents.append(text_latents.to(self.device))
+                        else:
+                            best_latents.append(
+                                text_latents[best.cpu()].to(self.device)
+                            )
+                del samples, sample_latents, prefix_cache
+
+                # See autoregressive_stage() for why the latents are re-produced here when they were not kept.
+                if not retain_latents:
+                    with self.timed_stage("latent_reforward"), self.temporary_cuda(
+                        self.autoregressive
+                    ) as autoregressive, torch.autocast(
+                        device_type="cuda", dtype=torch.float16, enabled=half
+                    ):
+                        for conditioning, tokens, codes in zip(
+                            auto_conditioning, text_tokens, best_results
+                        ):
+                            best_latents.append(
+                                autoregressive(
+                                    conditioning,
+                                    tokens,
+                                    torch.tensor(
+                                        [tokens.shape[-1]], device=tokens.device
+                                    ),
+                                    codes,
+                                    torch.tensor(
+                                        [
+                                            codes.shape[-1]
+                                            * self.autoregressive.mel_length_compression
+                                        ],
+                                        device=tokens.device,
+                                    ),
+                                    return_latent=True,
+                                    clip_inputs=False,
+                                )
+                            )
+            del auto_conditioning, conditioning_mels
+            if self.cvvp is not None:
+                self.cvvp = self.cvvp.cpu()
+
+            trimmed_latents = [
+                trim_latents(codes, latents)
+                for codes, latents in zip(best_results, best_latents)
+            ]
+
+            if verbose:
+                print("Transforming autoregressive outputs into audio..")
+            wavs = self.diffuse_batch(
+                diffuser,
+                trimmed_latents,
+                diffusion_conditioning,
+                temperature=diffusion_temperature,
+                verbose=verbose,
+                half=half,
+            )
+
+            results = []
+            for text, wav in zip(texts, wavs):
+                if self.enable_redaction:
+                    with self.timed_stage("redaction"):
+                        wav = self.aligner.redact(wav.squeeze(1), text).unsqueeze(1)
+                results.append(wav)
+            return results
+
+    def diffuse_batch(
+        self,
+        diffuser,
+        latents,
+        diffusion_conditioning,
+        temperature=1.0,
+        verbose=True,
+        half=True,
+    ):
+        """
+        Turns the autoregressive latents of several clips into audio with the diffusion model and the vocoder. Clips of
+        similar length (see group_by_length()) are diffused and vocoded as one batch: the shorter ones are extended to
+        the longest with their trailing calm latents, and their audio is cut back to their own length afterwards.
+        :param latents: List of latents of shape (1, length, channels), one per clip, trimmed as in diffusion_stage().
+        :param diffusion_conditioning: The clips' diffusion conditioning latents, concatenated along the batch.
+        :return: List of audio clips of shape (1, 1, S), in the order of latents.
+        """
+        lengths = [clip_latents.shape[1] for clip_latents in latents]
+        wavs = [None for _ in latents]
+        with self.temporary_cuda(self.diffusion) as diffusion, self.temporary_cuda(
+            self.vocoder
+        ) as vocoder:
+            diffusion.enable_fp16 = half  # hacky
+            for indices in group_by_length(lengths):
+                length = max(lengths[i] for i in indices)
+                with self.timed_stage("diffusion"):
+                    mel = do_spectrogram_diffusion(
+                        diffusion,
+                        diffuser,
+                        torch.cat(
+                            [extend_latents(latents[i], length) for i in indices], dim=0
+                        ),
+                        diffusion_conditioning[indices],
+                        temperature=temperature,
+                        verbose=verbose,
+                        cancel_check=self.check_cancelled,
+                    )
+                with self.timed_stage("vocoder"):
+                    group_wavs = vocoder.inference(mel).cpu()
+                samples_per_frame = group_wavs.shape[-1] // mel.shape[-1]
+                for j, i in enumerate(indices):
+                    # The same frame count do_spectrogram_diffusion() gives a clip of this length on its own.
+                    frames = lengths[i] * 4 * 24000 // 22050
+                    wavs[i] = group_wavs[j : j + 1, :, : frames * samples_per_frame]
+        return wavs
 
     def deterministic_state(self, seed=None):
         """
@@ -841,3 +2008,364 @@ class TextToSpeech:
         # torch.use_deterministic_algorithms(True)
 
         return seed
+
+
+class ContinuousTTS:
+    """
+    Generation that takes new requests while it runs, created by TextToSpeech.continuous_tts(). A request is a list
+    of texts, each spoken with its own voice; texts longer than a sentence or two are split into segments as in
+    tts_long(). Every segment is its own prompt for a single ContinuousSampler, whose slots the candidates of all
+    requests share: as candidates finish, the slots go to the next batch of candidates, the texts taking turns, so
+    a request added while others run starts sampling with the next batch that finishes rather than after them.
+    Batches are ranked by CLVP (and CVVP) as soon as they are done, and with adaptive sampling a segment stops once
+    its ranking saturates. The best candidate of each segment is then diffused and vocoded, together with the other
+    segments that finished in the same step (see TextToSpeech.diffuse_batch()), and a request is returned once all
+    of its segments are, its texts' segments joined with a crossfade.
+    Use it as a context manager, which keeps the autoregressive model and CLVP on the device while it is open, add()
+    requests at any time and call step() while busy(). Must be used under torch.no_grad().
+    """
+
+    def __init__(
+        self,
+        tts,
+        engine,
+        diffuser,
+        batch_size,
+        num_batches,
+        max_batches,
+        max_mel_tokens,
+        adaptive_sampling,
+        adaptive_margin,
+        adaptive_threshold,
+        cvvp_amount,
+        diffusion_temperature,
+        half,
+        crossfade,
+        verbose,
+    ):
+        self.tts = tts
+        self.engine = engine
+        self.diffuser = diffuser
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.max_batches = max_batches
+        self.max_mel_tokens = max_mel_tokens
+        self.adaptive_sampling = adaptive_sampling
+        self.adaptive_margin = adaptive_margin
+        self.adaptive_threshold = adaptive_threshold
+        self.cvvp_amount = cvvp_amount
+        self.diffusion_temperature = diffusion_temperature
+        self.half = half
+        self.crossfade = int(crossfade * 24000)
+        self.verbose = verbose
+        self.clvp = None
+        self._stack = ExitStack()
+        # Open while candidates are sampled, from one finished batch to the next (see step()).
+        self._timer = None
+        # key -> {"texts": [segment keys of each text], "clips": {segment key: clip}}
+        self._requests = {}
+        # (key, n) -> the n-th segment of request key: its prompt, ranking and batch counts.
+        self._segments = {}
+        # Segment keys of each text with batches left to submit, in turn order.
+        self._turns = deque()
+        self._in_flight = 0
+
+    def __enter__(self):
+        self._stack.enter_context(self.tts.temporary_cuda(self.tts.autoregressive))
+        self.clvp = self._stack.enter_context(self.tts.temporary_cuda(self.tts.clvp))
+        if self.cvvp_amount > 0:
+            # Candidates are ranked while others are still sampled, so CVVP stays on the device as long as CLVP.
+            self.tts.cvvp = self.tts.cvvp.to(self.tts.device)
+            self._stack.callback(
+                lambda: setattr(self.tts, "cvvp", self.tts.cvvp.cpu())
+            )
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._timer is not None:
+            self._timer.close()
+            self._timer = None
+        self._stack.close()
+
+    def busy(self):
+        """Whether any request is still being generated."""
+        return bool(self._requests)
+
+    def add(self, key, texts, conditioning_latents, conditioning_mels=None):
+        """
+        Adds a request for one clip per text, returned by step() under key. conditioning_latents and conditioning_mels
+        hold one entry per text, as for tts_batch().
+        """
+        if key in self._requests:
+            raise ValueError(f"Request {key!r} is already being generated")
+        if self.cvvp_amount > 0 and conditioning_mels is None:
+            raise ValueError(
+                "cvvp_amount > 0 needs the conditioning_mels of every text"
+            )
+        # Everything is checked before anything is queued, so a failed request leaves nothing behind.
+        segments = []
+        for i, text in enumerate(texts):
+            parts = split_and_recombine_text(text)
+            if len(parts) <= 1:
+                parts = [text]
+            mels = None
+            if self.cvvp_amount > 0 and conditioning_mels[i] is not None:
+                mels = conditioning_mels[i].to(self.tts.device)
+            text_segments = []
+            for part in parts:
+                tokens = (
+                    torch.IntTensor(self.tts.tokenizer.encode(part))
+                    .unsqueeze(0)
+                    .to(self.tts.device)
+                )
+                tokens = F.pad(tokens, (0, 1))  # This may not be necessary.
+                assert (
+                    tokens.shape[-1] < 400
+                ), "Too much text provided in one segment. Add punctuation to the text and re-try inference."
+                text_segments.append(
+                    {
+                        "text": part,
+                        "tokens": tokens,
+                        "auto_conditioning": conditioning_latents[i][0].to(
+                            self.tts.device
+                        ),
+                        "diffusion_conditioning": conditioning_latents[i][1].to(
+                            self.tts.device
+                        ),
+                        "mels": mels,
+                        "submitted": 0,
+                        "in_flight": 0,
+                        "results": [],
+                        "best": None,
+                    }
+                )
+            segments.append(text_segments)
+
+        request = {"texts": [], "clips": {}}
+        n = 0
+        for text_segments in segments:
+            segment_keys = []
+            for segment in text_segments:
+                segment_keys.append((key, n))
+                self._segments[key, n] = segment
+                n += 1
+            request["texts"].append(segment_keys)
+            self._turns.append(list(segment_keys))
+        self._requests[key] = request
+        if self.verbose:
+            print(f"Queued {len(texts)} texts of request {key!r} for generation..")
+        self._fill()
+
+    def drop(self, key):
+        """Forgets request key, whether its candidates are waiting or being sampled."""
+        if self._requests.pop(key, None) is None:
+            return
+        for segment_key in [k for k in self._segments if k[0] == key]:
+            self._stop(segment_key)
+            del self._segments[segment_key]
+        self._fill()
+
+    def _stop(self, segment_key):
+        """Submits no more batches for a segment and drops those being sampled."""
+        segment = self._segments[segment_key]
+        segment["submitted"] = self.num_batches
+        self._in_flight -= segment["in_flight"]
+        segment["in_flight"] = 0
+        self.engine.drop(segment_key)
+        for segment_keys in self._turns:
+            if segment_key in segment_keys:
+                segment_keys.remove(segment_key)
+        self._turns = deque(keys for keys in self._turns if keys)
+
+    def _fill(self):
+        """Submits batches of candidates while the sampler has free slots, the texts taking turns."""
+        while self._in_flight < self.max_batches and self._turns:
+            segment_keys = self._turns.popleft()
+            segment = self._segments[segment_keys[0]]
+            self.engine.submit(
+                (*segment_keys[0], segment["submitted"]),
+                segment["auto_conditioning"],
+                segment["tokens"],
+                self.batch_size,
+                prompt_key=segment_keys[0],
+            )
+            segment["submitted"] += 1
+            segment["in_flight"] += 1
+            self._in_flight += 1
+            # A text's segments are sampled in order, so that the first ones can be diffused while the rest are.
+            if segment["submitted"] == self.num_batches:
+                segment_keys.pop(0)
+            if segment_keys:
+                self._turns.append(segment_keys)
+
+    def step(self):
+        """
+        Samples one more token of every candidate being sampled and ranks the batches of candidates that completed.
+        Segments whose candidates are all ranked are diffused and vocoded. Returns [(key, clips)] for the requests
+        completed by this step, with one audio clip of shape (1,1,S) per text. Sample rate is 24kHz.
+        """
+        if self._timer is None:
+            # Timed from one finished batch to the next rather than per token, since timing synchronizes the device.
+            self._timer = ExitStack()
+            self._timer.enter_context(self.tts.timed_stage("autoregressive"))
+        with torch.autocast(
+            device_type="cuda", dtype=torch.float16, enabled=self.half
+        ):
+            finished = self.engine.step()
+        if not finished:
+            return []
+        self._timer.close()
+        self._timer = None
+
+        done = []
+        stop_mel_token = self.tts.autoregressive.stop_mel_token
+        for (key, n, _), codes, latents in finished:
+            segment_key = (key, n)
+            if segment_key in done:
+                # Its ranking saturated with an earlier batch of this step.
+                continue
+            segment = self._segments[segment_key]
+            segment["in_flight"] -= 1
+            self._in_flight -= 1
+            with self.tts.timed_stage("clvp"), torch.autocast(
+                device_type="cuda", dtype=torch.float16, enabled=self.half
+            ):
+                codes = F.pad(
+                    codes,
+                    (0, self.max_mel_tokens - codes.shape[1]),
+                    value=stop_mel_token,
+                )
+                scores = self.tts.rank_candidates(
+                    self.clvp,
+                    segment["tokens"],
+                    codes,
+                    segment["mels"],
+                    self.cvvp_amount,
+                )
+            segment["results"].append(scores)
+            top = torch.argmax(scores).item()
+            if segment["best"] is None or scores[top] > segment["best"][0]:
+                segment["best"] = (
+                    scores[top],
+                    codes[top : top + 1],
+                    pad_latents(latents[top : top + 1], self.max_mel_tokens),
+                )
+            if self.adaptive_sampling and self.tts.candidates_saturated(
+                segment["results"], 1, self.adaptive_margin, self.adaptive_threshold
+            ):
+                self._stop(segment_key)
+            if segment["submitted"] == self.num_batches and not segment["in_flight"]:
+                done.append(segment_key)
+        self._fill()
+        return self._finish(done)
+
+    def _finish(self, done):
+        """Turns the best candidates of the segments in done into audio and returns the requests they complete."""
+        if not done:
+            return []
+        segments = [self._segments.pop(segment_key) for segment_key in done]
+        for segment_key in done:
+            self.engine.drop(segment_key)
+        if self.verbose:
+            print(f"Transforming {len(done)} segments into audio..")
+        wavs = self.tts.diffuse_batch(
+            self.diffuser,
+            [trim_latents(*segment["best"][1:]) for segment in segments],
+            torch.cat(
+                [segment["diffusion_conditioning"] for segment in segments], dim=0
+            ),
+            temperature=self.diffusion_temperature,
+            verbose=self.verbose,
+            half=self.half,
+        )
+        completed = []
+        for segment_key, segment, wav in zip(done, segments, wavs):
+            if self.tts.enable_redaction:
+                with self.tts.timed_stage("redaction"):
+                    wav = self.tts.aligner.redact(
+                        wav.squeeze(1), segment["text"]
+                    ).unsqueeze(1)
+            key = segment_key[0]
+            request = self._requests[key]
+            request["clips"][segment_key] = wav
+            if len(request["clips"]) < sum(len(keys) for keys in request["texts"]):
+                continue
+            del self._requests[key]
+            completed.append(
+                (
+                    key,
+                    [
+                        crossfade_clips(
+                            [request["clips"][k] for k in segment_keys], self.crossfade
+                        )
+                        for segment_keys in request["texts"]
+                    ],
+                )
+            )
+        return completed
+
+
+def module_nbytes(module):
+    """Memory taken by a model's parameters and buffers, in bytes."""
+    return sum(t.numel() * t.element_size() for t in module.parameters()) + sum(
+        t.numel() * t.element_size() for t in module.buffers()
+    )
+
+
+class ModelRegistry:
+    """
+    Hands out one TextToSpeech pipeline per language. The diffusion decoder, CLVP, vocoder and aligner are loaded
+    once and shared by every pipeline; the autoregressive model and tokenizer of a language are loaded on first
+    use. When the autoregressive models together take more than `memory_budget` bytes, the least recently used
+    languages are dropped until they fit again (the one just requested is always kept).
+    """
+
+    def __init__(self, memory_budget=None, **tts_kwargs):
+        """
+        :param memory_budget: Bytes the per-language autoregressive models may take in total. None means no limit.
+        :param tts_kwargs: Passed to every TextToSpeech constructor.
+        """
+        self.memory_budget = memory_budget
+        self.tts_kwargs = tts_kwargs
+        self._shared = None
+        self._pipelines = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, lang):
+        with self._lock:
+            tts = self._pipelines.get(lang)
+            if tts is not None:
+                self._pipelines.move_to_end(lang)
+                return tts
+
+            tts = TextToSpeech(
+                lang=lang, shared_models=self._shared, **self.tts_kwargs
+            )
+            if self._shared is None:
+                self._shared = tts.shared_models()
+            self._pipelines[lang] = tts
+            self._evict()
+            return tts
+
+    def autoregressive_nbytes(self):
+        return sum(
+            module_nbytes(tts.autoregressive) for tts in self._pipelines.values()
+        )
+
+    def _evict(self):
+        if self.memory_budget is None:
+            return
+        while (
+            len(self._pipelines) > 1
+            and self.autoregressive_nbytes() > self.memory_budget
+        ):
+            lang, _ = self._pipelines.popitem(last=False)
+            print(
+                f"Unloading autoregressive model for '{lang}' to stay within the memory budget"
+            )
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def loaded_languages(self):
+        with self._lock:
+            return list(self._pipelines)
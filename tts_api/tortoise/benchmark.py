@@ -0,0 +1,407 @@
+"""
+Reproducible CPU benchmark of the TextToSpeech pipeline.
+
+Builds the autoregressive model, CLVP, the diffusion decoder and the UnivNet vocoder at reduced sizes with random
+weights, so it needs neither a GPU nor downloaded checkpoints, and times every stage of tts() for each preset over
+texts of several lengths taken from tortoise/data/*.txt. Random models rarely emit the stop token, so every
+candidate is sampled to --max_mel_tokens and runs are comparable across text lengths and code changes.
+
+With --worker the texts go through the path the inference workers take instead: conditioning latents computed once,
+and --requests copies of the text added together to a ContinuousTTS (or, with --deepspeed, a single request through
+tts_long() and more through one tts_batch()). --deepspeed builds the autoregressive model on DeepSpeed's kernels as
+with TTS_USE_DEEPSPEED=1; it needs DeepSpeed and a GPU.
+
+Importing tortoise.api requires HF_TOKEN to be set; nothing is downloaded, so any value will do. Run from tts_api/:
+    python -m tortoise.benchmark --output baseline.json
+    python -m tortoise.benchmark --baseline baseline.json --output after.json
+    python -m tortoise.benchmark --worker --requests 4 --output worker.json
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import torch
+
+from tortoise.api import PRESETS, TextToSpeech
+from tortoise.models.autoregressive import UnifiedVoice
+from tortoise.models.clvp import CLVP
+from tortoise.models.diffusion_decoder import DiffusionTts
+from tortoise.models.vocoder import UnivNetGenerator
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data")
+
+# Model sizes used by the benchmark. Channel counts stay multiples of 32 for the group norms in the attention blocks.
+TINY_CONFIG = {
+    "model_dim": 64,
+    "heads": 4,
+    "autoregressive_layers": 2,
+    "clvp_depth": 2,
+    "diffusion_layers": 2,
+    "vocoder_channels": 16,
+}
+
+
+# TTS_MAX_BATCH's default: the number of batches of candidates an inference worker samples at once.
+WORKER_MAX_BATCHES = 4
+
+
+def build_tiny_tts(
+    config=TINY_CONFIG,
+    autoregressive_batch_size=16,
+    lang="en",
+    seed=0,
+    use_deepspeed=False,
+):
+    """
+    Returns a TextToSpeech around randomly initialized models of the given sizes. Apart from the sizes the models are
+    built like the production ones, so the pipeline runs the same code paths.
+    """
+    torch.manual_seed(seed)
+    autoregressive = (
+        UnifiedVoice(
+            max_mel_tokens=604,
+            max_text_tokens=402,
+            max_conditioning_inputs=2,
+            layers=config["autoregressive_layers"],
+            model_dim=config["model_dim"],
+            heads=config["heads"],
+            number_text_tokens=255,
+            start_text_token=255,
+            checkpointing=False,
+            train_solo_embeddings=False,
+        )
+        .cpu()
+        .eval()
+    )
+    autoregressive.post_init_gpt2_config(kv_cache=True, use_deepspeed=use_deepspeed)
+    diffusion = (
+        DiffusionTts(
+            model_channels=config["model_dim"],
+            num_layers=config["diffusion_layers"],
+            in_channels=100,
+            out_channels=200,
+            in_latent_channels=config["model_dim"],
+            in_tokens=8193,
+            dropout=0,
+            use_fp16=False,
+            num_heads=config["heads"],
+            layer_drop=0,
+            unconditioned_percentage=0,
+        )
+        .cpu()
+        .eval()
+    )
+    clvp = (
+        CLVP(
+            dim_text=config["model_dim"],
+            dim_speech=config["model_dim"],
+            dim_latent=config["model_dim"],
+            num_text_tokens=256,
+            text_enc_depth=config["clvp_depth"],
+            text_seq_len=350,
+            text_heads=config["heads"],
+            num_speech_tokens=8192,
+            speech_enc_depth=config["clvp_depth"],
+            speech_heads=config["heads"],
+            speech_seq_len=430,
+            use_xformers=True,
+        )
+        .cpu()
+        .eval()
+    )
+    vocoder = UnivNetGenerator(channel_size=config["vocoder_channels"]).cpu()
+    vocoder.eval(inference=True)
+    return TextToSpeech(
+        autoregressive_batch_size=autoregressive_batch_size,
+        enable_redaction=False,
+        lang=lang,
+        autoregressive=autoregressive,
+        shared_models={
+            "diffusion": diffusion,
+            "clvp": clvp,
+            "vocoder": vocoder,
+            "aligner": None,
+        },
+    )
+
+
+def sample_texts(lengths):
+    """Returns {length: text} with texts of about `length` characters, cut at a word boundary from the data texts."""
+    words = []
+    for path in sorted(glob.glob(os.path.join(DATA_DIR, "*.txt"))):
+        with open(path, encoding="utf-8") as f:
+            words.extend(f.read().split())
+    corpus = " ".join(words)
+    texts = {}
+    for length in lengths:
+        cut = corpus.rfind(" ", 0, length + 1)
+        texts[length] = corpus[: cut if cut > 0 else length]
+    return texts
+
+
+def random_voice_samples(seconds=3, seed=0):
+    """A pair of random clips at 22.05 kHz and 24 kHz, standing in for a voice."""
+    generator = torch.Generator().manual_seed(seed)
+    return [
+        (
+            torch.randn(1, 22050 * seconds, generator=generator) * 0.1,
+            torch.randn(1, 24000 * seconds, generator=generator) * 0.1,
+        )
+    ]
+
+
+def generate_like_worker(
+    tts,
+    text,
+    preset,
+    conditioning_latents,
+    requests,
+    use_deterministic_seed=None,
+    **kwargs,
+):
+    """
+    Generates `text` as an inference worker does: `requests` copies of it added together to a ContinuousTTS. Where
+    the autoregressive model cannot sample that way (--deepspeed), one request goes through tts_long() and several
+    through one tts_batch(), as workers do then and for seeded requests.
+    """
+    tts.deterministic_state(seed=use_deterministic_seed)
+    session = tts.continuous_tts_with_preset(
+        preset, max_batches=WORKER_MAX_BATCHES, **kwargs
+    )
+    if session is None:
+        if requests == 1:
+            return tts.tts_long_with_preset(
+                text,
+                conditioning_latents=conditioning_latents,
+                preset=preset,
+                use_deterministic_seed=use_deterministic_seed,
+                **kwargs,
+            )
+        return tts.tts_batch_with_preset(
+            [text] * requests,
+            conditioning_latents=[conditioning_latents] * requests,
+            preset=preset,
+            use_deterministic_seed=use_deterministic_seed,
+            **kwargs,
+        )
+    clips = []
+    with torch.no_grad(), session:
+        for request in range(requests):
+            session.add(request, [text], [conditioning_latents])
+        while session.busy():
+            clips += [clip for _, [clip] in session.step()]
+    return clips
+
+
+def run_case(tts, text, preset, generate, max_mel_tokens, repeats, seed):
+    """
+    Generates `text` `repeats` times with generate(tts, text, preset, **kwargs) and returns the median total and
+    per-stage times with the peak memory.
+    """
+    totals = []
+    stages = {}
+    for _ in range(repeats):
+        tts.stage_timings = {}
+        start = time.perf_counter()
+        generate(
+            tts,
+            text,
+            preset,
+            use_deterministic_seed=seed,
+            verbose=False,
+            max_mel_tokens=max_mel_tokens,
+        )
+        totals.append(time.perf_counter() - start)
+        for stage, (seconds, peak) in tts.stage_timings.items():
+            stages.setdefault(stage, ([], []))
+            stages[stage][0].append(seconds)
+            stages[stage][1].append(peak)
+    return {
+        "preset": preset,
+        "text_length": len(text),
+        "total_seconds": statistics.median(totals),
+        "stages": {
+            stage: {"seconds": statistics.median(seconds), "peak_bytes": max(peaks)}
+            for stage, (seconds, peaks) in stages.items()
+        },
+    }
+
+
+def compare(results, baseline, threshold):
+    """Prints per-stage times against the baseline and returns the entries that got slower by more than threshold."""
+    previous = {(r["preset"], r["text_length"]): r for r in baseline["results"]}
+    regressions = []
+    print(
+        f"{'preset':<16}{'chars':>6}  {'stage':<22}{'baseline':>10}{'current':>10}{'ratio':>8}"
+    )
+    for result in results["results"]:
+        before = previous.get((result["preset"], result["text_length"]))
+        if before is None:
+            continue
+        rows = [("total", before["total_seconds"], result["total_seconds"])]
+        for stage, current in sorted(result["stages"].items()):
+            if stage in before["stages"]:
+                rows.append(
+                    (stage, before["stages"][stage]["seconds"], current["seconds"])
+                )
+        for stage, old, new in rows:
+            ratio = new / old if old else float("inf")
+            flag = " !" if ratio > 1 + threshold else ""
+            print(
+                f"{result['preset']:<16}{result['text_length']:>6}  {stage:<22}{old:>10.3f}{new:>10.3f}{ratio:>7.2f}x{flag}"
+            )
+            if flag:
+                regressions.append((result["preset"], result["text_length"], stage))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    parser.add_argument(
+        "--presets",
+        type=str,
+        help="Comma-separated presets to run.",
+        default=",".join(PRESETS),
+    )
+    parser.add_argument(
+        "--lengths",
+        type=str,
+        help="Comma-separated text lengths in characters.",
+        default="50,150,300",
+    )
+    parser.add_argument(
+        "--max_mel_tokens",
+        type=int,
+        help="Autoregressive tokens sampled per candidate.",
+        default=100,
+    )
+    parser.add_argument(
+        "--repeats", type=int, help="Runs per case; medians are reported.", default=3
+    )
+    parser.add_argument(
+        "--batch_size", type=int, help="Autoregressive batch size.", default=16
+    )
+    parser.add_argument(
+        "--threads", type=int, help="Torch CPU threads (default: torch's choice)."
+    )
+    parser.add_argument(
+        "--seed", type=int, help="Seed for weights and sampling.", default=0
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Generate the way inference workers do instead of through tts().",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        help="With --worker, requests generated together.",
+        default=1,
+    )
+    parser.add_argument(
+        "--deepspeed",
+        action="store_true",
+        help="Run the autoregressive model on DeepSpeed (needs DeepSpeed and a GPU).",
+    )
+    parser.add_argument("--output", type=str, help="Where to write the JSON results.")
+    parser.add_argument(
+        "--baseline", type=str, help="JSON results of an earlier run to compare against."
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        help="Relative slowdown against the baseline reported as a regression.",
+        default=0.1,
+    )
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    tts = build_tiny_tts(
+        autoregressive_batch_size=args.batch_size,
+        seed=args.seed,
+        use_deepspeed=args.deepspeed,
+    )
+    voice_samples = random_voice_samples(seed=args.seed)
+    if args.worker:
+        # Workers get the latents from the latent cache, so computing them is not part of a request.
+        conditioning_latents = tts.get_conditioning_latents(voice_samples)
+
+        def generate(tts, text, preset, **kwargs):
+            return generate_like_worker(
+                tts, text, preset, conditioning_latents, args.requests, **kwargs
+            )
+
+    else:
+
+        def generate(tts, text, preset, **kwargs):
+            return tts.tts_with_preset(
+                text, preset=preset, voice_samples=voice_samples, **kwargs
+            )
+
+    texts = sample_texts([int(length) for length in args.lengths.split(",")])
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "machine": platform.machine(),
+            "device": str(tts.device),
+            "processor": platform.processor(),
+            "threads": torch.get_num_threads(),
+        },
+        "settings": {
+            "models": TINY_CONFIG,
+            "max_mel_tokens": args.max_mel_tokens,
+            "repeats": args.repeats,
+            "batch_size": args.batch_size,
+            "seed": args.seed,
+            "worker": args.worker,
+            "requests": args.requests if args.worker else 1,
+            "deepspeed": args.deepspeed,
+        },
+        "results": [],
+    }
+    for preset in args.presets.split(","):
+        for text in texts.values():
+            result = run_case(
+                tts,
+                text,
+                preset,
+                generate,
+                args.max_mel_tokens,
+                args.repeats,
+                args.seed,
+            )
+            results["results"].append(result)
+            print(
+                f"{preset:<16}{len(text):>6} chars  {result['total_seconds']:.3f}s",
+                file=sys.stderr,
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline["settings"] != results["settings"]:
+            print(
+                "Warning: baseline was run with different settings:",
+                baseline["settings"],
+                file=sys.stderr,
+            )
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.threshold:.0%}")
+            sys.exit(1)
@@ -1,5 +1,6 @@
 # AGPL: a notification must be added stating that changes have been made to that file.
 import functools
+from collections import deque
 
 import torch
 import torch.nn as nn
@@ -8,8 +9,8 @@ from transformers import GPT2Config, GPT2PreTrainedModel, LogitsProcessorList
 from transformers.modeling_outputs import CausalLMOutputWithCrossAttentions
 
 from tortoise.models.arch_util import AttentionBlock
+from tortoise.utils.sampling import FusedSampler
 from tortoise.utils.typical_sampling import TypicalLogitsWarper
-import deepspeed
 
 def null_position_embeddings(range, dim):
     return torch.zeros((range.shape[0], range.shape[1], dim), device=range.device)
@@ -96,7 +97,12 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
+        return_latent=False,
     ):
+        """
+        With return_latent, the hidden_states of the output are the final-normed hidden states of the last layer
+        (the latents the diffusion model is conditioned on) instead of the per-layer hidden states.
+        """
         assert self.cached_mel_emb is not None
         assert inputs_embeds is None  # Not supported by this inference model.
         assert labels is None  # Training not supported by this inference model.
@@ -138,7 +144,11 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             return_dict=return_dict,
         )
         hidden_states = transformer_outputs[0]
-        lm_logits = self.lm_head(hidden_states)
+        if return_latent:
+            latent = self.lm_head[0](hidden_states)
+            lm_logits = self.lm_head[1](latent)
+        else:
+            lm_logits = self.lm_head(hidden_states)
 
         if not return_dict:
             return (lm_logits,) + transformer_outputs[1:]
@@ -147,7 +157,7 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
             loss=None,
             logits=lm_logits,
             past_key_values=transformer_outputs.past_key_values,
-            hidden_states=transformer_outputs.hidden_states,
+            hidden_states=latent if return_latent else transformer_outputs.hidden_states,
             attentions=transformer_outputs.attentions,
             cross_attentions=transformer_outputs.cross_attentions,
         )
@@ -168,6 +178,133 @@ class GPT2InferenceModel(GPT2PreTrainedModel):
         )
 
 
+class StaticKVCache:
+    """
+    Keys and values of every transformer layer for up to `slots` sequences of up to `capacity` positions, allocated
+    once and written in place as tokens are decoded (see UnifiedVoice.decode_step()), rather than concatenated onto
+    past_key_values at every step. The sequences in use are always the first `rows` ones. Each writes its next
+    position at its own column, so sequences with prompts of different lengths, or admitted at different steps,
+    can share the cache.
+    """
+
+    def __init__(self, layers, heads, head_dim, slots, capacity, dtype, device):
+        shape = (layers, slots, heads, capacity, head_dim)
+        self.keys = torch.empty(shape, dtype=dtype, device=device)
+        self.values = torch.empty(shape, dtype=dtype, device=device)
+        # Additive attention bias, built from the attention mask the way GPT2Model does. Unwritten columns stay
+        # masked out.
+        self.bias = torch.full(
+            (slots, 1, 1, capacity),
+            torch.finfo(torch.float32).min,
+            dtype=torch.float32,
+            device=device,
+        )
+        # The column each sequence writes next.
+        self.columns = torch.zeros(slots, dtype=torch.long, device=device)
+        self.rows = 0
+        # Upper bound of the columns in use.
+        self.width = 0
+
+    @classmethod
+    def like(cls, past_key_values, slots, capacity):
+        """An empty cache for sequences that continue from past_key_values of the same model."""
+        key = past_key_values[0][0]
+        return cls(
+            len(past_key_values),
+            key.shape[1],
+            key.shape[3],
+            slots,
+            capacity,
+            key.dtype,
+            key.device,
+        )
+
+    @property
+    def capacity(self):
+        return self.keys.shape[3]
+
+    def admit(self, past_key_values, prompts, attention_mask):
+        """
+        Adds a sequence for each index in prompts, starting from the prompt state past_key_values[...][prompts], of
+        prompts whose padding is masked out by attention_mask (one row per new sequence).
+        """
+        start, stop = self.rows, self.rows + len(prompts)
+        length = past_key_values[0][0].shape[2]
+        for layer, (keys, values) in enumerate(past_key_values):
+            self.keys[layer, start:stop, :, :length] = keys[prompts]
+            self.values[layer, start:stop, :, :length] = values[prompts]
+        self.bias[start:stop] = torch.finfo(torch.float32).min
+        self.bias[start:stop, 0, 0, :length].masked_fill_(attention_mask != 0, 0.0)
+        self.columns[start:stop] = length
+        self.rows = stop
+        self.width = max(self.width, length)
+
+    def attention_bias(self):
+        """Opens the column each sequence writes next to attention and returns the bias over the columns in use."""
+        rows = self.rows
+        self.bias[
+            torch.arange(rows, device=self.bias.device), 0, 0, self.columns[:rows]
+        ] = 0.0
+        return self.bias[:rows, :, :, : self.width + 1]
+
+    def update(self, layer, key, value):
+        """
+        Writes the (rows, heads, head_dim) key and value of each sequence's next position into layer, and returns
+        the layer's keys and values over the columns in use.
+        """
+        rows = self.rows
+        index = torch.arange(rows, device=key.device)
+        self.keys[layer][index, :, self.columns[:rows]] = key
+        self.values[layer][index, :, self.columns[:rows]] = value
+        return (
+            self.keys[layer, :rows, :, : self.width + 1],
+            self.values[layer, :rows, :, : self.width + 1],
+        )
+
+    def advance(self):
+        """Moves every sequence on to its next column, after all layers were updated."""
+        self.columns[: self.rows] += 1
+        self.width += 1
+
+    def compact(self, keep):
+        """Moves the sequences at indices keep (in increasing order) to the front and drops the others."""
+        rows = len(keep)
+        for layer in range(self.keys.shape[0]):
+            self.keys[layer, :rows, :, : self.width] = self.keys[
+                layer, keep, :, : self.width
+            ]
+            self.values[layer, :rows, :, : self.width] = self.values[
+                layer, keep, :, : self.width
+            ]
+        self.bias[:rows] = self.bias[keep]
+        self.columns[:rows] = self.columns[keep]
+        self.rows = rows
+        self.width = int(self.columns[:rows].max()) if rows else 0
+
+    def resize(self, capacity):
+        """Reallocates the cache for `capacity` positions, keeping the sequences in use."""
+        slots = self.keys.shape[1]
+        resized = StaticKVCache(
+            self.keys.shape[0],
+            self.keys.shape[2],
+            self.keys.shape[4],
+            slots,
+            capacity,
+            self.keys.dtype,
+            self.keys.device,
+        )
+        width = min(self.width, capacity)
+        resized.keys[:, : self.rows, :, :width] = self.keys[:, : self.rows, :, :width]
+        resized.values[:, : self.rows, :, :width] = self.values[
+            :, : self.rows, :, :width
+        ]
+        resized.bias[: self.rows, :, :, :width] = self.bias[: self.rows, :, :, :width]
+        resized.columns[: self.rows] = self.columns[: self.rows]
+        resized.rows = self.rows
+        resized.width = self.width
+        self.__dict__.update(resized.__dict__)
+
+
 class ConditioningEncoder(nn.Module):
     def __init__(
         self,
@@ -278,6 +415,16 @@ class MelEncoder(nn.Module):
 
 
 class UnifiedVoice(nn.Module):
+    # generate() arguments that sample_codes() implements. Calls with any other argument go through generate().
+    SAMPLING_ARGS = {
+        "do_sample",
+        "temperature",
+        "top_k",
+        "top_p",
+        "repetition_penalty",
+        "length_penalty",
+    }
+
     def __init__(
         self,
         layers=8,
@@ -379,7 +526,7 @@ class UnifiedVoice(nn.Module):
         for module in embeddings:
             module.weight.data.normal_(mean=0.0, std=0.02)
 
-    def post_init_gpt2_config(self, kv_cache=True):
+    def post_init_gpt2_config(self, kv_cache=True, use_deepspeed=True):
         seq_length = self.max_mel_tokens + self.max_text_tokens + 2
         gpt_config = GPT2Config(
             vocab_size=self.max_mel_tokens,
@@ -400,11 +547,22 @@ class UnifiedVoice(nn.Module):
             self.mel_head,
             kv_cache=kv_cache,
         )
-        self.ds_engine = deepspeed.init_inference(model=self.inference_model,  
-                                                  mp_size=1,
-                                                  replace_with_kernel_inject=True,
-                                                  dtype=torch.half)
-        self.ds_engine.module.eval()
+        if use_deepspeed:
+            # Only needed for the injected kernels, so machines without DeepSpeed can still run the plain model.
+            import deepspeed
+
+            self.ds_engine = deepspeed.init_inference(model=self.inference_model,  
+                                                      mp_size=1,
+                                                      replace_with_kernel_inject=True,
+                                                      dtype=torch.half)
+            self.ds_engine.module.eval()
+            self.generation_model = self.ds_engine.module
+            # The injected kernels keep their own KV cache, which cannot be cut down to the live sequences.
+            self.compact_sampling = False
+        else:
+            # The plain model, which sample_codes() can drive directly (and generate() does for what it cannot).
+            self.generation_model = self.inference_model.eval()
+            self.compact_sampling = kv_cache
         # self.inference_model = PrunedGPT2InferenceModel(gpt_config, self.gpt, self.mel_pos_embedding, self.mel_embedding, self.final_norm, self.mel_head)
         self.gpt.wte = self.mel_embedding
 
@@ -593,19 +751,295 @@ class UnifiedVoice(nn.Module):
         loss_mel = F.cross_entropy(mel_logits, mel_targets.long())
         return loss_text.mean(), loss_mel.mean(), mel_logits
 
-    def inference_speech(
+    def decode_step(self, emb, cache):
+        """
+        Runs the GPT-2 blocks of the inference model on one new position of each of the cache.rows sequences in
+        cache, emb being their (rows, 1, model_dim) input embeddings. The new keys and values are written into the
+        cache, which moves every sequence on by one position. Computes what GPT2Model would with past_key_values,
+        returning its last hidden states.
+        """
+        rows = cache.rows
+        bias = cache.attention_bias()
+        h = emb
+        for layer, block in enumerate(self.gpt.h):
+            attn = block.attn
+            query, key, value = attn.c_attn(block.ln_1(h)).split(attn.split_size, dim=2)
+            keys, values = cache.update(
+                layer,
+                key.view(rows, attn.num_heads, attn.head_dim),
+                value.view(rows, attn.num_heads, attn.head_dim),
+            )
+            weights = torch.matmul(
+                query.view(rows, attn.num_heads, 1, attn.head_dim),
+                keys.transpose(-1, -2),
+            )
+            if attn.scale_attn_weights:
+                weights = weights / attn.head_dim**0.5
+            if attn.scale_attn_by_inverse_layer_idx:
+                weights = weights / float(attn.layer_idx + 1)
+            weights = F.softmax(weights + bias, dim=-1).type(values.dtype)
+            # With a single query, (rows, heads, 1, head_dim) is laid out like the merged heads.
+            out = torch.matmul(weights, values).reshape(rows, 1, -1)
+            h = h + attn.c_proj(out)
+            h = h + block.mlp(block.ln_2(h))
+        cache.advance()
+        return self.gpt.ln_f(h)
+
+    def decode_embedding(self, tokens, columns, mel_lens):
+        """
+        Input embeddings of the next tokens of sequences that write them at the given cache columns, after prompts
+        whose conditioning and text embeddings take mel_lens columns. Mel positions count from the start token,
+        which follows those embeddings, like in GPT2InferenceModel.forward().
+        """
+        positions = self.mel_pos_embedding.emb.weight
+        # Trailing tokens fed at the very end of the model's context reuse its last position.
+        index = (columns - mel_lens).clamp(max=len(positions) - 1)
+        return (self.mel_embedding(tokens) + positions[index]).unsqueeze(1)
+
+    def prefill(
+        self, inputs, attention_mask=None, return_latent=False, prefix_cache=None
+    ):
+        """
+        Runs prompts through the inference model (whose mel embeddings must be stored already) and returns the
+        state sampling continues from: a dict of their past_key_values and the logits and latent (with
+        return_latent) of their last position. Fills and returns prefix_cache instead when it is given, and leaves
+        it alone if it already holds what is asked for.
+        """
+        if prefix_cache is None:
+            prefix_cache = {}
+        if prefix_cache and (prefix_cache["latent"] is not None or not return_latent):
+            return prefix_cache
+        if attention_mask is None:
+            attention_mask = torch.ones_like(inputs)
+        outputs = self.inference_model(
+            input_ids=inputs,
+            attention_mask=attention_mask,
+            use_cache=True,
+            return_dict=True,
+            return_latent=return_latent,
+        )
+        prefix_cache["past_key_values"] = outputs.past_key_values
+        prefix_cache["logits"] = outputs.logits[:, -1]
+        prefix_cache["latent"] = outputs.hidden_states[:, -1] if return_latent else None
+        return prefix_cache
+
+    def sample_codes(
         self,
-        speech_conditioning_latent,
-        text_inputs,
-        input_tokens=None,
-        num_return_sequences=1,
-        max_generate_length=None,
-        typical_sampling=False,
-        typical_mass=0.9,
+        inputs,
+        attention_mask,
+        num_return_sequences,
+        max_length,
+        sampler,
+        return_latent=False,
+        trailing_tokens=None,
+        prefix_cache=None,
+    ):
+        """
+        Sampling loop equivalent to generate(do_sample=True), with sampler (a FusedSampler) choosing the tokens,
+        except that a sequence leaves the batch as soon as it emits the stop token. Each step then only computes the
+        candidates that are still running. Returns the sampled codes (without the prompt), padded with the stop token
+        to the length of the longest candidate.
+
+        The prompts are run through the inference model once each. Their KV cache is then copied to each of their
+        num_return_sequences candidates in a StaticKVCache sized for max_length, and every following step runs
+        decode_step() on it. prefix_cache is a dict owned by the caller: passing the same one for every batch
+        sampled from the same prompts (and under the same autocast settings) also skips the prompt pass after the
+        first batch.
+
+        With return_latent, also returns the latents of every candidate (see UnifiedVoice.forward()), recorded while
+        sampling: column j holds the latent from which code j was sampled. Since the latents of a stopped sequence
+        are wanted as if its stop token and what follows had been replaced, it is fed trailing_tokens after the
+        stop token before it leaves the batch. Columns past that are left zero.
+        """
+        if attention_mask is None:
+            attention_mask = torch.ones_like(inputs)
+        prefix_cache = self.prefill(inputs, attention_mask, return_latent, prefix_cache)
+
+        device = inputs.device
+        prompt = torch.arange(inputs.shape[0], device=device).repeat_interleave(
+            num_return_sequences
+        )
+        total = len(prompt)
+        width = inputs.shape[1]
+        max_new_tokens = max_length - width
+        trailing = torch.as_tensor(
+            trailing_tokens if return_latent and trailing_tokens else [],
+            dtype=torch.long,
+            device=device,
+        )
+        cache = StaticKVCache.like(
+            prefix_cache["past_key_values"], total, max_length + len(trailing)
+        )
+        cache.admit(prefix_cache["past_key_values"], prompt, attention_mask[prompt])
+        logits = prefix_cache["logits"][prompt]
+        latent = prefix_cache["latent"][prompt] if return_latent else None
+        # The sequences so far, for logits processors that look at them.
+        input_ids = inputs.new_empty((total, max_length))
+        input_ids[:, :width] = inputs[prompt]
+        seen = None
+        if sampler.needs_seen:
+            seen = torch.zeros(
+                (total, self.number_mel_codes), dtype=torch.bool, device=device
+            )
+            seen.scatter_(1, input_ids[:, :width], True)
+        codes = torch.full(
+            (total, max_new_tokens),
+            fill_value=self.stop_mel_token,
+            dtype=torch.long,
+            device=device,
+        )
+        if return_latent:
+            latents = latent.new_zeros(
+                (total, max_new_tokens + len(trailing), latent.shape[-1])
+            )
+        mel_lens = torch.full(
+            (total,),
+            self.inference_model.cached_mel_emb.shape[1],
+            dtype=torch.long,
+            device=device,
+        )
+
+        # Rows of `codes` that the sequences still in the batch belong to.
+        live = torch.arange(total, device=device)
+        # Index of the trailing token each sequence is fed next, -1 while it is still sampling.
+        fed = torch.full((total,), -1, dtype=torch.long, device=device)
+        step = 0
+        sampled_steps = 0
+        while True:
+            rows = len(live)
+            if return_latent:
+                latents[live, step] = latent
+
+            sampling = fed < 0
+            if sampling.any():
+                next_tokens = sampler(
+                    logits,
+                    seen[:rows] if seen is not None else None,
+                    input_ids[:rows, :width],
+                )
+                codes[live[sampling], step] = next_tokens[sampling]
+                sampled_steps = step + 1
+                stopped = sampling & (next_tokens == self.stop_mel_token)
+            else:
+                next_tokens = torch.full_like(live, self.stop_mel_token)
+                stopped = sampling
+            step += 1
+
+            fed = torch.where(sampling, stopped.long() - 1, fed + 1)
+            if len(trailing):
+                next_tokens = torch.where(
+                    fed >= 0, trailing[fed.clamp(0, len(trailing) - 1)], next_tokens
+                )
+            # Sequences that are done feeding trailing tokens leave, and so do those still sampling at the length limit.
+            running = (fed < len(trailing)) & ((fed >= 0) | (step < max_new_tokens))
+            if not running.all():
+                if not running.any():
+                    break
+                keep = running.nonzero().squeeze(1)
+                live = live[keep]
+                fed = fed[keep]
+                next_tokens = next_tokens[keep]
+                rows = len(keep)
+                input_ids[:rows, :width] = input_ids[keep, :width]
+                if seen is not None:
+                    seen[:rows] = seen[keep]
+                cache.compact(keep)
+            if width < max_length:
+                input_ids[:rows, width] = next_tokens
+            if seen is not None:
+                seen[:rows].scatter_(1, next_tokens.unsqueeze(1), True)
+            emb = self.decode_embedding(
+                next_tokens, cache.columns[:rows], mel_lens[:rows]
+            )
+            width += 1
+            latent = self.final_norm(self.decode_step(emb, cache)[:, -1])
+            logits = self.mel_head(latent)
+        if return_latent:
+            return codes[:, :sampled_steps], latents[:, :step]
+        return codes[:, :sampled_steps]
+
+    def can_sample(self, hf_generate_kwargs):
+        """Whether sample_codes() can stand in for generate() with these arguments."""
+        return bool(
+            self.compact_sampling
+            and hf_generate_kwargs.get("do_sample")
+            and set(hf_generate_kwargs) <= self.SAMPLING_ARGS
+        )
+
+    def fused_sampler(self, logits_processor, hf_generate_kwargs):
+        """The FusedSampler doing what generate() would with these processors and arguments."""
+        # Typical sampling is done by the sampler itself, other processors are handed to it as they are.
+        typical = [
+            p
+            for p in logits_processor
+            if isinstance(p, TypicalLogitsWarper) and p.min_tokens_to_keep == 1
+        ][:1]
+        return FusedSampler(
+            repetition_penalty=hf_generate_kwargs.get("repetition_penalty") or 1.0,
+            typical_mass=typical[0].mass if typical else None,
+            temperature=hf_generate_kwargs.get("temperature") or 1.0,
+            # generate() falls back to the model's default top_k of 50.
+            top_k=hf_generate_kwargs.get(
+                "top_k", self.inference_model.generation_config.top_k
+            )
+            or 0,
+            top_p=hf_generate_kwargs.get("top_p") or 1.0,
+            processors=[p for p in logits_processor if p not in typical],
+        )
+
+    def generate_codes(
+        self,
+        inputs,
+        attention_mask,
+        num_return_sequences,
+        max_length,
+        logits_processor,
+        return_latent=False,
+        trailing_tokens=None,
+        prefix_cache=None,
         **hf_generate_kwargs
     ):
+        """
+        Samples codes after inputs with sample_codes() when it supports the arguments, and with Hugging Face
+        generate() otherwise. Either way the processors are applied in the order generate() applies them.
+        With return_latent, returns (codes, latents) as described in sample_codes(); latents is None when
+        generate() was used, since it does not keep them. prefix_cache is only used by sample_codes(), so with
+        DeepSpeed (compact_sampling off) every batch runs the prompt again inside generate().
+        """
+        if not self.can_sample(hf_generate_kwargs):
+            if attention_mask is not None:
+                hf_generate_kwargs["attention_mask"] = attention_mask
+            gen = self.generation_model.generate(
+                inputs,
+                bos_token_id=self.start_mel_token,
+                pad_token_id=self.stop_mel_token,
+                eos_token_id=self.stop_mel_token,
+                max_length=max_length,
+                logits_processor=logits_processor,
+                num_return_sequences=num_return_sequences,
+                **hf_generate_kwargs
+            )
+            codes = gen[:, inputs.shape[1] :]
+            return (codes, None) if return_latent else codes
+
+        return self.sample_codes(
+            inputs,
+            attention_mask,
+            num_return_sequences,
+            max_length,
+            self.fused_sampler(logits_processor, hf_generate_kwargs),
+            return_latent=return_latent,
+            trailing_tokens=trailing_tokens,
+            prefix_cache=prefix_cache,
+        )
+
+    def speech_prompt(self, speech_conditioning_latent, text_inputs):
+        """
+        Returns the conditioning and text embeddings to store in the inference model before sampling speech for
+        text_inputs, and the placeholder input ids standing for them, ending with the start mel token.
+        """
         text_inputs = F.pad(text_inputs, (0, 1), value=self.stop_text_token)
-        text_inputs, text_targets = self.build_aligned_inputs_and_targets(
+        text_inputs, _ = self.build_aligned_inputs_and_targets(
             text_inputs, self.start_text_token, self.stop_text_token
         )
         text_emb = self.text_embedding(text_inputs) + self.text_pos_embedding(
@@ -614,7 +1048,6 @@ class UnifiedVoice(nn.Module):
 
         conds = speech_conditioning_latent.unsqueeze(1)
         emb = torch.cat([conds, text_emb], dim=1)
-        self.inference_model.store_mel_emb(emb)
 
         fake_inputs = torch.full(
             (
@@ -626,6 +1059,59 @@ class UnifiedVoice(nn.Module):
             device=text_inputs.device,
         )
         fake_inputs[:, -1] = self.start_mel_token
+        return emb, fake_inputs
+
+    def continuous_sampler(
+        self,
+        slots,
+        max_generate_length=None,
+        typical_sampling=False,
+        typical_mass=0.9,
+        return_latent=False,
+        trailing_tokens=None,
+        **hf_generate_kwargs
+    ):
+        """
+        Returns a ContinuousSampler with `slots` sequences that samples like inference_speech() with these
+        arguments, or None if sample_codes() does not support them (see can_sample()).
+        """
+        logits_processor = (
+            LogitsProcessorList([TypicalLogitsWarper(mass=typical_mass)])
+            if typical_sampling
+            else LogitsProcessorList()
+        )
+        if not self.can_sample(hf_generate_kwargs):
+            return None
+        sampler = self.fused_sampler(logits_processor, hf_generate_kwargs)
+        if sampler.processors:
+            return None
+        return ContinuousSampler(
+            self,
+            sampler,
+            slots,
+            self.max_mel_tokens - 1
+            if max_generate_length is None
+            else max_generate_length,
+            return_latent=return_latent,
+            trailing_tokens=trailing_tokens,
+        )
+
+    def inference_speech(
+        self,
+        speech_conditioning_latent,
+        text_inputs,
+        input_tokens=None,
+        num_return_sequences=1,
+        max_generate_length=None,
+        typical_sampling=False,
+        typical_mass=0.9,
+        return_latent=False,
+        trailing_tokens=None,
+        prefix_cache=None,
+        **hf_generate_kwargs
+    ):
+        emb, fake_inputs = self.speech_prompt(speech_conditioning_latent, text_inputs)
+        self.inference_model.store_mel_emb(emb)
         trunc_index = fake_inputs.shape[1]
         if input_tokens is None:
             inputs = fake_inputs
@@ -649,17 +1135,381 @@ class UnifiedVoice(nn.Module):
             if max_generate_length is None
             else trunc_index + max_generate_length
         )
-        gen = self.ds_engine.module.generate(
+        codes = self.generate_codes(
             inputs,
-            bos_token_id=self.start_mel_token,
-            pad_token_id=self.stop_mel_token,
-            eos_token_id=self.stop_mel_token,
-            max_length=max_length,
-            logits_processor=logits_processor,
-            num_return_sequences=num_return_sequences,
+            None,
+            num_return_sequences,
+            max_length,
+            logits_processor,
+            return_latent=return_latent,
+            trailing_tokens=trailing_tokens,
+            prefix_cache=prefix_cache,
             **hf_generate_kwargs
         )
-        return gen[:, trunc_index:]
+        if return_latent:
+            # The latents only cover the sampled codes, not input_tokens.
+            codes, latents = codes
+        if input_tokens is not None:
+            # Like generate(), return the given tokens in front of the sampled ones.
+            codes = torch.cat(
+                [
+                    inputs[:, trunc_index:].repeat_interleave(num_return_sequences, 0),
+                    codes,
+                ],
+                dim=1,
+            )
+        if return_latent:
+            return codes, latents
+        return codes
+
+    def inference_speech_batch(
+        self,
+        speech_conditioning_latents,
+        text_inputs,
+        num_return_sequences=1,
+        max_generate_length=None,
+        typical_sampling=False,
+        typical_mass=0.9,
+        return_latent=False,
+        trailing_tokens=None,
+        prefix_cache=None,
+        **hf_generate_kwargs
+    ):
+        """
+        Batched variant of inference_speech() for several independent prompts. speech_conditioning_latents and
+        text_inputs are lists of (1,1024) latents and (1,t) token tensors; t may differ between prompts. Each prompt is
+        left-padded and masked out of attention, so that every sequence starts sampling mel tokens at the same column.
+        Returns num_return_sequences rows of codes per prompt, grouped in prompt order, along with their latents with
+        return_latent (see generate_codes()). See sample_codes() for prefix_cache.
+        """
+        embs = []
+        for cond, text in zip(speech_conditioning_latents, text_inputs):
+            text = F.pad(text, (0, 1), value=self.stop_text_token)
+            text, _ = self.build_aligned_inputs_and_targets(
+                text, self.start_text_token, self.stop_text_token
+            )
+            text_emb = self.text_embedding(text) + self.text_pos_embedding(text)
+            embs.append(torch.cat([cond.unsqueeze(1), text_emb], dim=1))
+        prefix_len = max(e.shape[1] for e in embs)
+        emb = torch.cat(
+            [F.pad(e, (0, 0, prefix_len - e.shape[1], 0)) for e in embs], dim=0
+        )
+        self.inference_model.store_mel_emb(emb)
+
+        # One extra column for the start mel token, as in inference_speech().
+        fake_inputs = torch.full(
+            (emb.shape[0], prefix_len + 1),
+            fill_value=1,
+            dtype=torch.long,
+            device=emb.device,
+        )
+        fake_inputs[:, -1] = self.start_mel_token
+        attention_mask = torch.ones_like(fake_inputs)
+        for i, e in enumerate(embs):
+            attention_mask[i, : prefix_len - e.shape[1]] = 0
+        trunc_index = fake_inputs.shape[1]
+
+        logits_processor = (
+            LogitsProcessorList([TypicalLogitsWarper(mass=typical_mass)])
+            if typical_sampling
+            else LogitsProcessorList()
+        )
+        max_length = (
+            trunc_index + self.max_mel_tokens - 1
+            if max_generate_length is None
+            else trunc_index + max_generate_length
+        )
+        return self.generate_codes(
+            fake_inputs,
+            attention_mask,
+            num_return_sequences,
+            max_length,
+            logits_processor,
+            return_latent=return_latent,
+            trailing_tokens=trailing_tokens,
+            prefix_cache=prefix_cache,
+            **hf_generate_kwargs
+        )
+
+
+class ContinuousSampler:
+    """
+    Iteration-level batching of speech sampling across requests. A request is a prompt (conditioning latent and
+    text) and a number of sequences to sample after it. Requests wait in a queue and their sequences take the free
+    slots of a StaticKVCache as soon as other sequences finish, instead of waiting for the whole batch to end. A
+    prompt is run through the model once, when its first sequence is admitted, and shared by every request made
+    with the same prompt_key.
+
+    step() advances every sequence by one token, like an iteration of UnifiedVoice.sample_codes(), and returns the
+    requests whose sequences have all finished as (key, codes, latents), codes being padded with the stop token to
+    max_new_tokens.
+    """
+
+    def __init__(
+        self,
+        model,
+        sampler,
+        slots,
+        max_new_tokens,
+        return_latent=False,
+        trailing_tokens=None,
+    ):
+        self.model = model
+        self.sampler = sampler
+        self.slots = slots
+        self.max_new_tokens = max_new_tokens
+        self.return_latent = return_latent
+        self.trailing_tokens = (
+            list(trailing_tokens) if return_latent and trailing_tokens else []
+        )
+        self.cache = None
+        # prompt_key -> {"emb", "inputs", "prefix"}
+        self._prompts = {}
+        # key -> {"prompt_key", "remaining", "codes", "latents"}
+        self._requests = {}
+        # [key, sequences not admitted yet] in submission order.
+        self._pending = deque()
+        # Request key of each sequence in the cache.
+        self._owners = []
+        self._logits = None
+        self._latent = None
+
+    def submit(
+        self, key, speech_conditioning_latent, text_inputs, count, prompt_key=None
+    ):
+        """Queues `count` sequences to be sampled after the given prompt, returned by step() under key."""
+        prompt_key = key if prompt_key is None else prompt_key
+        if prompt_key not in self._prompts:
+            emb, inputs = self.model.speech_prompt(
+                speech_conditioning_latent, text_inputs
+            )
+            self._prompts[prompt_key] = {"emb": emb, "inputs": inputs, "prefix": {}}
+        self._requests[key] = {
+            "prompt_key": prompt_key,
+            "remaining": count,
+            "codes": [],
+            "latents": [],
+        }
+        self._pending.append([key, count])
+
+    def drop(self, prompt_key):
+        """Forgets the requests made with prompt_key, whether they are waiting or being sampled."""
+        keys = {
+            key
+            for key, request in self._requests.items()
+            if request["prompt_key"] == prompt_key
+        }
+        for key in keys:
+            del self._requests[key]
+        self._pending = deque(entry for entry in self._pending if entry[0] not in keys)
+        self._prompts.pop(prompt_key, None)
+        if self.cache is not None and self.cache.rows:
+            self._compact(
+                torch.tensor(
+                    [row for row, key in enumerate(self._owners) if key not in keys],
+                    dtype=torch.long,
+                    device=self.cache.columns.device,
+                )
+            )
+
+    def busy(self):
+        return bool(self._pending) or (self.cache is not None and self.cache.rows > 0)
+
+    def _allocate(self, device, latent=None):
+        """Allocates the per-slot state, latent being an example of the latents to keep, if any."""
+        slots = self.slots
+        self.steps = torch.zeros(slots, dtype=torch.long, device=device)
+        # Index of the trailing token each sequence is fed next, -1 while it is still sampling.
+        self.fed = torch.zeros(slots, dtype=torch.long, device=device)
+        self.mel_lens = torch.zeros(slots, dtype=torch.long, device=device)
+        self.codes = torch.empty(
+            (slots, self.max_new_tokens), dtype=torch.long, device=device
+        )
+        self.seen = (
+            torch.empty(
+                (slots, self.model.number_mel_codes), dtype=torch.bool, device=device
+            )
+            if self.sampler.needs_seen
+            else None
+        )
+        self.latents = (
+            latent.new_empty(
+                (
+                    slots,
+                    self.max_new_tokens + len(self.trailing_tokens),
+                    latent.shape[-1],
+                )
+            )
+            if latent is not None
+            else None
+        )
+        self._trailing = torch.as_tensor(
+            self.trailing_tokens, dtype=torch.long, device=device
+        )
+
+    def _admit(self):
+        """Moves waiting sequences into the free slots, running their prompts through the model if needed."""
+        while self._pending and (self.cache is None or self.cache.rows < self.slots):
+            entry = self._pending[0]
+            key, count = entry
+            prompt = self._prompts[self._requests[key]["prompt_key"]]
+            inputs = prompt["inputs"]
+            self.model.inference_model.store_mel_emb(prompt["emb"])
+            prefix = self.model.prefill(
+                inputs,
+                return_latent=self.return_latent,
+                prefix_cache=prompt["prefix"],
+            )
+            capacity = (
+                inputs.shape[1] + self.max_new_tokens + len(self.trailing_tokens)
+            )
+            if self.cache is None:
+                self.cache = StaticKVCache.like(
+                    prefix["past_key_values"], self.slots, capacity
+                )
+                self._allocate(inputs.device, prefix["latent"])
+            elif self.cache.capacity < capacity:
+                self.cache.resize(capacity)
+
+            start = self.cache.rows
+            admitted = min(count, self.slots - start)
+            stop = start + admitted
+            prompts = torch.zeros(admitted, dtype=torch.long, device=inputs.device)
+            self.cache.admit(
+                prefix["past_key_values"],
+                prompts,
+                torch.ones(
+                    (admitted, inputs.shape[1]), dtype=torch.long, device=inputs.device
+                ),
+            )
+            self._owners.extend([key] * admitted)
+            self.steps[start:stop] = 0
+            self.fed[start:stop] = -1
+            self.mel_lens[start:stop] = prompt["emb"].shape[1]
+            self.codes[start:stop] = self.model.stop_mel_token
+            if self.seen is not None:
+                self.seen[start:stop] = False
+                self.seen[start:stop].scatter_(
+                    1, inputs.expand(admitted, -1), True
+                )
+            if self.latents is not None:
+                self.latents[start:stop] = 0
+            logits = prefix["logits"].expand(admitted, -1)
+            self._logits = (
+                logits if self._logits is None else torch.cat([self._logits, logits])
+            )
+            if self.return_latent:
+                latent = prefix["latent"].expand(admitted, -1)
+                self._latent = (
+                    latent
+                    if self._latent is None
+                    else torch.cat([self._latent, latent])
+                )
+
+            entry[1] -= admitted
+            if not entry[1]:
+                self._pending.popleft()
+
+    def _compact(self, keep):
+        """Keeps only the sequences at indices keep (in increasing order) of the cache."""
+        rows = len(keep)
+        self.cache.compact(keep)
+        self._owners = [self._owners[row] for row in keep.tolist()]
+        for buffer in (
+            self.steps,
+            self.fed,
+            self.mel_lens,
+            self.codes,
+            self.seen,
+            self.latents,
+        ):
+            if buffer is not None:
+                buffer[:rows] = buffer[keep]
+        if rows:
+            self._logits = self._logits[keep]
+            if self.return_latent:
+                self._latent = self._latent[keep]
+        else:
+            self._logits = self._latent = None
+
+    def _finish(self, row, finished):
+        """Hands the sequence at row to its request, adding the request to finished if it is complete."""
+        key = self._owners[row]
+        request = self._requests.get(key)
+        if request is None:
+            return
+        request["codes"].append(self.codes[row].clone())
+        if self.latents is not None:
+            request["latents"].append(self.latents[row].clone())
+        request["remaining"] -= 1
+        if request["remaining"]:
+            return
+        del self._requests[key]
+        if not any(
+            r["prompt_key"] == request["prompt_key"] for r in self._requests.values()
+        ):
+            self._prompts.pop(request["prompt_key"], None)
+        finished.append(
+            (
+                key,
+                torch.stack(request["codes"]),
+                torch.stack(request["latents"]) if self.latents is not None else None,
+            )
+        )
+
+    def step(self):
+        """Admits waiting sequences, then samples one token for each. Returns the requests that completed."""
+        self._admit()
+        finished = []
+        if self.cache is None or not self.cache.rows:
+            return finished
+        rows = self.cache.rows
+        index = torch.arange(rows, device=self.codes.device)
+        steps = self.steps[:rows]
+        fed = self.fed[:rows]
+        if self.latents is not None:
+            self.latents[index, steps] = self._latent
+
+        sampling = fed < 0
+        stop_mel_token = self.model.stop_mel_token
+        if sampling.any():
+            next_tokens = self.sampler(
+                self._logits, self.seen[:rows] if self.seen is not None else None
+            )
+            self.codes[index[sampling], steps[sampling]] = next_tokens[sampling]
+            stopped = sampling & (next_tokens == stop_mel_token)
+        else:
+            next_tokens = torch.full_like(index, stop_mel_token)
+            stopped = sampling
+        steps += 1
+        fed.copy_(torch.where(sampling, stopped.long() - 1, fed + 1))
+        trailing = self._trailing
+        if len(trailing):
+            next_tokens = torch.where(
+                fed >= 0, trailing[fed.clamp(0, len(trailing) - 1)], next_tokens
+            )
+        # See UnifiedVoice.sample_codes().
+        running = (fed < len(trailing)) & ((fed >= 0) | (steps < self.max_new_tokens))
+        if not running.all():
+            for row in (~running).nonzero().squeeze(1).tolist():
+                self._finish(row, finished)
+            keep = running.nonzero().squeeze(1)
+            next_tokens = next_tokens[keep]
+            self._compact(keep)
+            rows = len(keep)
+            if not rows:
+                return finished
+
+        if self.seen is not None:
+            self.seen[:rows].scatter_(1, next_tokens.unsqueeze(1), True)
+        emb = self.model.decode_embedding(
+            next_tokens, self.cache.columns[:rows], self.mel_lens[:rows]
+        )
+        latent = self.model.final_norm(self.model.decode_step(emb, self.cache)[:, -1])
+        self._logits = self.model.mel_head(latent)
+        if self.return_latent:
+            self._latent = latent
+        return finished
 
 
 class PrunedGPT2InferenceModel(GPT2PreTrainedModel):
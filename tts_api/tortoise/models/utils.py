@@ -4,6 +4,7 @@ import os
 import re
 import requests
 import progressbar
+import torch
 from dotenv import load_dotenv
 
 try:
@@ -13,6 +14,10 @@ except ImportError:
         "Sorry, gdown is required in order to download the new BigVGAN vocoder.\n"
         "Please install it with `pip install gdown` and try again."
     )
+try:
+    from safetensors.torch import load_file, save_file
+except ImportError:
+    load_file = save_file = None
 from urllib import request
 
 import progressbar
@@ -116,3 +121,68 @@ def get_model_path(model_name, models_dir=MODELS_DIR):
     if not os.path.exists(model_path) and models_dir == MODELS_DIR:
         download_models([model_name])
     return model_path
+
+
+def mapped_checkpoint_path(model_path):
+    return os.path.splitext(model_path)[0] + ".safetensors"
+
+
+def load_checkpoint(model_path, subkey=None):
+    """
+    Loads the state dict stored in a .pth checkpoint. The first time, the checkpoint is converted to a .safetensors
+    file next to it; after that the tensors are memory-mapped from that file, so loading is nearly free and processes
+    using the same checkpoint share its pages through the page cache. Falls back to torch.load when safetensors is not
+    installed or the checkpoint directory is read-only.
+    :param subkey: Key of the state dict inside the checkpoint, for checkpoints that bundle several.
+    """
+    if load_file is None:
+        state_dict = torch.load(model_path, map_location=torch.device("cpu"))
+        return state_dict[subkey] if subkey is not None else state_dict
+
+    mapped_path = mapped_checkpoint_path(model_path)
+    if not os.path.exists(mapped_path) or os.path.getmtime(
+        mapped_path
+    ) < os.path.getmtime(model_path):
+        state_dict = torch.load(model_path, map_location=torch.device("cpu"))
+        if subkey is not None:
+            state_dict = state_dict[subkey]
+        # safetensors refuses tensors that share storage, so every entry gets its own contiguous copy.
+        state_dict = {
+            k: v.contiguous().clone()
+            for k, v in state_dict.items()
+            if isinstance(v, torch.Tensor)
+        }
+        tmp_path = f"{mapped_path}.{os.getpid()}.tmp"
+        try:
+            save_file(state_dict, tmp_path)
+            os.replace(tmp_path, mapped_path)
+        except OSError as e:
+            print(f"Could not write {mapped_path}, loading {model_path} directly: {e}")
+            return state_dict
+    return load_file(mapped_path, device="cpu")
+
+
+def assign_state_dict(module, state_dict):
+    """
+    Like module.load_state_dict(state_dict), but makes the parameters and buffers use the given tensors instead of
+    copying into them, so weights memory-mapped by load_checkpoint() stay shared.
+    """
+    own = module.state_dict()
+    missing = [k for k in own if k not in state_dict]
+    unexpected = [k for k in state_dict if k not in own]
+    if missing or unexpected:
+        raise RuntimeError(
+            f"Error(s) in loading state_dict for {module.__class__.__name__}: "
+            f"missing keys {missing}, unexpected keys {unexpected}"
+        )
+    for name, tensor in state_dict.items():
+        *path, attr = name.split(".")
+        owner = module
+        for part in path:
+            owner = getattr(owner, part)
+        target = getattr(owner, attr)
+        if target.shape != tensor.shape:
+            raise RuntimeError(
+                f"Size mismatch for {name}: checkpoint has {tuple(tensor.shape)}, model has {tuple(target.shape)}"
+            )
+        target.data = tensor.to(target.dtype)
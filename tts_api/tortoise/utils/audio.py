@@ -1,6 +1,7 @@
 import os
 from glob import glob
 import re
+import threading
 from typing import Dict, List, Tuple, Optional
 
 import librosa
@@ -10,9 +11,6 @@ import torchaudio
 from scipy.io.wavfile import read
 
 from tortoise.utils.stft import STFT
-import logging
-
-logging.basicConfig(level=logging.DEBUG)
 
 # BUILTIN_VOICES_DIR = os.path.join(
 #     os.path.dirname(os.path.realpath(__file__)), "../voices"
@@ -120,56 +118,155 @@ def is_user_voice_format(voice_name: str) -> bool:
     return bool(re.match(r"^\d+$", voice_name))
 
 
+def list_voice_dirs(voices_dir: str) -> Dict[str, str]:
+    """
+    Maps voice names to their directories: default voices sit directly in voices_dir,
+    user voices in a user ID subdirectory and are named "<user_id>/<voice>".
+    """
+    voice_dirs: Dict[str, str] = {}
+    for item in os.listdir(voices_dir):
+        item_path = os.path.join(voices_dir, item)
+        if os.path.isdir(item_path):
+            if is_user_voice_format(item):  # This is a user ID directory
+                for voice_name in os.listdir(item_path):
+                    voice_dir = os.path.join(item_path, voice_name)
+                    if os.path.isdir(voice_dir):
+                        voice_dirs[f"{item}/{voice_name}"] = voice_dir
+            else:  # This is a default voice directory
+                voice_dirs[item] = item_path
+    return voice_dirs
+
+
 def get_voices(extra_voice_dirs: List[str] = []) -> Dict[str, List[str]]:
     dirs = [BUILTIN_VOICES_DIR] + extra_voice_dirs
     voices: Dict[str, List[str]] = {}
     for d in dirs:
-        logging.debug("Searching directory: %s", d)
-        for item in os.listdir(d):
-            item_path = os.path.join(d, item)
-            logging.debug("Checking item: %s", item_path)
-            if os.path.isdir(item_path):
-                if is_user_voice_format(item):  # This is a user ID directory
-                    for voice_name in os.listdir(item_path):
-                        voice_dir = os.path.join(item_path, voice_name)
-                        if os.path.isdir(voice_dir):
-                            voice_key = f"{item}/{voice_name}"
-                            voices[voice_key] = get_audio_files(voice_dir)
-                            logging.debug(
-                                "Added user voice: %s with files: %s",
-                                voice_key,
-                                voices[voice_key],
-                            )
-                else:  # This is a default voice directory
-                    voices[item] = get_audio_files(item_path)
-                    logging.debug(
-                        "Added default voice: %s with files: %s", item, voices[item]
-                    )
-    logging.debug("Final voices dictionary: %s", voices)
+        for voice, voice_dir in list_voice_dirs(d).items():
+            voices[voice] = get_audio_files(voice_dir)
     return voices
 
 
 def get_audio_files(directory: str) -> List[str]:
-    files = (
+    return (
         glob(f"{directory}/*.wav")
         + glob(f"{directory}/*.mp3")
         + glob(f"{directory}/*.pth")
     )
-    logging.debug("Audio files found in %s: %s", directory, files)
-    return files
+
+
+class VoiceRegistry:
+    """
+    Resident index of the voices under a voices directory, so resolving a voice does not
+    rescan the whole tree. Each entry remembers its directory's mtime and re-lists its
+    files when that changes; voices that appear on disk later are picked up on lookup.
+
+    Only membership is tracked: which files a voice has. A clip overwritten in place
+    leaves the directory mtime and the list unchanged, and nothing derived from the
+    clips' contents is kept here. Caches of such data must validate the files
+    themselves, as LatentCache does by keying on each clip's size and mtime.
+
+    Only names that list_voice_dirs() produces are resolved, and only to directories
+    really inside voices_dir, so a name taken from a request cannot reach other files.
+    """
+
+    def __init__(self, voices_dir: str):
+        self.voices_dir = voices_dir
+        self._voices: Dict[str, Tuple[int, List[str]]] = {}
+        self._lock = threading.Lock()
+        self._built = False
+
+    def build(self):
+        """Scans the voices directory once; later changes are applied incrementally."""
+        voices = {}
+        for voice, voice_dir in list_voice_dirs(self.voices_dir).items():
+            try:
+                self._voice_dir(voice)
+            except ValueError:
+                continue  # e.g. a symlink out of the tree
+            voices[voice] = (os.stat(voice_dir).st_mtime_ns, get_audio_files(voice_dir))
+        with self._lock:
+            self._voices = voices
+            self._built = True
+
+    def _voice_dir(self, voice: str) -> str:
+        """Returns the directory of a voice, raising ValueError for names outside the tree."""
+        parts = voice.split("/")
+        if len(parts) == 1:
+            well_formed = not is_user_voice_format(voice)
+        else:
+            well_formed = len(parts) == 2 and is_user_voice_format(parts[0])
+        if not well_formed or any(part in ("", ".", "..") for part in parts):
+            raise ValueError(f"Voice '{voice}' not found")
+        voice_dir = os.path.join(self.voices_dir, *parts)
+        root = os.path.realpath(self.voices_dir)
+        if os.path.commonpath([root, os.path.realpath(voice_dir)]) != root:
+            raise ValueError(f"Voice '{voice}' not found")
+        return voice_dir
+
+    def get(self, voice: str) -> List[str]:
+        """
+        Returns the clip (or latent) files of a voice, raising ValueError if it does not exist.
+        The paths are current, but their contents may have changed since the last call.
+        """
+        if not self._built:
+            self.build()
+        with self._lock:
+            entry = self._voices.get(voice)
+        if entry is None:
+            # Unknown names are only looked up in a fresh scan, never joined onto the path.
+            self.build()
+            with self._lock:
+                entry = self._voices.get(voice)
+            if entry is None:
+                raise ValueError(f"Voice '{voice}' not found")
+        try:
+            mtime = os.stat(self._voice_dir(voice)).st_mtime_ns
+        except FileNotFoundError:
+            self.remove(voice)
+            raise ValueError(f"Voice '{voice}' not found")
+        if entry[0] == mtime:
+            return entry[1]
+        return self.update(voice)
+
+    def update(self, voice: str) -> List[str]:
+        """(Re-)lists the files of a voice that was added or changed."""
+        voice_dir = self._voice_dir(voice)
+        mtime = os.stat(voice_dir).st_mtime_ns
+        files = get_audio_files(voice_dir)
+        with self._lock:
+            self._voices[voice] = (mtime, files)
+        return files
+
+    def remove(self, voice: str):
+        """Forgets a voice, or every voice under a prefix such as a user ID."""
+        with self._lock:
+            for name in [
+                n for n in self._voices if n == voice or n.startswith(f"{voice}/")
+            ]:
+                del self._voices[name]
+
+    def names(self) -> List[str]:
+        if not self._built:
+            self.build()
+        with self._lock:
+            return list(self._voices)
+
+
+voice_registry = VoiceRegistry(BUILTIN_VOICES_DIR)
 
 
 def load_voice(
-    voice: str, extra_voice_dirs: List[str] = []
+    voice: str, extra_voice_dirs: List[str] = [], registry: VoiceRegistry = None
 ) -> Tuple[Optional[List], Optional[torch.Tensor]]:
     if voice == "random":
         return None, None
-    voices = get_voices(extra_voice_dirs)
-    logging.debug("Attempting to load voice: %s", voice)
-    logging.debug("Available voices: %s", list(voices.keys()))
-    if voice not in voices:
-        raise ValueError(f"Voice '{voice}' not found")
-    paths = voices[voice]
+    if extra_voice_dirs:
+        voices = get_voices(extra_voice_dirs)
+        if voice not in voices:
+            raise ValueError(f"Voice '{voice}' not found")
+        paths = voices[voice]
+    else:
+        paths = (registry or voice_registry).get(voice)
     if len(paths) == 1 and paths[0].endswith(".pth"):
         return None, torch.load(paths[0])
     else:
@@ -196,6 +196,9 @@ class GaussianDiffusion:
     :param rescale_timesteps: if True, pass floating point timesteps into the
                               model so that they are always scaled like in the
                               original paper (0 to 1000).
+
+    Sampling draws its noise from the global torch RNG, or from `generator` when
+    it is set to a torch.Generator on the model's device.
     """
 
     def __init__(
@@ -212,6 +215,7 @@ class GaussianDiffusion:
         sampler="ddim",
     ):
         self.sampler = sampler
+        self.generator = None
         self.model_mean_type = ModelMeanType(model_mean_type)
         self.model_var_type = ModelVarType(model_var_type)
         self.loss_type = LossType(loss_type)
@@ -397,7 +401,8 @@ class GaussianDiffusion:
 
         if self.conditioning_free:
             if self.ramp_conditioning_free:
-                assert t.shape[0] == 1  # This should only be used in inference.
+                # Only used in inference, where a whole batch is at one timestep.
+                assert (t == t[0]).all()
                 cfk = self.conditioning_free_k * (
                     1 - self._scale_timesteps(t)[0].item() / self.num_timesteps
                 )
@@ -546,7 +551,7 @@ class GaussianDiffusion:
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
         )
-        noise = th.randn_like(x)
+        noise = self.randn(x.shape, x.device, x.dtype)
         nonzero_mask = (
             (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
         )  # no noise when t == 0
@@ -714,7 +719,21 @@ class GaussianDiffusion:
         '''
         """
 
-    def sample_loop(self, *args, **kwargs):
+    def randn(self, shape, device, dtype=None):
+        """Sampling noise of the given shape; see `generator`."""
+        return th.randn(*shape, device=device, dtype=dtype, generator=self.generator)
+
+    def sample_loop(self, model, *args, cancel_check=None, **kwargs):
+        """
+        Samples with the configured sampler. Other arguments are those of the
+        sampler's *_sample_loop().
+
+        :param cancel_check: if not None, called before every model evaluation,
+            i.e. between diffusion steps; it may raise to abandon sampling.
+        """
+        if cancel_check is not None:
+            model = _CancellableModel(model, cancel_check)
+        args = (model,) + args
         s = self.sampler
         if s == "p":
             return self.p_sample_loop(*args, **kwargs)
@@ -804,7 +823,7 @@ class GaussianDiffusion:
         if noise is not None:
             img = noise
         else:
-            img = th.randn(*shape, device=device)
+            img = self.randn(shape, device)
         indices = list(range(self.num_timesteps))[::-1]
 
         for i in tqdm(indices, disable=not progress):
@@ -861,7 +880,7 @@ class GaussianDiffusion:
             * th.sqrt(1 - alpha_bar / alpha_bar_prev)
         )
         # Equation 12.
-        noise = th.randn_like(x)
+        noise = self.randn(x.shape, x.device, x.dtype)
         mean_pred = (
             out["pred_xstart"] * th.sqrt(alpha_bar_prev)
             + th.sqrt(1 - alpha_bar_prev - sigma**2) * eps
@@ -969,7 +988,7 @@ class GaussianDiffusion:
         if noise is not None:
             img = noise
         else:
-            img = th.randn(*shape, device=device)
+            img = self.randn(shape, device)
         indices = list(range(self.num_timesteps))[::-1]
 
         if progress:
@@ -1146,7 +1165,7 @@ class GaussianDiffusion:
         if noise is not None:
             img = noise
         else:
-            img = th.randn(*shape, device=device)
+            img = self.randn(shape, device)
 
         if skip_timesteps and init_image is None:
             init_image = th.zeros_like(img)
@@ -1618,6 +1637,19 @@ def space_timesteps(num_timesteps, section_counts):
     return set(all_steps)
 
 
+class _CancellableModel:
+    def __init__(self, model, cancel_check):
+        self.model = model
+        self.cancel_check = cancel_check
+
+    def __call__(self, *args, **kwargs):
+        self.cancel_check()
+        return self.model(*args, **kwargs)
+
+    def parameters(self):
+        return self.model.parameters()
+
+
 class _WrappedModel:
     def __init__(self, model, timestep_map, rescale_timesteps, original_num_steps):
         self.model = model
@@ -0,0 +1,99 @@
+import torch
+import torch.nn.functional as F
+
+
+class FusedSampler:
+    """
+    Picks the next token of every sequence in a batch like Hugging Face generate(do_sample=True) does with a
+    repetition penalty, extra logits processors, typical sampling, temperature, top-k and top-p, applied in that
+    order, but with a handful of batched tensor operations per step:
+
+    - the repetition penalty reads a (batch, vocab) mask of the tokens each sequence has seen, kept up to date by
+      the caller, instead of gathering the logits of the whole history;
+    - typical sampling (see TypicalLogitsWarper) thresholds the scores directly instead of scattering a mask back
+      from sorted order;
+    - with top_k set, only the k best scores are sorted, top-p is applied among them, and the token is drawn from
+      them, so the full vocabulary is never sorted.
+    """
+
+    def __init__(
+        self,
+        repetition_penalty=1.0,
+        typical_mass=None,
+        temperature=1.0,
+        top_k=0,
+        top_p=1.0,
+        processors=(),
+    ):
+        self.repetition_penalty = repetition_penalty
+        self.typical_mass = typical_mass
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.processors = list(processors)
+
+    @property
+    def needs_seen(self):
+        """Whether __call__() reads the mask of seen tokens."""
+        return self.repetition_penalty != 1.0
+
+    def warp(self, logits, seen=None, input_ids=None):
+        """
+        Returns (scores, indices): the scores __call__() draws tokens from, after every processor and warper, with
+        those of tokens that cannot be drawn at -inf. With top_k or top_p set, they are in decreasing order (only the
+        k best with top_k) and indices holds their token ids; otherwise they are in vocabulary order and indices is
+        None.
+        """
+        scores = logits.float()
+        if self.repetition_penalty != 1.0:
+            penalized = torch.where(
+                scores < 0,
+                scores * self.repetition_penalty,
+                scores / self.repetition_penalty,
+            )
+            scores = torch.where(seen, penalized, scores)
+        for processor in self.processors:
+            scores = processor(input_ids, scores)
+        if self.typical_mass is not None:
+            normalized = F.log_softmax(scores, dim=-1)
+            p = normalized.exp()
+            ent = -(normalized * p).nansum(-1, keepdim=True)
+            shifted = (-normalized - ent).abs()
+            sorted_shifted, sorted_indices = torch.sort(shifted, dim=-1)
+            last_ind = (
+                (p.gather(-1, sorted_indices).cumsum(dim=-1) < self.typical_mass)
+                .sum(dim=-1, keepdim=True)
+                .clamp(max=scores.shape[-1] - 1)
+            )
+            scores = scores.masked_fill(
+                shifted > sorted_shifted.gather(-1, last_ind), -float("Inf")
+            )
+        if self.temperature != 1.0:
+            scores = scores / self.temperature
+
+        if self.top_k:
+            scores, indices = torch.topk(
+                scores, min(self.top_k, scores.shape[-1]), dim=-1
+            )
+        elif self.top_p < 1.0:
+            scores, indices = torch.sort(scores, descending=True, dim=-1)
+        else:
+            indices = None
+        if self.top_p < 1.0:
+            # Drop the tokens after the smallest prefix of the sorted ones that holds top_p of the mass.
+            probs = F.softmax(scores, dim=-1)
+            remove = probs.cumsum(dim=-1) - probs >= self.top_p
+            scores = scores.masked_fill(remove, -float("Inf"))
+        return scores, indices
+
+    def __call__(self, logits, seen=None, input_ids=None):
+        """
+        Returns a (batch,) tensor of tokens sampled from logits, a (batch, vocab) tensor. seen is the boolean mask
+        of tokens already in each sequence (only read with a repetition penalty); input_ids, the sequences so far,
+        are only passed to the extra processors.
+        """
+        scores, indices = self.warp(logits, seen, input_ids)
+        tokens = torch.multinomial(F.softmax(scores, dim=-1), num_samples=1)
+        if indices is not None:
+            tokens = indices.gather(-1, tokens)
+        return tokens.squeeze(1)